@@ -0,0 +1,49 @@
+'''Timing of sliding window vessel detection: the former per-patch loop against the
+batched tiled inference in eye2you.patches, with a small convolutional model on the CPU.
+
+Usage: python benchmarks/bench_inference.py [size] [patch_size] [stride]
+'''
+import sys
+import time
+
+import torch
+
+from eye2you import patches
+from eye2you.helper_functions import sliding_window_vessel
+
+
+def loop_sliding_window_vessel(model, img, patch_size, stride):
+    # former sliding_window_vessel: one model call per patch
+    c, h, w = img.shape
+    n_h, n_w = patches.grid_size((h, w), patch_size, stride)
+    vessel = torch.zeros((1, h, w))
+    for ii in range(n_h):
+        for jj in range(n_w):
+            y = model(img[:, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size].unsqueeze(0))
+            vessel[0, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size] += (
+                y[:, 1, :, :] > y[:, 0, :, :]).squeeze().float()
+    return torch.clamp(vessel, 0, 1)
+
+
+def main(size=256, patch_size=32, stride=8):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(8, 2, 3, padding=1))
+    model.eval()
+    img = torch.rand(3, size, size)
+    n_h, n_w = patches.grid_size((size, size), patch_size, stride)
+    print('{0}x{0} image, patch {1}, stride {2}: {3} patches'.format(size, patch_size, stride, n_h * n_w))
+    cases = [
+        ('per patch loop', lambda: loop_sliding_window_vessel(model, img, patch_size, stride)),
+        ('batched voting', lambda: sliding_window_vessel(model, img, patch_size, stride, device='cpu')),
+        ('batched gaussian blend', lambda: sliding_window_vessel(model, img, patch_size, stride, device='cpu',
+                                                                 blend='gaussian')),
+    ]
+    with torch.no_grad():
+        for name, func in cases:
+            start = time.perf_counter()
+            func()
+            print('{:<25} {:10.3f} ms'.format(name, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,67 @@
+'''Timing of patch extraction and merging: the former per-patch Python loops against the
+unfold/fold based functions in eye2you.patches.
+
+Usage: python benchmarks/bench_patches.py [size] [patch_size] [stride] [repeats]
+'''
+import sys
+import timeit
+
+import torch
+
+from eye2you import patches
+
+
+def loop_sliding_window(img, patch_size, stride):
+    # former split_tensor_image_sliding_window
+    c, h, w = img.shape
+    n_h = int((h - patch_size) / stride) + 1
+    n_w = int((w - patch_size) / stride) + 1
+    out = torch.zeros((n_h * n_w, c, patch_size, patch_size))
+    for ii in range(n_h):
+        for jj in range(n_w):
+            out[ii * n_w + jj, ...] = img[:, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size]
+    return out
+
+
+def loop_merge(split, n_h, n_w, patch_size):
+    # former merge_tensor_image_from_patches
+    out = torch.zeros((split.shape[1], patch_size * n_h, patch_size * n_w))
+    for ii in range(n_h):
+        for jj in range(n_w):
+            out[:, ii * patch_size:(ii + 1) * patch_size, jj * patch_size:(jj + 1) * patch_size] = split[ii * n_w + jj]
+    return out
+
+
+def loop_fold(split, size, patch_size, stride):
+    # summing overlapping windows one at a time, as the former merge_labels
+    n_h, n_w = patches.grid_size((size, size), patch_size, stride)
+    out = torch.zeros((split.shape[1], size, size))
+    for ii in range(n_h):
+        for jj in range(n_w):
+            out[:, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size] += split[ii * n_w + jj]
+    return out
+
+
+def main(size=512, patch_size=32, stride=4, repeats=3):
+    img = torch.rand(3, size, size)
+    n_h, n_w = patches.grid_size((size, size), patch_size)
+    tiles = patches.split_patches(img[None], patch_size)
+    windows = patches.split_patches(img[None], patch_size, stride)
+    cases = [
+        ('sliding window, loop', lambda: loop_sliding_window(img, patch_size, stride)),
+        ('sliding window, view', lambda: patches.sliding_window_view(img[None], patch_size, stride)),
+        ('sliding window, copy', lambda: patches.split_patches(img[None], patch_size, stride)),
+        ('merge tiles, loop', lambda: loop_merge(tiles, n_h, n_w, patch_size)),
+        ('merge tiles, reshape', lambda: patches.merge_patches(tiles, (n_h, n_w))),
+        ('fold windows, loop', lambda: loop_fold(windows, size, patch_size, stride)),
+        ('fold windows', lambda: patches.fold_patches(windows, (size, size), stride)),
+    ]
+    print('{0}x{0} image, patch {1}, stride {2}: {3} windows'.format(size, patch_size, stride, len(windows)))
+    for name, func in cases:
+        func()
+        duration = min(timeit.repeat(func, number=repeats, repeat=3)) / repeats
+        print('{:<25} {:10.3f} ms'.format(name, duration * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,58 @@
+'''Micro-benchmark of the per-image cost of DataPreparation: composed torchvision transforms
+(resize, center crop, ToTensor, Normalize) against the cached PreparationTransform.
+
+Usage: python benchmarks/bench_preparation.py [image] [repeats]
+'''
+import pathlib
+import sys
+import timeit
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from eye2you.datasets import DataPreparation, to_normalized_tensor
+
+LOCAL_DIR = pathlib.Path(__file__).resolve().parent
+
+
+def main(filename, repeats=200):
+    img = Image.open(filename).convert('RGB')
+    img.load()
+    arr = np.array(img)
+    tensor = torch.from_numpy(arr).permute(2, 0, 1).contiguous()
+    prep = DataPreparation(size=299, crop=299, mean=(0.3198, 0.1746, 0.0901), std=(0.2287, 0.1286, 0.0723))
+
+    def rebuilt_compose(img):
+        # previous behaviour of DataPreparation.transform
+        return transforms.Compose([
+            transforms.Resize(prep.size),
+            transforms.CenterCrop(prep.crop),
+            transforms.ToTensor(),
+            transforms.Normalize(prep.mean, prep.std),
+        ])(img)
+
+    to_tensor = transforms.ToTensor()
+    normalize = transforms.Normalize(prep.mean, prep.std)
+    small = img.resize((299, 299))
+
+    cases = [
+        ('conversion ToTensor+Normalize', lambda: normalize(to_tensor(small))),
+        ('conversion to_normalized_tensor', lambda: to_normalized_tensor(small, prep.mean, prep.std)),
+        ('compose rebuilt per call, PIL', lambda: rebuilt_compose(img)),
+        ('compose cached, PIL', lambda: prep.get_transform()(img)),
+        ('transform, PIL', lambda: prep.transform(img)),
+        ('transform, numpy', lambda: prep.transform(arr)),
+        ('transform, tensor', lambda: prep.transform(tensor)),
+    ]
+    print('Image {} {}x{}, {} repeats'.format(filename, img.width, img.height, repeats))
+    for name, func in cases:
+        func()
+        duration = min(timeit.repeat(func, number=repeats, repeat=5)) / repeats
+        print('{:<35} {:8.3f} ms/image'.format(name, duration * 1000))
+
+
+if __name__ == '__main__':
+    image = sys.argv[1] if len(sys.argv) > 1 else LOCAL_DIR.parent / 'eye2you/tests/data/classA/img0.jpg'
+    main(image, int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,115 @@
+'''Timing of find_retina_boxes: threshold and contour circle fit (with Hough fallback)
+against the former recursive Hough transform search, the bounded Hough search only, the
+threaded batch API and batched retina masks with and without camera profile.
+
+Usage: python benchmarks/bench_retina.py [image ...] [--repeats N]
+'''
+import pathlib
+import sys
+import timeit
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from eye2you.helper_functions import RetinaMasks, find_retina_boxes, find_retina_boxes_batch
+
+LOCAL_DIR = pathlib.Path(__file__).resolve().parent
+
+
+def recursive_find_retina_boxes(im,
+                                dp=1.0,
+                                param1=60,
+                                param2=50,
+                                minimum_circle_distance=0.2,
+                                minimum_radius=0.4,
+                                maximum_radius=0.65,
+                                max_patch_size=800,
+                                max_distance_center=0.05,
+                                param1_limit=40,
+                                param1_step=10,
+                                param2_limit=20,
+                                param2_step=10):
+    # former find_retina_boxes without display output and retry messages
+    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    scale_factor = max(gray.shape) / max_patch_size
+    shape = (int(gray.shape[0] / scale_factor), int(gray.shape[1] / scale_factor))
+    gray = cv2.resize(gray.T, shape).T
+
+    minRadius = int(min(gray.shape) * minimum_radius)
+    maxRadius = int(min(gray.shape) * maximum_radius)
+    minDist = int(min(gray.shape) * minimum_circle_distance)
+    maxDist = int(min(gray.shape) * max_distance_center)
+
+    circles = cv2.HoughCircles(gray,
+                               cv2.HOUGH_GRADIENT,
+                               dp=dp,
+                               minDist=minDist,
+                               param1=param1,
+                               param2=param2,
+                               minRadius=minRadius,
+                               maxRadius=maxRadius)
+    center_circle = None
+    if circles is not None:
+        circles = np.round(circles[0, :]).astype("int")
+        center_circle = 0
+        if len(circles) > 1:
+            cy, cx = np.array(gray.shape) / 2
+            dist = np.sqrt((circles[:, 0] - cx)**2 + (circles[:, 1] - cy)**2)
+            center_circle = np.argmin(dist)
+            if dist[center_circle] > maxDist:
+                center_circle = None
+        if center_circle is not None:
+            x, y, r_out = np.round(scale_factor * circles[center_circle, :]).astype(int)
+            r_in = int(np.sqrt((r_out**2) / 2))
+            return x, y, r_in, r_out, None
+        return None
+
+    kwargs = dict(dp=dp,
+                  minimum_circle_distance=minimum_circle_distance,
+                  minimum_radius=minimum_radius,
+                  maximum_radius=maximum_radius,
+                  max_patch_size=max_patch_size,
+                  max_distance_center=max_distance_center)
+    if param1 > param1_limit:
+        return recursive_find_retina_boxes(im, param1=param1 - abs(param1_step), param2=param2, **kwargs)
+    if param2 > param2_limit:
+        return recursive_find_retina_boxes(im, param1=param1, param2=param2 - abs(param2_step), **kwargs)
+    return None
+
+
+def main(filenames, repeats=10):
+    images = [np.ascontiguousarray(np.asarray(Image.open(f).convert('RGB'))[..., ::-1]) for f in filenames]
+    cases = [
+        ('hough, recursive', lambda: [recursive_find_retina_boxes(im) for im in images]),
+        ('hough', lambda: [find_retina_boxes(im, method='hough') for im in images]),
+        ('contour', lambda: [find_retina_boxes(im) for im in images]),
+        ('contour, batch', lambda: find_retina_boxes_batch(images)),
+    ]
+    retina_masks = RetinaMasks()
+    mask_cases = [
+        ('masks', lambda: retina_masks(images)),
+        ('masks, profile', lambda: retina_masks(images, profile='camera')),
+    ]
+    print('{} images, {} repeats'.format(len(images), repeats))
+    for name, func in cases:
+        circles = func()
+        duration = min(timeit.repeat(func, number=repeats, repeat=3)) / repeats / len(images)
+        print('{:<20} {:8.2f} ms/image   {}'.format(name, duration * 1000,
+                                                   [c[:2] + c[3:4] if c is not None else None for c in circles]))
+    for name, func in mask_cases:
+        func()
+        duration = min(timeit.repeat(func, number=repeats, repeat=3)) / repeats / len(images)
+        print('{:<20} {:8.2f} ms/image'.format(name, duration * 1000))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    repeats = 10
+    if '--repeats' in args:
+        ii = args.index('--repeats')
+        repeats = int(args[ii + 1])
+        del args[ii:ii + 2]
+    if not args:
+        args = sorted((LOCAL_DIR.parent / 'eye2you/tests/data').glob('class*/img?.jpg'))
+    main(args, repeats)
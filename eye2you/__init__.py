@@ -1,4 +1,5 @@
-from .datasets import TripleDataset, DataAugmentation, DataPreparation
+from .datasets import (TripleDataset, ShardDataset, PatchDataset, TarDataset, DataAugmentation, BatchAugmentation,
+                       DataPreparation)
 from . import models, factory, net, datasets, helper_functions
 from .services import SimpleService, CAMService
 from .net import Network
@@ -6,7 +7,11 @@ from .train import Coach
 
 __all__ = [
     'TripleDataset',
+    'ShardDataset',
+    'PatchDataset',
+    'TarDataset',
     'DataAugmentation',
+    'BatchAugmentation',
     'DataPreparation',
     'Network',
     'models',
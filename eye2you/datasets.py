@@ -1,15 +1,83 @@
+import glob
+import io
+import math
+import os
 import pathlib
 import random
+import tarfile
 
 import numpy as np
+import pandas as pd
 import torch
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as F
-from PIL import Image
+import yaml
+from PIL import Image, ImageDraw
 
 from .helper_functions import pil_loader
 
+SHARD_INDEX = 'index.yaml'
+
+
+class ConstantChannel():
+    '''Lightweight placeholder for an absent mask or segmentation channel in which every pixel
+    has the same uint8 value. It is not resampled by DataAugmentation (it only takes over the size
+    of the augmented sample) and DataPreparation turns it into a broadcast tensor without
+    allocating the full image.
+
+    Arguments:
+        value {int} -- uint8 value of all pixels
+        size {tuple} -- (width, height) as in PIL
+    '''
+
+    def __init__(self, value, size):
+        self.value = value
+        self.size = tuple(size)
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def resize(self, size, *args, **kwargs):  # pylint: disable=unused-argument
+        return ConstantChannel(self.value, size)
+
+    def to_image(self):
+        return Image.fromarray(np.full((self.height, self.width), self.value, dtype=np.uint8))
+
+    def to_tensor(self):
+        return torch.full((1, 1, 1), self.value / 255).expand(1, self.height, self.width)
+
+
+def _transform_label(img, func, *args):
+    # constant channels are not resampled, see _fit_constant
+    if img is None or isinstance(img, ConstantChannel):
+        return img
+    return func(img, *args)
+
+
+def _fit_constant(img, sample):
+    if isinstance(img, ConstantChannel) and img.size != sample.size:
+        return img.resize(sample.size)
+    return img
+
+
+def _rotation_matrix(angle, size, center=None):
+    # same output to input mapping as PIL.Image.rotate without expand
+    w, h = size
+    if center is None:
+        center = (w / 2.0, h / 2.0)
+    cx, cy = center
+    theta = -math.radians(angle)
+    a, b = math.cos(theta), math.sin(theta)
+    d, e = -math.sin(theta), math.cos(theta)
+    return np.array([[a, b, cx - a * cx - b * cy], [d, e, cy - d * cx - e * cy], [0, 0, 1]])
+
 
 class DataAugmentation():
 
@@ -23,7 +91,8 @@ class DataAugmentation():
                  saturation=None,
                  hue=None,
                  hflip=None,
-                 vflip=None):
+                 vflip=None,
+                 fused=False):
         self.color_jitter = None
         self.rotation = None
         self.random_resize_crop = None
@@ -54,8 +123,11 @@ class DataAugmentation():
 
         self.hflip = hflip
         self.vflip = vflip
+        self.fused = fused
 
     def apply(self, source, target):
+        if self.fused:
+            return self.apply_fused(source, target)
         target_is_image = isinstance(target[0], Image.Image)
         sample, mask, segment = source
 
@@ -68,8 +140,9 @@ class DataAugmentation():
         if self.rotation is not None:
             angle = self.rotation.get_params(self.rotation.degrees)
             sample = F.rotate(sample, angle, Image.BILINEAR, self.rotation.expand, self.rotation.center)
-            mask = F.rotate(mask, angle, Image.NEAREST, self.rotation.expand, self.rotation.center)
-            segment = F.rotate(segment, angle, Image.NEAREST, self.rotation.expand, self.rotation.center)
+            mask = _transform_label(mask, F.rotate, angle, Image.NEAREST, self.rotation.expand, self.rotation.center)
+            segment = _transform_label(segment, F.rotate, angle, Image.NEAREST, self.rotation.expand,
+                                       self.rotation.center)
             if target_is_image:
                 for ii in range(len(target)):
                     target[ii] = F.rotate(target[ii], angle, Image.NEAREST, self.rotation.expand, self.rotation.center)
@@ -79,8 +152,9 @@ class DataAugmentation():
             i, j, h, w = self.random_resize_crop.get_params(sample, self.random_resize_crop.scale,
                                                             self.random_resize_crop.ratio)
             sample = F.resized_crop(sample, i, j, h, w, self.random_resize_crop.size, Image.BILINEAR)
-            mask = F.resized_crop(mask, i, j, h, w, self.random_resize_crop.size, Image.NEAREST)
-            segment = F.resized_crop(segment, i, j, h, w, self.random_resize_crop.size, Image.NEAREST)
+            mask = _transform_label(mask, F.resized_crop, i, j, h, w, self.random_resize_crop.size, Image.NEAREST)
+            segment = _transform_label(segment, F.resized_crop, i, j, h, w, self.random_resize_crop.size,
+                                       Image.NEAREST)
             if target_is_image:
                 for ii in range(len(target)):
                     target[ii] = F.resized_crop(target[ii], i, j, h, w, self.random_resize_crop.size, Image.NEAREST)
@@ -88,8 +162,8 @@ class DataAugmentation():
         if self.hflip is not None:
             if random.random() < self.hflip:
                 sample = F.hflip(sample)
-                mask = F.hflip(mask)
-                segment = F.hflip(segment)
+                mask = _transform_label(mask, F.hflip)
+                segment = _transform_label(segment, F.hflip)
                 if target_is_image:
                     for ii in range(len(target)):
                         target[ii] = F.hflip(target[ii])
@@ -97,13 +171,79 @@ class DataAugmentation():
         if self.vflip is not None:
             if random.random() < self.vflip:
                 sample = F.vflip(sample)
-                mask = F.vflip(mask)
-                segment = F.vflip(segment)
+                mask = _transform_label(mask, F.vflip)
+                segment = _transform_label(segment, F.vflip)
                 if target_is_image:
                     for ii in range(len(target)):
                         target[ii] = F.vflip(target[ii])
 
-        return (sample, mask, segment), target
+        return (sample, _fit_constant(mask, sample), _fit_constant(segment, sample)), target
+
+    def apply_fused(self, source, target):
+        '''Applies the same random transformations as apply, but composes rotation, resized crop
+        and flips into one affine matrix and resamples each image only once (bilinear for the
+        sample, nearest for mask, segmentation and target images). The warp does not low-pass filter,
+        so strong downscaling should be combined with reduced decoding in the dataset.
+        '''
+        target_is_image = isinstance(target[0], Image.Image)
+        sample, mask, segment = source
+
+        if self.color_jitter is not None:
+            trans = self.color_jitter.get_params(self.color_jitter.brightness, self.color_jitter.contrast,
+                                                 self.color_jitter.saturation, self.color_jitter.hue)
+            sample = trans(sample)
+
+        # matrix maps output pixel coordinates to input coordinates
+        size = sample.size
+        matrix = np.eye(3)
+        if self.rotation is not None:
+            angle = self.rotation.get_params(self.rotation.degrees)
+            matrix = _rotation_matrix(angle, size, self.rotation.center)
+
+        if self.random_resize_crop is not None:
+            i, j, h, w = self.random_resize_crop.get_params(sample, self.random_resize_crop.scale,
+                                                            self.random_resize_crop.ratio)
+            out_h, out_w = self.random_resize_crop.size
+            matrix = matrix @ np.array([[w / out_w, 0, j], [0, h / out_h, i], [0, 0, 1]])
+            size = (out_w, out_h)
+
+        if self.hflip is not None:
+            if random.random() < self.hflip:
+                matrix = matrix @ np.array([[-1, 0, size[0]], [0, 1, 0], [0, 0, 1]])
+
+        if self.vflip is not None:
+            if random.random() < self.vflip:
+                matrix = matrix @ np.array([[1, 0, 0], [0, -1, size[1]], [0, 0, 1]])
+
+        if size == sample.size and np.allclose(matrix, np.eye(3)):
+            return (sample, mask, segment), target
+
+        data = tuple(matrix[:2, :].flatten())
+        sample = sample.transform(size, Image.AFFINE, data, Image.BILINEAR)
+        mask = _transform_label(mask, Image.Image.transform, size, Image.AFFINE, data, Image.NEAREST)
+        segment = _transform_label(segment, Image.Image.transform, size, Image.AFFINE, data, Image.NEAREST)
+        if target_is_image:
+            for ii in range(len(target)):
+                target[ii] = target[ii].transform(size, Image.AFFINE, data, Image.NEAREST)
+
+        return (sample, _fit_constant(mask, sample), _fit_constant(segment, sample)), target
+
+    def get_minimum_size(self):
+        '''Smallest (height, width) of the source image that keeps the full resolution
+        in the random resized crop, i.e. the smallest crop is not upsampled.
+
+        Returns:
+            tuple -- (height, width) or None if the augmentation does not resize
+        '''
+        if self.random_resize_crop is None:
+            return None
+        size_h, size_w = self.random_resize_crop.size
+        scale = min(min(self.random_resize_crop.scale), 1.0)
+        ratio_min, ratio_max = min(self.random_resize_crop.ratio), max(self.random_resize_crop.ratio)
+        # crop height is sqrt(area / ratio), crop width sqrt(area * ratio)
+        height = size_h * np.sqrt(ratio_max / scale)
+        width = size_w * np.sqrt(1 / (ratio_min * scale))
+        return int(np.ceil(height)), int(np.ceil(width))
 
     def __str__(self):
         return 'Augmentation:\n' + str(self.get_transform())
@@ -127,6 +267,278 @@ class DataAugmentation():
         return self.get_transform()
 
 
+def _rgb_to_hsv(img):
+    r, g, b = img.unbind(dim=1)
+    maxc, _ = img.max(dim=1)
+    minc, _ = img.min(dim=1)
+    delta = maxc - minc
+    s = delta / torch.where(maxc > 0, maxc, torch.ones_like(maxc))
+    delta_div = torch.where(delta > 0, delta, torch.ones_like(delta))
+    rc = (maxc - r) / delta_div
+    gc = (maxc - g) / delta_div
+    bc = (maxc - b) / delta_div
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.fmod(h / 6.0 + 1.0, 1.0)
+    h = torch.where(delta > 0, h, torch.zeros_like(h))
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(img):
+    h, s, v = img.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    r = torch.stack((v, q, p, p, t, v), dim=1).gather(1, i.unsqueeze(1))
+    g = torch.stack((t, v, v, q, p, p), dim=1).gather(1, i.unsqueeze(1))
+    b = torch.stack((p, p, t, v, v, q), dim=1).gather(1, i.unsqueeze(1))
+    return torch.cat((r, g, b), dim=1)
+
+
+def _grayscale(img):
+    return (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+
+
+class BatchAugmentation(DataAugmentation):
+    '''Tensor version of DataAugmentation that is applied on the collated NCHW batch (e.g. on the
+    training device in Network.train) instead of per sample in the DataLoader workers. Every sample
+    gets its own random parameters, geometric transformations are applied with one warp per
+    batch to sample, mask, segmentation and image targets. Color jitter is applied in the fixed order
+    brightness, contrast, saturation, hue.
+    If mean and std are given the batch is assumed to be normalized and is denormalized for the
+    color jitter and before the warp so that padding stays black.
+    '''
+
+    def __init__(self, mean=None, std=None, **kwargs):
+        super().__init__(**kwargs)
+        self.mean = mean
+        self.std = std
+
+    @staticmethod
+    def _uniform(bounds, n, device):
+        low, high = bounds
+        return torch.rand(n, device=device) * (high - low) + low
+
+    def _color_jitter(self, sample):
+        n = sample.shape[0]
+        view = (n, 1, 1, 1)
+        jitter = self.color_jitter
+        if jitter.brightness is not None:
+            factor = self._uniform(jitter.brightness, n, sample.device).view(view)
+            sample = (sample * factor).clamp(0, 1)
+        if jitter.contrast is not None:
+            factor = self._uniform(jitter.contrast, n, sample.device).view(view)
+            mean = _grayscale(sample).mean(dim=(1, 2, 3), keepdim=True)
+            sample = (factor * sample + (1 - factor) * mean).clamp(0, 1)
+        if jitter.saturation is not None:
+            factor = self._uniform(jitter.saturation, n, sample.device).view(view)
+            sample = (factor * sample + (1 - factor) * _grayscale(sample)).clamp(0, 1)
+        if jitter.hue is not None:
+            factor = self._uniform(jitter.hue, n, sample.device).view(n, 1, 1)
+            hsv = _rgb_to_hsv(sample)
+            hsv[:, 0] = torch.fmod(hsv[:, 0] + factor + 1.0, 1.0)
+            sample = _hsv_to_rgb(hsv)
+        return sample
+
+    def _crop_params(self, n, height, width, device):
+        # vectorized version of RandomResizedCrop.get_params with 10 attempts per sample
+        area = height * width
+        scale = torch.tensor(self.random_resize_crop.scale, dtype=torch.float, device=device)
+        log_ratio = torch.log(torch.tensor(self.random_resize_crop.ratio, dtype=torch.float, device=device))
+        target_area = area * (torch.rand((n, 10), device=device) * (scale[1] - scale[0]) + scale[0])
+        aspect_ratio = torch.exp(torch.rand((n, 10), device=device) * (log_ratio[1] - log_ratio[0]) + log_ratio[0])
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = valid.float().argmax(dim=1, keepdim=True)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+
+        # fallback to central crop
+        in_ratio = width / height
+        ratio = torch.exp(log_ratio)
+        if in_ratio < ratio.min():
+            fallback = (round(width / ratio.min().item()), width)
+        elif in_ratio > ratio.max():
+            fallback = (height, round(height * ratio.max().item()))
+        else:
+            fallback = (height, width)
+        found = valid.any(dim=1)
+        h = torch.where(found, h, torch.full_like(h, fallback[0]))
+        w = torch.where(found, w, torch.full_like(w, fallback[1]))
+
+        i = torch.where(found, torch.floor(torch.rand(n, device=device) * (height - h + 1)), (height - h) / 2)
+        j = torch.where(found, torch.floor(torch.rand(n, device=device) * (width - w + 1)), (width - w) / 2)
+        return torch.floor(i), torch.floor(j), h, w
+
+    def _affine_grid(self, n, height, width, device):
+        # per sample matrix that maps output to input pixel coordinates, see DataAugmentation.apply_fused
+        matrix = torch.eye(3, device=device).repeat(n, 1, 1)
+        out_h, out_w = height, width
+
+        if self.rotation is not None:
+            theta = -torch.deg2rad(self._uniform(self.rotation.degrees, n, device))
+            cos, sin = torch.cos(theta), torch.sin(theta)
+            if self.rotation.center is None:
+                cx, cy = width / 2.0, height / 2.0
+            else:
+                cx, cy = self.rotation.center
+            matrix[:, 0, 0] = cos
+            matrix[:, 0, 1] = sin
+            matrix[:, 0, 2] = cx - cos * cx - sin * cy
+            matrix[:, 1, 0] = -sin
+            matrix[:, 1, 1] = cos
+            matrix[:, 1, 2] = cy + sin * cx - cos * cy
+
+        if self.random_resize_crop is not None:
+            i, j, h, w = self._crop_params(n, height, width, device)
+            out_h, out_w = self.random_resize_crop.size
+            crop = torch.eye(3, device=device).repeat(n, 1, 1)
+            crop[:, 0, 0] = w / out_w
+            crop[:, 0, 2] = j
+            crop[:, 1, 1] = h / out_h
+            crop[:, 1, 2] = i
+            matrix = matrix @ crop
+
+        if self.hflip is not None:
+            flip = torch.rand(n, device=device) < self.hflip
+            flip_matrix = torch.eye(3, device=device).repeat(n, 1, 1)
+            flip_matrix[flip, 0, 0] = -1
+            flip_matrix[flip, 0, 2] = out_w
+            matrix = matrix @ flip_matrix
+
+        if self.vflip is not None:
+            flip = torch.rand(n, device=device) < self.vflip
+            flip_matrix = torch.eye(3, device=device).repeat(n, 1, 1)
+            flip_matrix[flip, 1, 1] = -1
+            flip_matrix[flip, 1, 2] = out_h
+            matrix = matrix @ flip_matrix
+
+        # convert pixel coordinates to the normalized coordinates of grid_sample (align_corners=False)
+        to_input = torch.tensor([[2 / width, 0, -1], [0, 2 / height, -1], [0, 0, 1]], device=device)
+        from_output = torch.tensor([[out_w / 2, 0, out_w / 2], [0, out_h / 2, out_h / 2], [0, 0, 1]], device=device)
+        theta = (to_input @ matrix @ from_output)[:, :2, :]
+        return torch.nn.functional.affine_grid(theta, (n, 1, out_h, out_w), align_corners=False)
+
+    def apply(self, source, target):
+        '''Augments a collated batch
+
+        Arguments:
+            source {list} -- list of NCHW tensors (sample, mask, segmentation) or a single sample tensor
+            target {torch.Tensor} -- NC labels or NCHW image targets
+
+        Returns:
+            tuple -- (source, target) in the same format as the input
+        '''
+        single = isinstance(source, torch.Tensor)
+        if single:
+            source = [source]
+        sample, *labels = source
+        target_is_image = target.dim() == 4
+        n, _, height, width = sample.shape
+        device = sample.device
+
+        if self.mean is not None and self.std is not None:
+            mean = torch.tensor(self.mean, dtype=sample.dtype, device=device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, dtype=sample.dtype, device=device).view(1, -1, 1, 1)
+            sample = sample * std + mean
+
+        if self.color_jitter is not None:
+            sample = self._color_jitter(sample)
+
+        if any(t is not None for t in (self.rotation, self.random_resize_crop, self.hflip, self.vflip)):
+            grid = self._affine_grid(n, height, width, device)
+            sample = torch.nn.functional.grid_sample(sample, grid, mode='bilinear', align_corners=False)
+            labels = [
+                torch.nn.functional.grid_sample(l.float(), grid, mode='nearest', align_corners=False).to(l.dtype)
+                if l is not None else None for l in labels
+            ]
+            if target_is_image:
+                target = torch.nn.functional.grid_sample(target.float(), grid, mode='nearest',
+                                                         align_corners=False).to(target.dtype)
+
+        if self.mean is not None and self.std is not None:
+            sample = (sample - mean) / std
+
+        if single:
+            return sample, target
+        return [sample, *labels], target
+
+    def __str__(self):
+        return 'Batch augmentation:\n' + str(self.get_transform())
+
+
+def to_normalized_tensor(img, mean=None, std=None):
+    '''Converts a PIL image, HWC numpy array or CHW tensor to a float CHW tensor. uint8 data
+    is scaled to [0, 1] and normalized in the same pass that converts to float, numpy arrays and
+    tensors are only viewed, not copied, before that conversion. Other data types are not scaled and
+    floating point input without normalization is returned as is.
+
+    Arguments:
+        img {PIL.Image, numpy.ndarray, torch.Tensor} -- input image
+
+    Keyword Arguments:
+        mean {sequence} -- channel means for normalization (default: {None})
+        std {sequence} -- channel standard deviations for normalization (default: {None})
+
+    Returns:
+        torch.Tensor -- CHW float tensor
+    '''
+    if isinstance(img, Image.Image):
+        pil_img = img
+        # PIL exports a read-only buffer, np.array takes the one unavoidable copy into writable memory
+        img = np.array(pil_img)
+        if img.dtype != np.uint8:
+            img = F.to_tensor(pil_img)
+    if isinstance(img, np.ndarray):
+        if img.ndim == 2:
+            img = img[:, :, None]
+        img = torch.from_numpy(img).permute(2, 0, 1)
+
+    scale = 1 / 255 if img.dtype == torch.uint8 else 1.0
+    if (mean is None or std is None) and img.is_floating_point():
+        return img
+    # single contiguous float output, written by the scaling multiplication
+    res = torch.empty(img.shape, dtype=torch.float, device=img.device)
+    if mean is None or std is None:
+        return torch.mul(img, scale, out=res)
+    mean = torch.as_tensor(mean, dtype=torch.float, device=img.device).view(-1, 1, 1)
+    std = torch.as_tensor(std, dtype=torch.float, device=img.device).view(-1, 1, 1)
+    torch.mul(img, scale / std, out=res)
+    return res.sub_(mean / std)
+
+
+class PreparationTransform():
+    '''Callable version of DataPreparation.get_transform() that accepts PIL images, HWC numpy
+    arrays and CHW tensors and converts and normalizes with to_normalized_tensor.
+    '''
+
+    def __init__(self, size=None, crop=None, mean=None, std=None, description=''):
+        self.size = size
+        self.crop = crop
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float)
+        self.description = description
+
+    def __call__(self, img):
+        if isinstance(img, np.ndarray):
+            img = torch.from_numpy(img if img.ndim == 3 else img[:, :, None]).permute(2, 0, 1)
+        if self.size is not None:
+            # bilinear is the default interpolation for PIL images and tensors
+            img = F.resize(img, self.size)
+        if self.crop is not None:
+            img = F.center_crop(img, self.crop)
+        return to_normalized_tensor(img, self.mean, self.std)
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return self.description
+
+
 class DataPreparation():
 
     def __init__(self, size=None, mean=None, std=None, crop=None):
@@ -135,6 +547,7 @@ class DataPreparation():
         self.size = size
         self.crop = crop
         self.convert = transforms.ToTensor()
+        self._compiled = dict()
 
     def apply(self, source, target):
         sample, mask, segment = source
@@ -142,58 +555,214 @@ class DataPreparation():
 
         if self.size is not None:
             sample = F.resize(sample, self.size, interpolation=Image.BILINEAR)
-            if mask is not None:
-                mask = F.resize(mask, self.size, interpolation=Image.NEAREST)
-            if segment is not None:
-                segment = F.resize(segment, self.size, interpolation=Image.NEAREST)
+            mask = _transform_label(mask, F.resize, self.size, Image.NEAREST)
+            segment = _transform_label(segment, F.resize, self.size, Image.NEAREST)
             if target_is_image:
                 for ii in range(len(target)):
                     target[ii] = F.resize(target[ii], self.size, interpolation=Image.NEAREST)
 
         if self.crop is not None:
             sample = F.center_crop(sample, self.crop)
-            if mask is not None:
-                mask = F.center_crop(mask, self.crop)
-            if segment is not None:
-                segment = F.center_crop(segment, self.crop)
+            mask = _transform_label(mask, F.center_crop, self.crop)
+            segment = _transform_label(segment, F.center_crop, self.crop)
             if target_is_image:
                 for ii in range(len(target)):
                     target[ii] = F.center_crop(target[ii], self.crop)
 
-        sample = self.convert(sample)
-        if mask is not None:
-            mask = self.convert(mask)
-        if segment is not None:
-            segment = self.convert(segment)
+        mask = _fit_constant(mask, sample)
+        segment = _fit_constant(segment, sample)
+
+        # conversion and normalization in one pass
+        sample = to_normalized_tensor(sample, self.mean, self.std)
+        mask = self._convert_label(mask)
+        segment = self._convert_label(segment)
         if target_is_image:
             for ii in range(len(target)):
                 target[ii] = self.convert(target[ii])
             target = torch.cat(target, dim=0)
 
-        if self.mean is not None and self.std is not None:
-            sample = transforms.functional.normalize(sample, self.mean, self.std)
-
         return (sample, mask, segment), target
 
+    def _convert_label(self, img):
+        if img is None:
+            return None
+        if isinstance(img, ConstantChannel):
+            return img.to_tensor()
+        return self.convert(img)
+
+    def get_minimum_size(self):
+        '''Smallest (height, width) of the input image that is not upsampled by the resize.
+
+        Returns:
+            tuple -- (height, width) or None if the preparation does not resize
+        '''
+        if self.size is None:
+            return None
+        if isinstance(self.size, (tuple, list)):
+            return tuple(self.size)
+        return (self.size, self.size)
+
+    def _get_compiled(self):
+        # composed transforms are cached until one of the parameters changes
+        key = repr((self.size, self.crop, self.mean, self.std))
+        if self._compiled.get('key') != key:
+            trans = []
+            if self.size is not None:
+                trans.append(transforms.Resize(self.size))
+            if self.crop is not None:
+                trans.append(transforms.CenterCrop(self.crop))
+            trans.append(self.convert)
+            if self.mean is not None and self.std is not None:
+                trans.append(transforms.Normalize(self.mean, self.std))
+            compose = transforms.Compose(trans)
+            self._compiled = {
+                'key': key,
+                'compose': compose,
+                'transform': PreparationTransform(self.size, self.crop, self.mean, self.std, str(compose)),
+            }
+        return self._compiled
+
     def get_transform(self):
-        trans = []
-        if self.size is not None:
-            trans.append(transforms.Resize(self.size))
-        if self.crop is not None:
-            trans.append(transforms.CenterCrop(self.crop))
-        trans.append(self.convert)
-        if self.mean is not None and self.std is not None:
-            trans.append(transforms.Normalize(self.mean, self.std))
-        return transforms.Compose(trans)
+        return self._get_compiled()['compose']
 
     @property
     def transform(self):
-        return self.get_transform()
+        return self._get_compiled()['transform']
 
     def __str__(self):
         return 'Preparation:\n' + str(self.get_transform())
 
 
+def split_target_bands(target):
+    '''Splits a target image into a list of single channel images. Empty bands are
+    skipped and if more than one band remains a background channel is prepended.
+
+    Arguments:
+        target {PIL.Image.Image} -- target image with one or more bands
+
+    Returns:
+        list -- list of single channel PIL images
+    '''
+    if len(target.getbands()) == 1:
+        return [target]
+    targets = []
+    for band in target.getbands():
+        channel = target.getchannel(band)
+        if channel.histogram()[0] == np.prod(channel.size):
+            continue
+        targets.append(channel)
+    if len(targets) > 1:
+        bg_mask = np.array(targets[0])
+        for t in targets[1:]:
+            bg_mask = np.clip(bg_mask + np.array(t), 0, 255)
+        bg_mask = 255 - bg_mask
+        bg_mask = Image.fromarray(bg_mask)
+        return [bg_mask, *targets]
+    return targets
+
+
+TARGET_INDEX = 'target_index.csv'
+
+
+def label_map_from_bands(target):
+    '''Composites a multi-band target image into a single uint8 class index image, 0 for background
+    and k for the k-th non-empty band. This is only lossless if all bands are binary (0 or 255)
+    and do not overlap, otherwise None is returned.
+
+    Arguments:
+        target {PIL.Image.Image} -- target image with more than one band
+
+    Returns:
+        tuple -- (label map as PIL image, number of non-empty bands) or None
+    '''
+    bands = np.asarray(target)
+    if bands.ndim != 3:
+        return None
+    bands = bands[:, :, bands.reshape(-1, bands.shape[2]).any(axis=0)]
+    channels = bands.shape[2]
+    if channels == 0 or not np.isin(bands, (0, 255)).all() or (bands.sum(axis=2, dtype=np.int64) > 255).any():
+        return None
+    label_map = np.zeros(bands.shape[:2], dtype=np.uint8)
+    for ii in range(channels):
+        label_map[bands[:, :, ii] == 255] = ii + 1
+    return Image.fromarray(label_map), channels
+
+
+def bands_from_label_map(label_map, channels):
+    '''Inverse of label_map_from_bands, returns the same list of channels as split_target_bands
+    for the original target image.
+    '''
+    targets = [label_map.point([255 if v == ii + 1 else 0 for v in range(256)]) for ii in range(channels)]
+    if channels > 1:
+        background = label_map.point([255 if v == 0 else 0 for v in range(256)])
+        return [background, *targets]
+    return targets
+
+
+def load_target_index(directory):
+    '''Loads an index written by factory.create_target_index
+
+    Arguments:
+        directory {str} -- index directory
+
+    Returns:
+        dict -- target filename -> (label map filename, number of channels)
+    '''
+    directory = pathlib.Path(directory)
+    df = pd.read_csv(str(directory / TARGET_INDEX), index_col=0)
+    df = df[df['channels'] > 0]
+    return {t: (str(directory / m), int(c)) for t, m, c in zip(df.index, df['label_map'], df['channels'])}
+
+
+def load_retina_index(filename):
+    '''Loads the retina circles written by factory.create_retina_index.
+
+    Arguments:
+        filename {str} -- csv file of the retina index
+
+    Returns:
+        dict -- sample filename -> (x, y, radius, height, width) in pixels of the original image
+    '''
+    df = pd.read_csv(str(filename), index_col=0).dropna()
+    values = df[['x', 'y', 'radius', 'height', 'width']].values.astype(np.int64)
+    return {str(f): tuple(int(v) for v in row) for f, row in zip(df.index, values)}
+
+
+def crop_to_retina(source, target, circle, retina_mask=False):
+    '''Crops all images of a sample to the square around the retina circle. The circle is
+    given for the original image size and scaled to the (possibly drafted) sample.
+
+    Arguments:
+        source {tuple} -- (sample, mask, segment)
+        target {list} -- target bands or class labels
+        circle {tuple} -- (x, y, radius, height, width) from load_retina_index
+
+    Keyword Arguments:
+        retina_mask {bool} -- replace an absent mask with the retina circle (default: {False})
+
+    Returns:
+        tuple -- cropped source, target
+    '''
+    sample, mask, segment = source
+    x, y, radius, height, width = circle
+    scale_x, scale_y = sample.width / width, sample.height / height
+    left, top = (x - radius) * scale_x, (y - radius) * scale_y
+    right, bottom = (x + radius) * scale_x, (y + radius) * scale_y
+
+    if retina_mask and isinstance(mask, ConstantChannel):
+        mask = Image.new('L', sample.size, 0)
+        ImageDraw.Draw(mask).ellipse((left, top, right - 1, bottom - 1), fill=255)
+
+    box = (max(0, int(round(left))), max(0, int(round(top))), min(sample.width, int(round(right))),
+           min(sample.height, int(round(bottom))))
+    sample = sample.crop(box)
+    mask = _fit_constant(_transform_label(mask, Image.Image.crop, box), sample)
+    segment = _fit_constant(_transform_label(segment, Image.Image.crop, box), sample)
+    if isinstance(target, list):
+        target = [t.crop(box) for t in target]
+    return (sample, mask, segment), target
+
+
 class TripleDataset(torch.utils.data.Dataset):
 
     def __init__(self,
@@ -204,7 +773,11 @@ class TripleDataset(torch.utils.data.Dataset):
                  target_labels=None,
                  loader=pil_loader,
                  augmentation=None,
-                 preparation=None):
+                 preparation=None,
+                 reduced_decode=False,
+                 target_index=None,
+                 retina_index=None,
+                 retina_mask=False):
 
         super().__init__()
         self.samples = samples
@@ -217,6 +790,10 @@ class TripleDataset(torch.utils.data.Dataset):
 
         self.augmentation = augmentation
         self.preparation = preparation
+        self.reduced_decode = reduced_decode
+        self.target_index = target_index
+        self.retina_index = retina_index
+        self.retina_mask = retina_mask
 
     def __len__(self):
         if self.samples is None:
@@ -227,49 +804,66 @@ class TripleDataset(torch.utils.data.Dataset):
         if index < 0 or index >= self.__len__():
             raise IndexError('Index {0} our of bounds for dataset of length {1}'.format(index, len(self)))
 
+        source, target = self._load(index)
+
+        if self.augmentation is not None:
+            source, target = self.augmentation.apply(source, target)
+
+        if self.preparation is not None:
+            source, target = self.preparation.apply(source, target)
+        else:
+            source = tuple(s.to_image() if isinstance(s, ConstantChannel) else s for s in source)
+
+        return source, target
+
+    @property
+    def decode_size(self):
+        '''Smallest (height, width) the samples can be decoded with before augmentation
+        and preparation, None if the full resolution is required.
+        '''
+        if self.augmentation is not None and self.augmentation.random_resize_crop is not None:
+            return self.augmentation.get_minimum_size()
+        if self.preparation is not None:
+            return self.preparation.get_minimum_size()
+        return None
+
+    def _load_aligned(self, filename, sample):
+        # label images are not drafted and need to match the (possibly reduced) sample size
+        img = self.loader(filename)
+        if self.reduced_decode and img.size != sample.size:
+            img = img.resize(sample.size, Image.NEAREST)
+        return img
+
+    def _load(self, index):
         # get all frames for index
-        sample = self.loader(self.samples[index])
+        if self.reduced_decode:
+            # the loader drafts before decoding, e.g. SharedImageCache caches the reduced image
+            sample = self.loader(self.samples[index], draft=self.decode_size)
+        else:
+            sample = self.loader(self.samples[index])
         if self.masks is None or not isinstance(self.masks[index], str):
-            mask = Image.fromarray(np.ones((sample.height, sample.width), dtype=np.uint8) * 255)
+            mask = ConstantChannel(255, sample.size)
         else:
-            mask = self.loader(self.masks[index]).convert('L')
+            mask = self._load_aligned(self.masks[index], sample).convert('L')
         if self.segmentations is None or not isinstance(self.segmentations[index], str):
-            segment = Image.fromarray(np.zeros((sample.height, sample.width), dtype=np.uint8))
+            segment = ConstantChannel(0, sample.size)
         else:
-            segment = self.loader(self.segmentations[index]).convert('L')
+            segment = self._load_aligned(self.segmentations[index], sample).convert('L')
         target = self.targets[index]
 
         # special treatment if target is class labels vs. filename
         if isinstance(target, (str, pathlib.Path)):
-            target = self.loader(target)
-            if len(target.getbands()) > 1:
-                targets = []
-                for band in target.getbands():
-                    channel = target.getchannel(band)
-                    if channel.histogram()[0] == np.prod(channel.size):
-                        continue
-                    targets.append(channel)
-                if len(targets) > 1:
-                    bg_mask = np.array(targets[0])
-                    for t in targets[1:]:
-                        bg_mask = np.clip(bg_mask + np.array(t), 0, 255)
-                    bg_mask = 255 - bg_mask
-                    bg_mask = Image.fromarray(bg_mask)
-                    target = [bg_mask, *targets]
-                else:
-                    target = targets
+            if self.target_index is not None and str(target) in self.target_index:
+                label_map, channels = self.target_index[str(target)]
+                target = bands_from_label_map(self._load_aligned(label_map, sample), channels)
             else:
-                target = [target]
-
-        source = (sample, mask, segment)
-
-        if self.augmentation is not None:
-            source, target = self.augmentation.apply(source, target)
-
-        if self.preparation is not None:
-            source, target = self.preparation.apply(source, target)
+                target = split_target_bands(self._load_aligned(target, sample))
 
-        return source, target
+        # crop black borders before augmentation, the drafted sample needs less decoding
+        if self.retina_index is not None and str(self.samples[index]) in self.retina_index:
+            return crop_to_retina((sample, mask, segment), target, self.retina_index[str(self.samples[index])],
+                                  self.retina_mask)
+        return (sample, mask, segment), target
 
     def __str__(self):
         res = f'''Dataset:
@@ -284,3 +878,547 @@ class TripleDataset(torch.utils.data.Dataset):
     @property
     def size(self):
         return len(self)
+
+
+class ShardDataset(TripleDataset):
+    '''Dataset reading preprocessed samples from memory-mapped shards as written by
+    factory.create_shards. Returns the same (source, target) tuples as TripleDataset.
+    '''
+
+    def __init__(self, directory, augmentation=None, preparation=None):
+        self.directory = pathlib.Path(directory)
+        with open(str(self.directory / SHARD_INDEX), 'r') as f:
+            self.index = yaml.safe_load(f)
+        self.offsets = np.load(str(self.directory / 'offsets.npy'))
+
+        if self.index['target_type'] == 'labels':
+            targets = np.load(str(self.directory / 'labels.npy'))
+        else:
+            targets = np.load(str(self.directory / 'targets.npy'))
+
+        super().__init__(samples=np.load(str(self.directory / 'samples.npy')),
+                         targets=targets,
+                         target_labels=self.index['target_labels'],
+                         loader=None,
+                         augmentation=augmentation,
+                         preparation=preparation)
+        self._shards = dict()
+
+    def __getstate__(self):
+        # memory maps are opened again in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_shards'] = dict()
+        return state
+
+    def _get_shard(self, shard):
+        if shard not in self._shards:
+            shard_dir = self.directory / self.index['shards'][shard]
+            arrays = dict()
+            for name in ('sample', 'mask', 'segmentation', 'target'):
+                filename = shard_dir / (name + '.npy')
+                if filename.exists():
+                    arrays[name] = np.load(str(filename), mmap_mode='r')
+            self._shards[shard] = arrays
+        return self._shards[shard]
+
+    def _load(self, index):
+        shard, offset = self.offsets[index]
+        arrays = self._get_shard(shard)
+
+        sample = Image.fromarray(np.array(arrays['sample'][offset]))
+        if 'mask' in arrays:
+            mask = Image.fromarray(np.array(arrays['mask'][offset]))
+        else:
+            mask = ConstantChannel(255, sample.size)
+        if 'segmentation' in arrays:
+            segment = Image.fromarray(np.array(arrays['segmentation'][offset]))
+        else:
+            segment = ConstantChannel(0, sample.size)
+
+        if self.index['target_type'] == 'labels':
+            target = self.targets[index]
+        else:
+            target = Image.fromarray(np.array(arrays['target'][offset]))
+            target = split_target_bands(target)
+
+        return (sample, mask, segment), target
+
+    def __str__(self):
+        return 'Shards: {}\n'.format(self.directory) + super().__str__()
+
+
+class PatchDataset(torch.utils.data.Dataset):
+    '''Dataset of random patches for segmentation training, read from memory-mapped shards
+    as written by factory.create_shards (with target images, e.g. vessel maps). Foreground
+    pixels of the target are counted with an integral image per entry, so the foreground
+    fraction of any patch is known in O(1). The integral images are written once next to the
+    shards and memory-mapped like the shards. A share of foreground_ratio of the patches is
+    drawn among positions with at least min_foreground foreground pixels, the rest uniformly.
+
+    Every access draws new positions, the index only sets the number of patches per epoch.
+    Batches are drawn vectorized through __getitems__ when used with a DataLoader.
+
+    Arguments:
+        directory {str} -- shard directory, see factory.create_shards
+        patch_size {int} -- edge length of the patches
+        num_patches {int} -- patches per epoch
+
+    Keyword Arguments:
+        foreground_ratio {float} -- share of patches with foreground (default: {0.5})
+        min_foreground {float} -- minimum foreground fraction of those patches (default: {0.05})
+        target_band {int} -- band of multi-band targets holding the foreground (default: {0})
+        label_channels {int} -- 1 for foreground labels, 2 for (background, foreground) (default: {1})
+        mean {tuple} -- per channel mean for normalization (default: {None})
+        std {tuple} -- per channel standard deviation for normalization (default: {None})
+        seed {int} -- seed for the random generator, in DataLoader workers combined with the worker seed that
+            changes every epoch (default: {None})
+    '''
+
+    def __init__(self,
+                 directory,
+                 patch_size,
+                 num_patches,
+                 foreground_ratio=0.5,
+                 min_foreground=0.05,
+                 target_band=0,
+                 label_channels=1,
+                 mean=None,
+                 std=None,
+                 seed=None):
+        super().__init__()
+        self.directory = pathlib.Path(directory)
+        with open(str(self.directory / SHARD_INDEX), 'r') as f:
+            self.index = yaml.safe_load(f)
+        if self.index['target_type'] != 'image':
+            raise ValueError('PatchDataset requires target images, {} has class labels'.format(self.directory))
+        if label_channels not in (1, 2):
+            raise ValueError('label_channels must be 1 or 2, got {}'.format(label_channels))
+        height, width = self.index['size']
+        if patch_size > min(height, width):
+            raise ValueError('Patch size {} exceeds the image size {}'.format(patch_size, (height, width)))
+
+        self.offsets = np.load(str(self.directory / 'offsets.npy'))
+        self.patch_size = patch_size
+        self.num_patches = num_patches
+        self.foreground_ratio = foreground_ratio
+        self.min_foreground = min_foreground
+        self.target_band = target_band
+        self.label_channels = label_channels
+        self.target_labels = ['background', 'foreground'][2 - label_channels:]
+        self.mean = None if mean is None else torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = None if std is None else torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.seed = seed
+        self._rng = None
+        self._rng_worker = None
+        self._arrays = dict()
+
+        self.integral_file = self.directory / 'integral_{}.npy'.format(target_band)
+        self._integral = None
+        if not self.integral_file.exists():
+            self._create_integral()
+
+    def __getstate__(self):
+        # memory maps are opened again in each worker, every worker gets its own generator
+        state = self.__dict__.copy()
+        state['_arrays'] = dict()
+        state['_integral'] = None
+        state['_rng'] = None
+        return state
+
+    def _create_integral(self):
+        # written to a temporary file first, other processes may create the same file
+        height, width = self.index['size']
+        filename = self.integral_file.with_name('{}.{}.npy'.format(self.integral_file.stem, os.getpid()))
+        integral = np.lib.format.open_memmap(str(filename),
+                                             mode='w+',
+                                             dtype=np.int32,
+                                             shape=(len(self.offsets), height + 1, width + 1))
+        integral[:, 0, :] = 0
+        integral[:, :, 0] = 0
+        for ii, (shard, offset) in enumerate(self.offsets):
+            target = self._get_shard(shard)['target']
+            foreground = self._foreground(target[offset], target.ndim == 4)
+            integral[ii, 1:, 1:] = foreground.cumsum(0, dtype=np.int32).cumsum(1, dtype=np.int32)
+        integral.flush()
+        del integral
+        os.replace(str(filename), str(self.integral_file))
+
+    @property
+    def integral(self):
+        '''Memory-mapped N x (H + 1) x (W + 1) integral images of the foreground.'''
+        if self._integral is None:
+            self._integral = np.load(str(self.integral_file), mmap_mode='r')
+        return self._integral
+
+    def __len__(self):
+        return self.num_patches
+
+    def _foreground(self, target, bands):
+        if bands:
+            target = target[..., self.target_band]
+        return target > 127
+
+    def _get_shard(self, shard):
+        if shard not in self._arrays:
+            shard_dir = self.directory / self.index['shards'][shard]
+            self._arrays[shard] = {
+                name: np.load(str(shard_dir / (name + '.npy')), mmap_mode='r') for name in ('sample', 'target')
+            }
+        return self._arrays[shard]
+
+    @property
+    def rng(self):
+        # the worker seed of the DataLoader differs per worker and epoch and follows torch.manual_seed
+        info = torch.utils.data.get_worker_info()
+        worker_seed = None if info is None else info.seed
+        if self._rng is None or self._rng_worker != worker_seed:
+            entropy = [torch.initial_seed() if self.seed is None else self.seed]
+            if worker_seed is not None:
+                entropy.append(worker_seed)
+            self._rng = np.random.default_rng(entropy)
+            self._rng_worker = worker_seed
+        return self._rng
+
+    def foreground_fraction(self, entries, ys, xs):
+        '''Foreground fraction of the patches with top left corners (ys, xs) in the given entries.'''
+        p = self.patch_size
+        integral = self.integral
+        count = (integral[entries, ys + p, xs + p] - integral[entries, ys, xs + p] - integral[entries, ys + p, xs] +
+                 integral[entries, ys, xs])
+        return count / (p * p)
+
+    def sample_positions(self, num):
+        '''Draws num patch positions with the configured foreground ratio.
+
+        Returns:
+            tuple -- arrays of entries, top and left patch coordinates
+        '''
+        rng = self.rng
+        max_y = self.integral.shape[1] - 1 - self.patch_size
+        max_x = self.integral.shape[2] - 1 - self.patch_size
+        num_foreground = rng.binomial(num, self.foreground_ratio)
+
+        entries = rng.integers(len(self.offsets), size=num)
+        ys = rng.integers(max_y, size=num, endpoint=True)
+        xs = rng.integers(max_x, size=num, endpoint=True)
+
+        # rejection sampling of the foreground positions, in vectorized rounds of candidates
+        found = 0
+        for _ in range(100):
+            if found >= num_foreground:
+                break
+            size = 4 * (num_foreground - found)
+            cand = (rng.integers(len(self.offsets), size=size), rng.integers(max_y, size=size, endpoint=True),
+                    rng.integers(max_x, size=size, endpoint=True))
+            accepted = np.flatnonzero(self.foreground_fraction(*cand) >= self.min_foreground)
+            accepted = accepted[:num_foreground - found]
+            for arr, values in zip((entries, ys, xs), cand):
+                arr[found:found + len(accepted)] = values[accepted]
+            found += len(accepted)
+        if found < num_foreground:
+            raise ValueError('Found too few patches with a foreground fraction of at least {}'.format(
+                self.min_foreground))
+        return entries, ys, xs
+
+    def load_patches(self, entries, ys, xs):
+        '''Reads the patches at the given positions.
+
+        Returns:
+            tuple -- NCHW float samples and N x label_channels x H x W float labels
+        '''
+        p = self.patch_size
+        samples = None
+        labels = np.empty((len(entries), p, p), dtype=bool)
+        for shard in np.unique(self.offsets[entries, 0]):
+            select = np.flatnonzero(self.offsets[entries, 0] == shard)
+            arrays = self._get_shard(shard)
+            sample = arrays['sample']
+            if sample.ndim == 3:
+                sample = sample[..., None]
+            window = np.lib.stride_tricks.sliding_window_view(sample, (p, p), axis=(1, 2))
+            bands = arrays['target'].ndim == 4
+            target = np.lib.stride_tricks.sliding_window_view(arrays['target'], (p, p), axis=(1, 2))
+            offsets = self.offsets[entries[select], 1]
+            patches = window[offsets, ys[select], xs[select]]
+            if samples is None:
+                samples = np.empty((len(entries), *patches.shape[1:]), dtype=np.uint8)
+            samples[select] = patches
+            target = target[offsets, ys[select], xs[select]]
+            labels[select] = self._foreground(np.moveaxis(target, 1, -1) if bands else target, bands)
+
+        samples = torch.from_numpy(samples).float().div_(255)
+        if self.mean is not None:
+            samples.sub_(self.mean)
+        if self.std is not None:
+            samples.div_(self.std)
+        labels = torch.from_numpy(labels).unsqueeze(1).float()
+        if self.label_channels == 2:
+            labels = torch.cat((1 - labels, labels), dim=1)
+        return samples, labels
+
+    def __getitems__(self, indices):
+        samples, labels = self.load_patches(*self.sample_positions(len(indices)))
+        return list(zip(samples, labels))
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.__len__():
+            raise IndexError('Index {0} our of bounds for dataset of length {1}'.format(index, len(self)))
+        return self.__getitems__([index])[0]
+
+    def __str__(self):
+        return f'''PatchDataset: {self.directory}
+        Patches: {self.num_patches} of size {self.patch_size}
+        Foreground: ratio {self.foreground_ratio}, minimum fraction {self.min_foreground}
+        '''
+
+
+class _MemberLoader():
+    # loader for TripleDataset that decodes tar members already read into memory
+    def __init__(self, members):
+        self.members = members
+
+    def __call__(self, name, mode=None):
+        return pil_loader(io.BytesIO(self.members[name]), mode)
+
+
+class TarDataset(torch.utils.data.IterableDataset):
+    '''Streaming dataset reading samples sequentially from tar shards instead of opening
+    every file separately. The manifest lists the member names in the columns used by
+    factory.load_csv (with an empty root). The members of an entry have to be stored
+    consecutively with the sample first, as written by factory.create_tar_shards.
+    Entries are returned as (source, target) tuples like TripleDataset, each entry once
+    per epoch.
+
+    Shards are split between the DataLoader workers. With shuffle the shard order is
+    permuted each epoch and entries are shuffled within a buffer of shuffle_buffer
+    entries (still encoded) per worker.
+
+    Arguments:
+        shards {list} -- tar files or glob pattern
+
+    Keyword Arguments:
+        samples, masks, segmentations, targets, target_labels -- manifest as returned by factory.load_csv
+        augmentation {DataAugmentation} -- (default: {None})
+        preparation {DataPreparation} -- (default: {None})
+        shuffle {bool} -- shuffle shards and entries (default: {True})
+        shuffle_buffer {int} -- number of entries buffered for shuffling (default: {1000})
+    '''
+
+    def __init__(self,
+                 shards,
+                 samples=None,
+                 segmentations=None,
+                 masks=None,
+                 targets=None,
+                 target_labels=None,
+                 augmentation=None,
+                 preparation=None,
+                 shuffle=True,
+                 shuffle_buffer=1000):
+        super().__init__()
+        if isinstance(shards, (str, pathlib.Path)):
+            shards = sorted(glob.glob(str(shards)))
+        self.shards = [str(s) for s in shards]
+        if len(self.shards) == 0:
+            raise ValueError('No tar shards given')
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+
+        samples = np.array([os.path.normpath(s) for s in samples])
+        if masks is not None:
+            masks = np.array([os.path.normpath(m) if isinstance(m, str) else m for m in masks], dtype=object)
+        if segmentations is not None:
+            segmentations = np.array([os.path.normpath(s) if isinstance(s, str) else s for s in segmentations],
+                                     dtype=object)
+        if targets.ndim == 1 and isinstance(targets[0], str):
+            targets = np.array([os.path.normpath(t) for t in targets], dtype=object)
+        self.dataset = TripleDataset(samples=samples,
+                                     masks=masks,
+                                     segmentations=segmentations,
+                                     targets=targets,
+                                     target_labels=target_labels,
+                                     loader=None,
+                                     augmentation=augmentation,
+                                     preparation=preparation)
+
+        # member name -> indices of the entries using it, and the distinct members of each entry
+        self._samples = {name: ii for ii, name in enumerate(samples)}
+        self._members = dict()
+        self._required = []
+        for ii in range(len(samples)):
+            names = {samples[ii]}
+            for column in (masks, segmentations, self.dataset.targets):
+                if column is not None and column.ndim == 1 and isinstance(column[ii], str):
+                    names.add(column[ii])
+            for name in names:
+                self._members.setdefault(name, []).append(ii)
+            self._required.append(len(names))
+
+    @property
+    def augmentation(self):
+        return self.dataset.augmentation
+
+    @augmentation.setter
+    def augmentation(self, augmentation):
+        self.dataset.augmentation = augmentation
+
+    @property
+    def preparation(self):
+        return self.dataset.preparation
+
+    @preparation.setter
+    def preparation(self, preparation):
+        self.dataset.preparation = preparation
+
+    @property
+    def targets(self):
+        return self.dataset.targets
+
+    @property
+    def target_labels(self):
+        return self.dataset.target_labels
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _worker_shards(self):
+        worker = torch.utils.data.get_worker_info()
+        if worker is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            worker_id, num_workers, worker_seed = 0, 1, seed
+        else:
+            # all workers of an epoch share the base seed, so they agree on the shard order
+            seed = worker.seed - worker.id
+            worker_id, num_workers, worker_seed = worker.id, worker.num_workers, worker.seed
+
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(seed).shuffle(shards)
+        return shards[worker_id::num_workers], random.Random(worker_seed)
+
+    def _read_shard(self, shard):
+        # yields (index, members) for every complete entry of the shard
+        pending = dict()
+        with tarfile.open(shard, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = os.path.normpath(member.name)
+                if name not in self._members:
+                    continue
+                data = tar.extractfile(member).read()
+                if name in self._samples:
+                    pending[self._samples[name]] = dict()
+                for index in self._members[name]:
+                    if index not in pending or name in pending[index]:
+                        continue
+                    pending[index][name] = data
+                    if len(pending[index]) == self._required[index]:
+                        yield index, pending.pop(index)
+
+    def _shuffled(self, entries, rng):
+        buffer = []
+        for entry in entries:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(entry)
+                continue
+            ii = rng.randrange(len(buffer))
+            yield buffer[ii]
+            buffer[ii] = entry
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _entries(self, shards):
+        for shard in shards:
+            yield from self._read_shard(shard)
+
+    def __iter__(self):
+        shards, rng = self._worker_shards()
+        entries = self._entries(shards)
+        if self.shuffle and self.shuffle_buffer > 0:
+            entries = self._shuffled(entries, rng)
+        for index, members in entries:
+            self.dataset.loader = _MemberLoader(members)
+            yield self.dataset[index]
+
+    def __str__(self):
+        return 'Tar shards: {}\n'.format(len(self.shards)) + str(self.dataset)
+
+
+def _is_constant(channel):
+    # tensors created by ConstantChannel.to_tensor() have zero strides in all expanded dimensions
+    def broadcast(t):
+        return isinstance(t, torch.Tensor) and t.dim() > 0 and all(
+            stride == 0 or size == 1 for stride, size in zip(t.stride(), t.shape))
+
+    if not all(broadcast(t) for t in channel):
+        return False
+    return len({(tuple(t.shape), t.reshape(-1)[0].item()) for t in channel}) == 1
+
+
+class TripleCollate():
+    '''collate_fn for DataLoaders of TripleDataset. Absent mask and segmentation channels are
+    not stacked but broadcast as one plane over the batch, or passed as None if omit_constant
+    is set (only for models whose forward ignores or accepts None for them).
+
+    Keyword Arguments:
+        omit_constant {bool} -- replace constant channels with None (default: {False})
+    '''
+
+    def __init__(self, omit_constant=False):
+        self.omit_constant = omit_constant
+
+    def __call__(self, batch):
+        sources, targets = zip(*batch)
+        target = default_collate(targets)
+        if not isinstance(sources[0], (tuple, list)):
+            return default_collate(sources), target
+
+        source = []
+        for channel in zip(*sources):
+            if _is_constant(channel):
+                if self.omit_constant:
+                    source.append(None)
+                else:
+                    source.append(channel[0].unsqueeze(0).expand(len(channel), *channel[0].shape))
+            else:
+                source.append(default_collate(channel))
+        return source, target
+
+
+class PaddingCollate(TripleCollate):
+    '''collate_fn for batches of images with different sizes, e.g. from a
+    samplers.BucketBatchSampler. All image tensors of a batch are zero padded at the bottom
+    and right to the largest height and width in the batch (rounded up to a multiple of
+    multiple), so padded pixels are also outside the mask. Batches of equal size are
+    collated like TripleCollate.
+
+    Keyword Arguments:
+        multiple {int} -- padded height and width are multiples of this, e.g. for the downsampling of u_net (default: {1})
+        omit_constant {bool} -- replace constant channels with None (default: {False})
+    '''
+
+    def __init__(self, multiple=1, omit_constant=False):
+        super().__init__(omit_constant=omit_constant)
+        self.multiple = multiple
+
+    def _pad(self, tensors):
+        if not isinstance(tensors[0], torch.Tensor) or tensors[0].dim() < 2:
+            return tensors
+        height = max(t.shape[-2] for t in tensors)
+        width = max(t.shape[-1] for t in tensors)
+        height = -(-height // self.multiple) * self.multiple
+        width = -(-width // self.multiple) * self.multiple
+        return [
+            t if t.shape[-2:] == (height, width) else torch.nn.functional.pad(
+                t, (0, width - t.shape[-1], 0, height - t.shape[-2])) for t in tensors
+        ]
+
+    def __call__(self, batch):
+        sources, targets = zip(*batch)
+        targets = self._pad(targets)
+        if isinstance(sources[0], (tuple, list)):
+            sources = zip(*[self._pad(channel) for channel in zip(*sources)])
+        else:
+            sources = self._pad(sources)
+        return super().__call__(list(zip(sources, targets)))
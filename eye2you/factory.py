@@ -1,17 +1,28 @@
 import ast
 import copy
+import hashlib
 import inspect
+import multiprocessing
 import os
+import pathlib
+import platform
+import shutil
+import tarfile
+import time
 
 import numpy as np
 import pandas as pd
 import torch
 import torchvision
 import yaml
+from PIL import Image
 from sklearn.model_selection import ShuffleSplit, StratifiedShuffleSplit
 
 from . import datasets
 from . import meter_functions as mf
+from . import samplers
+from .helper_functions import find_retina_boxes, pil_loader
+from .image_cache import SharedImageCache
 
 METER_FUNCTIONS = dict(inspect.getmembers(mf, inspect.isclass))
 # TRANSFORM_FUNCTIONS = dict(inspect.getmembers(torchvision.transforms, inspect.isclass))
@@ -98,59 +109,221 @@ def config_from_yaml(filename):
     return config
 
 
-def load_csv(filename, root, mask_column_name='mask', segmentation_column_name='segmentation',
-             target_column_names=None):
+def _join_paths(root, values):
+    # vectorized os.path.join(root, v), missing entries stay NaN
+    values = pd.Series(values)
+    root = str(root)
+    if root and not root.endswith(os.sep):
+        root += os.sep
+    present = values.notna().values
+    strings = values[present].astype(str)
+    joined = strings.where(strings.str.startswith(os.sep), root + strings).values.astype(str)
+    if present.all():
+        return joined
+    res = values.values.astype(object)
+    res[present] = joined
+    return res
+
+
+def _read_csv(filename, root, mask_column_name='mask', segmentation_column_name='segmentation',
+              target_column_names=None):
     df = pd.read_csv(filename, index_col=0)
     df = df.sort_index()
-    samples = np.array([os.path.join(root, v) for v in df.index.values])
+    samples = _join_paths(root, df.index.values)
     masks = None
     segmentations = None
     if mask_column_name in df:
-        masks = np.array([os.path.join(root, v) for v in df[mask_column_name].values])
+        masks = _join_paths(root, df[mask_column_name].values)
     if segmentation_column_name in df:
-        segmentations = np.array([os.path.join(root, v) for v in df[segmentation_column_name].values])
+        segmentations = _join_paths(root, df[segmentation_column_name].values)
 
     cols = df.columns.drop([mask_column_name, segmentation_column_name], errors='ignore')
     if target_column_names is not None:
         cols = [c for c in cols if c in target_column_names]
 
     if len(cols) == 1 and isinstance(df[cols].iloc[0].values[0], str):
-        targets = np.array([os.path.join(root, v[0]) for v in df[cols].values])
+        targets = _join_paths(root, df[cols[0]].values)
     else:
         targets = np.array(df[cols].values)
     target_labels = list(cols)
     return samples, masks, segmentations, targets, target_labels
 
 
-def data_from_config(config):
+def _hash(value):
+    return hashlib.blake2b(repr(value).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _file_digest(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(str(filename), 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cached_manifest(filename, root, cache_dir, **columns):
+    # returns the load_csv result and the digest of the csv file, the arrays are stored in
+    # cache_dir and reused as long as the csv content and the load_csv arguments are unchanged
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = _hash((str(pathlib.Path(filename).resolve()), str(root), sorted(columns.items())))
+    meta_file = cache_dir / 'manifest_{}.yaml'.format(key)
+    data_file = cache_dir / 'manifest_{}.npz'.format(key)
+    stat = os.stat(str(filename))
+
+    meta = None
+    if meta_file.exists() and data_file.exists():
+        with open(str(meta_file), 'r') as f:
+            meta = yaml.safe_load(f)
+        if meta['mtime'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+            # touched or modified: only the content counts
+            digest = _file_digest(filename)
+            if digest != meta['digest']:
+                meta = None
+            else:
+                meta.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+                with open(str(meta_file), 'w') as f:
+                    yaml.safe_dump(meta, f)
+
+    if meta is not None:
+        with np.load(str(data_file), allow_pickle=True) as data:
+            manifest = (data['samples'], data['masks'] if 'masks' in data else None,
+                        data['segmentations'] if 'segmentations' in data else None, data['targets'],
+                        [str(t) for t in data['target_labels']])
+        return manifest, meta['digest']
+
+    digest = _file_digest(filename)
+    manifest = _read_csv(filename, root, **columns)
+    arrays = dict(zip(('samples', 'masks', 'segmentations', 'targets'), manifest[:4]))
+    arrays = {name: arr for name, arr in arrays.items() if arr is not None}
+    np.savez(str(data_file), target_labels=np.array(manifest[4], dtype=str), **arrays)
+    with open(str(meta_file), 'w') as f:
+        yaml.safe_dump({'csv': str(filename), 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'digest': digest}, f)
+    return manifest, digest
+
+
+def load_csv(filename, root, mask_column_name='mask', segmentation_column_name='segmentation',
+             target_column_names=None, cache_dir=None):
+    '''Reads a csv manifest with the sample filenames as index, optional mask and segmentation
+    columns and either one column with target filenames or one column per class label.
+
+    Arguments:
+        filename {str} -- csv file
+        root {str} -- root directory the filenames are relative to
+
+    Keyword Arguments:
+        mask_column_name {str} -- (default: {'mask'})
+        segmentation_column_name {str} -- (default: {'segmentation'})
+        target_column_names {list} -- only use these target columns (default: {None})
+        cache_dir {str} -- directory to cache the parsed manifest in, it is invalidated when the
+        content of the csv file changes (default: {None})
+
+    Returns:
+        tuple -- samples, masks, segmentations, targets, target_labels
+    '''
+    columns = dict(mask_column_name=mask_column_name,
+                   segmentation_column_name=segmentation_column_name,
+                   target_column_names=target_column_names)
+    if cache_dir is None:
+        return _read_csv(filename, root, **columns)
+    return _cached_manifest(filename, root, cache_dir, **columns)[0]
+
+
+def _split_indices(config, samples, targets, cache_dir=None, digest=None):
+    # random train/validation split, persisted in cache_dir for the same manifest content
+    split_file = None
+    if cache_dir is not None:
+        key = _hash((str(pathlib.Path(config['csv']).resolve()), digest, config['test_size'],
+                     bool(config.get('stratified', False))))
+        split_file = pathlib.Path(cache_dir) / 'split_{}.npz'.format(key)
+        if split_file.exists():
+            with np.load(str(split_file)) as split:
+                return split['train'], split['validation']
+
+    if 'stratified' in config and config['stratified']:
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=config['test_size'])
+        train_index, validation_index = next(iter(sss.split(X=samples, y=targets)))
+    else:
+        ss = ShuffleSplit(n_splits=1, test_size=config['test_size'])
+        train_index, validation_index = next(iter(ss.split(X=samples)))
+
+    if split_file is not None:
+        np.savez(str(split_file), train=train_index, validation=validation_index)
+    return train_index, validation_index
+
+
+def _tar_data_from_config(config):
+    if 'validation' not in config:
+        raise ValueError('Tar shard datasets require a validation section with its own shards and csv')
+    data = []
+    for section, shuffle in ((config, True), (config['validation'], False)):
+        columns = section.get('columns', None) or dict()
+        samples, masks, segmentations, targets, target_labels = load_csv(section['csv'], '', **columns)
+        data.append(
+            datasets.TarDataset(section['shards'],
+                                samples=samples,
+                                masks=masks,
+                                segmentations=segmentations,
+                                targets=targets,
+                                target_labels=target_labels,
+                                shuffle=shuffle,
+                                shuffle_buffer=section.get('shuffle_buffer', 1000)))
+    return data[0], data[1]
+
+
+def data_from_config(config, split=None, return_split=False):
+    '''Training and validation data of a dataset config.
+
+    Arguments:
+        config {dict} -- dataset section of the config
+
+    Keyword Arguments:
+        split {tuple} -- (train_index, validation_index) into the csv used instead of a new random
+            split, for configs without validation section (default: {None})
+        return_split {bool} -- also return the split, None for configs with a validation section (default: {False})
+
+    Returns:
+        tuple -- training and validation data (and split)
+    '''
+
+    if 'shards' in config:
+        training_data, validation_data = _tar_data_from_config(config)
+        if return_split:
+            return training_data, validation_data, None
+        return training_data, validation_data
+
+    # optional directory for parsed manifests and persisted split indices
+    cache_dir = config.get('manifest_cache', None)
 
     if 'validation' in config:
+        split = None
         if 'columns' in config:
             columns = config['columns']
         else:
             columns = dict()
         train_samples, train_masks, train_segmentations, train_targets, target_labels = load_csv(
-            config['csv'], config['root'], **columns)
+            config['csv'], config['root'], cache_dir=cache_dir, **columns)
 
         if 'columns' in config['validation']:
             columns = config['validation']['columns']
         else:
             columns = dict()
         validation_samples, validation_masks, validation_segmentations, validation_targets, target_labels = load_csv(
-            config['validation']['csv'], config['validation']['root'], **columns)
+            config['validation']['csv'], config['validation']['root'], cache_dir=cache_dir, **columns)
 
     else:
         if 'columns' in config:
             columns = config['columns']
         else:
             columns = dict()
-        samples, masks, segmentations, targets, target_labels = load_csv(config['csv'], config['root'], **columns)
-        if 'stratified' in config and config['stratified']:
-            sss = StratifiedShuffleSplit(n_splits=1, test_size=config['test_size'])
-            train_index, validation_index = next(iter(sss.split(X=samples, y=targets)))
+        if cache_dir is None:
+            manifest, digest = load_csv(config['csv'], config['root'], **columns), None
         else:
-            ss = ShuffleSplit(n_splits=1, test_size=config['test_size'])
-            train_index, validation_index = next(iter(ss.split(X=samples)))
+            manifest, digest = _cached_manifest(config['csv'], config['root'], cache_dir, **columns)
+        samples, masks, segmentations, targets, target_labels = manifest
+        if split is None:
+            split = _split_indices(config, samples, targets, cache_dir, digest)
+        train_index, validation_index = split
 
         train_samples = samples[train_index]
         validation_samples = samples[validation_index]
@@ -176,21 +349,331 @@ def data_from_config(config):
             train_targets = targets[train_index]
             validation_targets = targets[validation_index]
 
+    # optional decoded image cache shared by training and validation data, size in MB
+    if 'cache_size' in config and config['cache_size'] is not None:
+        loader = SharedImageCache(config['cache_size'] * 2**20, **config.get('cache_kwargs', None) or dict())
+    else:
+        loader = pil_loader
+    reduced_decode = bool(config.get('reduced_decode', False))
+    if 'target_index' in config and config['target_index'] is not None:
+        target_index = datasets.load_target_index(config['target_index'])
+    else:
+        target_index = None
+    if 'retina_index' in config and config['retina_index'] is not None:
+        retina_index = datasets.load_retina_index(config['retina_index'])
+    else:
+        retina_index = None
+    retina_mask = bool(config.get('retina_mask', False))
+
     training_data = datasets.TripleDataset(samples=train_samples,
                                            masks=train_masks,
                                            segmentations=train_segmentations,
                                            targets=train_targets,
-                                           target_labels=target_labels)
+                                           target_labels=target_labels,
+                                           loader=loader,
+                                           reduced_decode=reduced_decode,
+                                           target_index=target_index,
+                                           retina_index=retina_index,
+                                           retina_mask=retina_mask)
     validation_data = datasets.TripleDataset(samples=validation_samples,
                                              masks=validation_masks,
                                              segmentations=validation_segmentations,
                                              targets=validation_targets,
-                                             target_labels=target_labels)
-
+                                             target_labels=target_labels,
+                                             loader=loader,
+                                             reduced_decode=reduced_decode,
+                                             target_index=target_index,
+                                             retina_index=retina_index,
+                                             retina_mask=retina_mask)
+
+    if return_split:
+        return training_data, validation_data, split
     return training_data, validation_data
 
 
-def get_loader(config, dataset, step=None):
+def _open_shard(directory, name, shape, dtype=np.uint8):
+    return np.lib.format.open_memmap(str(directory / (name + '.npy')), mode='w+', dtype=dtype, shape=shape)
+
+
+def _image_to_array(img, mode, size, interpolation):
+    if img.mode != mode:
+        img = img.convert(mode)
+    if img.size != (size[1], size[0]):
+        img = img.resize((size[1], size[0]), interpolation)
+    return np.asarray(img)
+
+
+def create_shards(filename, root, directory, size=None, shard_size=1000, loader=pil_loader, **columns):
+    '''Decodes all images listed in a csv manifest once and writes them into memory-mappable
+    shards of fixed-size uint8 arrays that can be read with datasets.ShardDataset.
+
+    Arguments:
+        filename {str} -- csv file with the manifest, see load_csv
+        root {str} -- root directory of the image files
+        directory {str} -- output directory for the shards
+
+    Keyword Arguments:
+        size {tuple} -- (height, width) all images are resized to. If None, all images must have the size of the first sample (default: {None})
+        shard_size {int} -- number of entries per shard (default: {1000})
+        loader {callable} -- image loader (default: {pil_loader})
+        columns -- column names passed to load_csv
+
+    Returns:
+        pathlib.Path -- directory containing the shards
+    '''
+    samples, masks, segmentations, targets, target_labels = load_csv(filename, root, **columns)
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    first = loader(samples[0])
+    sample_mode = first.mode
+    if size is None:
+        size = (first.height, first.width)
+    elif isinstance(size, int):
+        size = (size, size)
+    size = tuple(size)
+    sample_shape = (len(first.getbands()),) if len(first.getbands()) > 1 else ()
+
+    target_is_image = targets.ndim == 1 and isinstance(targets[0], str)
+    if target_is_image:
+        target_mode = loader(targets[0]).mode
+        target_bands = len(Image.new(target_mode, (1, 1)).getbands())
+        target_shape = (target_bands,) if target_bands > 1 else ()
+    else:
+        target_mode = None
+        np.save(str(directory / 'labels.npy'), targets)
+
+    num_entries = len(samples)
+    offsets = np.zeros((num_entries, 2), dtype=np.int64)
+    shards = []
+    for start in range(0, num_entries, shard_size):
+        stop = min(start + shard_size, num_entries)
+        shard_dir = directory / 'shard_{:05d}'.format(len(shards))
+        shard_dir.mkdir(exist_ok=True)
+
+        sample_arr = _open_shard(shard_dir, 'sample', (stop - start, *size, *sample_shape))
+        mask_arr = None if masks is None else _open_shard(shard_dir, 'mask', (stop - start, *size))
+        segment_arr = None if segmentations is None else _open_shard(shard_dir, 'segmentation', (stop - start, *size))
+        target_arr = None if not target_is_image else _open_shard(shard_dir, 'target',
+                                                                    (stop - start, *size, *target_shape))
+
+        for ii in range(start, stop):
+            offset = ii - start
+            sample_arr[offset] = _image_to_array(loader(samples[ii]), sample_mode, size, Image.BILINEAR)
+            if mask_arr is not None:
+                if isinstance(masks[ii], str):
+                    mask_arr[offset] = _image_to_array(loader(masks[ii]), 'L', size, Image.NEAREST)
+                else:
+                    mask_arr[offset] = 255
+            if segment_arr is not None and isinstance(segmentations[ii], str):
+                segment_arr[offset] = _image_to_array(loader(segmentations[ii]), 'L', size, Image.NEAREST)
+            if target_arr is not None:
+                target_arr[offset] = _image_to_array(loader(targets[ii]), target_mode, size, Image.NEAREST)
+            offsets[ii, :] = (len(shards), offset)
+
+        for arr in (sample_arr, mask_arr, segment_arr, target_arr):
+            if arr is not None:
+                arr.flush()
+        shards.append(shard_dir.name)
+
+    np.save(str(directory / 'offsets.npy'), offsets)
+    np.save(str(directory / 'samples.npy'), samples.astype(str))
+    if target_is_image:
+        np.save(str(directory / 'targets.npy'), targets.astype(str))
+
+    index = {
+        'size': list(size),
+        'num_entries': num_entries,
+        'shard_size': shard_size,
+        'shards': shards,
+        'sample_mode': sample_mode,
+        'target_mode': target_mode,
+        'target_type': 'image' if target_is_image else 'labels',
+        'target_labels': [str(t) for t in target_labels],
+    }
+    with open(str(directory / datasets.SHARD_INDEX), 'w') as f:
+        yaml.safe_dump(index, f)
+    return directory
+
+
+def create_tar_shards(filename, root, directory, shard_size=1000, **columns):
+    '''Packs the files listed in a csv manifest into tar shards that can be streamed with
+    datasets.TarDataset. The files are stored unchanged under their names in the manifest,
+    the members of each entry consecutively with the sample first. Label images shared by
+    several entries are stored once per entry. The manifest is copied to manifest.csv.
+
+    Arguments:
+        filename {str} -- csv file with the manifest, see load_csv
+        root {str} -- root directory of the image files
+        directory {str} -- output directory for the shards
+
+    Keyword Arguments:
+        shard_size {int} -- number of entries per shard (default: {1000})
+        columns -- column names passed to load_csv
+
+    Returns:
+        list -- filenames of the shards
+    '''
+    samples, masks, segmentations, targets, _ = load_csv(filename, root, **columns)
+    names, name_masks, name_segmentations, name_targets, _ = load_csv(filename, '', **columns)
+    target_is_image = targets.ndim == 1 and isinstance(targets[0], str)
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    for start in range(0, len(samples), shard_size):
+        shard = directory / 'shard_{:05d}.tar'.format(len(shards))
+        with tarfile.open(str(shard), 'w') as tar:
+            for ii in range(start, min(start + shard_size, len(samples))):
+                members = [(samples[ii], names[ii])]
+                if masks is not None:
+                    members.append((masks[ii], name_masks[ii]))
+                if segmentations is not None:
+                    members.append((segmentations[ii], name_segmentations[ii]))
+                if target_is_image:
+                    members.append((targets[ii], name_targets[ii]))
+                added = set()
+                for path, name in members:
+                    if isinstance(path, str) and name not in added:
+                        tar.add(path, arcname=name)
+                        added.add(name)
+        shards.append(shard)
+
+    shutil.copyfile(str(filename), str(directory / 'manifest.csv'))
+    return shards
+
+
+def create_target_index(filename, root, directory, loader=pil_loader, **columns):
+    '''Indexes the multi-band target images of a csv manifest once: records the non-empty
+    bands of each target and stores the background-composited label map as single uint8
+    class index image (see datasets.label_map_from_bands). Targets that cannot be stored
+    losslessly get 0 channels and are loaded from the original file.
+
+    Arguments:
+        filename {str} -- csv file with the manifest, see load_csv
+        root {str} -- root directory of the image files
+        directory {str} -- output directory for the index and label maps
+
+    Keyword Arguments:
+        loader {callable} -- image loader (default: {pil_loader})
+        columns -- column names passed to load_csv
+
+    Returns:
+        pathlib.Path -- directory containing the index
+    '''
+    _, _, _, targets, _ = load_csv(filename, root, **columns)
+    if targets.ndim != 1 or not isinstance(targets[0], str):
+        raise ValueError('Target index requires image targets')
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    label_maps = []
+    channels = np.zeros(len(targets), dtype=np.int64)
+    for ii, target in enumerate(targets):
+        label_map = None
+        img = loader(target)
+        if len(img.getbands()) > 1:
+            label_map = datasets.label_map_from_bands(img)
+        if label_map is None:
+            label_maps.append('')
+            continue
+        name = 'label_map_{:07d}.png'.format(ii)
+        label_map[0].save(str(directory / name))
+        label_maps.append(name)
+        channels[ii] = label_map[1]
+
+    df = pd.DataFrame({'label_map': label_maps, 'channels': channels}, index=pd.Index(targets, name='target'))
+    df.to_csv(str(directory / datasets.TARGET_INDEX))
+    return directory
+
+
+def _find_retina(args):
+    filename, kwargs = args
+    img = np.asarray(pil_loader(filename, 'RGB'))
+    circle = find_retina_boxes(np.ascontiguousarray(img[..., ::-1]), **kwargs)
+    if circle is None:
+        return (np.nan, np.nan, np.nan, img.shape[0], img.shape[1])
+    x, y, _, r_out, _ = circle
+    return (x, y, r_out, img.shape[0], img.shape[1])
+
+
+def create_retina_index(filename, root, output, num_workers=None, retina_kwargs=None, **columns):
+    '''Runs find_retina_boxes once for every sample of a csv manifest in a process pool and
+    stores the retina circle (center and outer radius) with the image size as csv, see
+    datasets.load_retina_index. Samples without a detected retina get empty entries.
+
+    Arguments:
+        filename {str} -- csv file with the manifest, see load_csv
+        root {str} -- root directory of the image files
+        output {str} -- csv file for the retina index
+
+    Keyword Arguments:
+        num_workers {int} -- number of processes, 0 runs in the calling process (default: {None} = number of cpus)
+        retina_kwargs {dict} -- keyword arguments for find_retina_boxes (default: {None})
+        columns -- column names passed to load_csv
+
+    Returns:
+        pathlib.Path -- the retina index file
+    '''
+    samples = load_csv(filename, root, **columns)[0]
+    tasks = [(sample, retina_kwargs or dict()) for sample in samples]
+    if num_workers == 0:
+        circles = list(map(_find_retina, tasks))
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            circles = pool.map(_find_retina, tasks, chunksize=16)
+
+    df = pd.DataFrame(circles, columns=['x', 'y', 'radius', 'height', 'width'], index=pd.Index(samples, name='filename'))
+    output = pathlib.Path(output)
+    df.to_csv(str(output))
+    return output
+
+
+def create_size_index(filename, root, output, **columns):
+    '''Reads (height, width) of all samples of a csv manifest from the image headers and
+    stores them as csv with the sample filenames as index, see load_size_index.
+
+    Arguments:
+        filename {str} -- csv file with the manifest, see load_csv
+        root {str} -- root directory of the image files
+        output {str} -- csv file for the size index
+
+    Keyword Arguments:
+        columns -- column names passed to load_csv
+
+    Returns:
+        pathlib.Path -- the size index file
+    '''
+    samples = load_csv(filename, root, **columns)[0]
+    sizes = np.zeros((len(samples), 2), dtype=np.int64)
+    for ii, sample in enumerate(samples):
+        with Image.open(sample) as img:
+            sizes[ii] = (img.height, img.width)
+    df = pd.DataFrame({'height': sizes[:, 0], 'width': sizes[:, 1]}, index=pd.Index(samples, name='filename'))
+    output = pathlib.Path(output)
+    df.to_csv(str(output))
+    return output
+
+
+def load_size_index(filename, samples):
+    '''Sizes of samples from a size index written by create_size_index.
+
+    Arguments:
+        filename {str} -- csv file of the size index
+        samples {list} -- sample filenames of the dataset
+
+    Returns:
+        numpy.array -- Nx2 array of (height, width) aligned with samples
+    '''
+    df = pd.read_csv(str(filename), index_col=0)
+    missing = pd.Index(samples).difference(df.index)
+    if len(missing) > 0:
+        raise ValueError('{} samples are missing in the size index {}, e.g. {}'.format(
+            len(missing), filename, missing[0]))
+    return df.loc[list(samples), ['height', 'width']].values
+
+
+def get_loader(config, dataset, step=None, tune_file=None, distributed=False):
     if 'drop_last' not in config or config['drop_last'] is None:
         drop_last = False
     else:
@@ -209,27 +692,191 @@ def get_loader(config, dataset, step=None):
     else:
         num_samples = config['num_samples']
 
-    if 'weighted_sampling_classes' in config:
-        sampler = get_equal_sampler(dataset,
-                                    num_samples=num_samples,
-                                    relevant_slice=config['weighted_sampling_classes'])
-    else:
-        sampler = torch.utils.data.RandomSampler(dataset, replacement=replacement, num_samples=num_samples)
-
-    if step is not None and 'batch_size_increase' in config and config['batch_size_increase'] is not None:
+    # with gradient accumulation the batch size increase goes into the number of
+    # micro-batches per optimizer step, see get_accumulation_steps
+    if (step is not None and config.get('batch_size_increase', None) is not None and
+            config.get('accumulation_steps', None) is None):
         batch_size = config['batch_size'] + step * config['batch_size_increase']
     else:
         batch_size = config['batch_size']
 
-    loader = torch.utils.data.DataLoader(dataset,
-                                         batch_size=batch_size,
-                                         shuffle=False,
-                                         drop_last=drop_last,
-                                         num_workers=config['num_workers'],
-                                         sampler=sampler)
+    omit_constant = bool(config.get('omit_constant_channels', False))
+
+    if distributed:
+        # every process of the initialized process group loads its share of the samples
+        if isinstance(dataset, torch.utils.data.IterableDataset) or config.get('size_index', None) is not None or \
+                config.get('stratified_batches', False):
+            raise ValueError('Distributed loading supports random and weighted sampling only')
+        if 'weighted_sampling_classes' in config:
+            weights = samplers.class_balanced_weights(dataset.targets, config['weighted_sampling_classes'])
+            replacement = True
+        else:
+            weights = np.ones(len(dataset))
+            replacement = replacement or (num_samples is not None and num_samples > len(dataset))
+        sampler = samplers.DistributedWeightedSampler(weights, num_samples=num_samples, replacement=replacement)
+        loader_kwargs = dict(batch_size=batch_size,
+                             shuffle=False,
+                             drop_last=drop_last,
+                             sampler=sampler,
+                             collate_fn=datasets.TripleCollate(omit_constant))
+
+    elif isinstance(dataset, torch.utils.data.IterableDataset):
+        # streaming datasets shuffle themselves and return every entry once per epoch
+        if 'weighted_sampling_classes' in config:
+            raise ValueError('weighted_sampling_classes is not supported for streaming datasets')
+        loader_kwargs = dict(batch_size=batch_size, drop_last=drop_last, collate_fn=datasets.TripleCollate(omit_constant))
+
+    elif config.get('size_index', None) is not None:
+        # batches of similar sized images at native resolution, padded to the largest one
+        batch_sampler = samplers.BucketBatchSampler(load_size_index(config['size_index'], dataset.samples),
+                                                    batch_size,
+                                                    granularity=config.get('bucket_granularity', 32),
+                                                    drop_last=drop_last)
+        loader_kwargs = dict(batch_sampler=batch_sampler,
+                             collate_fn=datasets.PaddingCollate(config.get('pad_multiple', 1), omit_constant))
+
+    elif config.get('stratified_batches', False):
+        # balanced classes within every batch instead of only in expectation
+        if num_samples is None:
+            num_samples = len(dataset)
+        classes = samplers.sample_classes(dataset.targets, config.get('weighted_sampling_classes', None))
+        batch_sampler = samplers.StratifiedBatchSampler(classes, batch_size, num_samples // batch_size)
+        loader_kwargs = dict(batch_sampler=batch_sampler, collate_fn=datasets.TripleCollate(omit_constant))
+
+    else:
+        if 'weighted_sampling_classes' in config:
+            sampler = get_equal_sampler(dataset,
+                                        num_samples=num_samples,
+                                        relevant_slice=config['weighted_sampling_classes'])
+        else:
+            sampler = torch.utils.data.RandomSampler(dataset, replacement=replacement, num_samples=num_samples)
+        loader_kwargs = dict(batch_size=batch_size,
+                             shuffle=False,
+                             drop_last=drop_last,
+                             sampler=sampler,
+                             collate_fn=datasets.TripleCollate(omit_constant))
+
+    if config['num_workers'] == 'auto':
+        tuned = tune_loader(dataset, loader_kwargs, cache_file=tune_file, **(config.get('auto_tune', None) or dict()))
+        num_workers = tuned['num_workers']
+        prefetch_factor = tuned['prefetch_factor']
+        pin_memory = config.get('pin_memory', torch.cuda.is_available())
+        persistent_workers = config.get('persistent_workers', True)
+    else:
+        num_workers = config['num_workers']
+        prefetch_factor = config.get('prefetch_factor', None)
+        pin_memory = config.get('pin_memory', False)
+        persistent_workers = config.get('persistent_workers', False)
+
+    loader_kwargs.update(_worker_kwargs(num_workers, prefetch_factor, persistent_workers))
+    loader = torch.utils.data.DataLoader(dataset, pin_memory=pin_memory, **loader_kwargs)
     return loader
 
 
+def get_accumulation_steps(config, step=None):
+    '''Micro-batches per optimizer step for Network.train. The effective batch size is
+    batch_size * accumulation_steps, grown by batch_size_increase per step (epoch) and
+    rounded up to whole micro-batches, so the loader keeps its batch size.
+
+    Arguments:
+        config {dict} -- training section of the config
+
+    Keyword Arguments:
+        step {int} -- current step for batch_size_increase (default: {None})
+
+    Returns:
+        int -- number of micro-batches
+    '''
+    accumulation_steps = config.get('accumulation_steps', None)
+    if accumulation_steps is None:
+        return 1
+    if step is None or config.get('batch_size_increase', None) is None:
+        return accumulation_steps
+    effective = config['batch_size'] * accumulation_steps + step * config['batch_size_increase']
+    return max(1, -(-effective // config['batch_size']))
+
+
+def _worker_kwargs(num_workers, prefetch_factor=None, persistent_workers=False):
+    # prefetch_factor and persistent_workers are only accepted with worker processes
+    kwargs = dict(num_workers=num_workers)
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        if prefetch_factor is not None:
+            kwargs['prefetch_factor'] = prefetch_factor
+    return kwargs
+
+
+def _measure_loader(loader, num_batches):
+    # samples per second after the first batch, which includes the worker start up
+    batches = iter(loader)
+    next(batches, None)
+    num_samples = 0
+    start = time.perf_counter()
+    for ii, (_, target) in enumerate(batches):
+        num_samples += len(target)
+        if ii + 1 >= num_batches:
+            break
+    duration = time.perf_counter() - start
+    del batches
+    return num_samples / duration if num_samples > 0 else 0.0
+
+
+def tune_loader(dataset, loader_kwargs, worker_counts=None, prefetch_factors=(2, 4), num_batches=10, cache_file=None):
+    '''Measures the samples per second of DataLoaders over the dataset for all combinations
+    of worker counts and prefetch factors and returns the fastest. If cache_file is given
+    the result is stored there and reused for the same machine, dataset size and batch size.
+
+    Arguments:
+        dataset {torch.utils.data.Dataset} -- the dataset to load
+        loader_kwargs {dict} -- DataLoader arguments except num_workers and prefetch_factor
+
+    Keyword Arguments:
+        worker_counts {list} -- number of workers to try (default: {None} = 0, 1, 2, 4, ... up to the number of cpus)
+        prefetch_factors {list} -- prefetch factors to try for worker processes (default: {(2, 4)})
+        num_batches {int} -- batches measured per configuration (default: {10})
+        cache_file {str} -- yaml file for the result (default: {None})
+
+    Returns:
+        dict -- num_workers, prefetch_factor and samples_per_second of the fastest configuration
+    '''
+    batch_size = loader_kwargs.get('batch_size', None)
+    if batch_size is None:
+        batch_size = loader_kwargs['batch_sampler'].batch_size
+    machine = {
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'dataset_size': len(dataset),
+        'batch_size': batch_size,
+    }
+    if cache_file is not None and pathlib.Path(cache_file).exists():
+        with open(str(cache_file), 'r') as f:
+            cached = yaml.safe_load(f)
+        if all(cached.get(k) == v for k, v in machine.items()):
+            print('Loader auto-tune: using num_workers={}, prefetch_factor={} from {}'.format(
+                cached['num_workers'], cached['prefetch_factor'], cache_file))
+            return cached
+
+    if worker_counts is None:
+        worker_counts = [0] + [2**ii for ii in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+
+    results = []
+    for num_workers in worker_counts:
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else [None]):
+            loader = torch.utils.data.DataLoader(dataset, **loader_kwargs,
+                                                 **_worker_kwargs(num_workers, prefetch_factor))
+            results.append((_measure_loader(loader, num_batches), num_workers, prefetch_factor))
+
+    # fewest workers and smallest prefetch among equally fast configurations
+    speed, num_workers, prefetch_factor = max(results, key=lambda r: (r[0], -r[1], -(r[2] or 0)))
+    tuned = dict(machine, num_workers=num_workers, prefetch_factor=prefetch_factor, samples_per_second=float(speed))
+    print('Loader auto-tune: num_workers={}, prefetch_factor={} ({:.1f} samples/s)'.format(
+        num_workers, prefetch_factor, speed))
+    if cache_file is not None:
+        with open(str(cache_file), 'w') as f:
+            yaml.safe_dump(tuned, f)
+    return tuned
+
+
 def get_equal_sampler(dataset, num_samples, relevant_slice=None):
     '''The distribution of samples in training and test data is not equal, i.e.
     the normal class is over represented. To get an unbiased sample (for example with 5
@@ -248,19 +895,6 @@ def get_equal_sampler(dataset, num_samples, relevant_slice=None):
         torch.util.data.Sampler -- Sampler object from which patches for the training
         or evaluation can be drawn
     '''
-    if relevant_slice is None:
-        relevant_slice = range(dataset.targets.shape[1])
-
-    class_distribution = np.vstack([s for s in dataset.targets]).astype(np.int)[:, relevant_slice]
-    weights = np.zeros(len(relevant_slice))
-    for ii in range(len(relevant_slice)):
-        weights[ii] = np.sum(class_distribution[:, ii] == 1) / len(class_distribution)
-
-    inverted_weights = (1 / weights) / np.sum(1 / weights)
-    sampling_weights = np.zeros(class_distribution.shape[0], dtype=np.float)
-    for ii in range(len(relevant_slice)):
-        sampling_weights[class_distribution[:, ii] == 1] = inverted_weights[ii]
-    sampling_weights /= sampling_weights.sum()
-
+    sampling_weights = samplers.class_balanced_weights(dataset.targets, relevant_slice)
     sampler = torch.utils.data.WeightedRandomSampler(sampling_weights, num_samples, True)
     return sampler
@@ -1,12 +1,18 @@
+import collections
+import concurrent.futures
+import multiprocessing
 import os
 import sys
 
 import cv2
-import imageio
 import numpy as np
 import torch
 import torchvision
 from PIL import Image
+
+from .patches import (blend_window, fold_patches, grid_size, merge_patches, sliding_window_view, split_patches,
+                      tiled_inference)
+
 if 'IPython' in sys.modules:
 
     from IPython import get_ipython
@@ -23,13 +29,31 @@ else:
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff')
 
 
-def pil_loader(path, mode=None):
-    img = Image.open(path)
+def pil_loader(path, mode=None, draft=None):
+    img = draft_image(Image.open(path), draft)
     if mode is None:
         return img
     return img.convert(mode)
 
 
+def draft_image(img, size):
+    '''Configures a not yet loaded JPEG image to be decoded at the smallest DCT scale
+    (1/2, 1/4, 1/8) that is still at least size. Other formats and images that are
+    already decoded are returned unchanged.
+
+    Arguments:
+        img {PIL.Image} -- image as returned by Image.open
+        size {tuple} -- minimum (height, width) of the decoded image
+
+    Returns:
+        PIL.Image -- the same image object
+    '''
+    if size is None or img.format != 'JPEG':
+        return img
+    img.draft(img.mode, (int(size[1]), int(size[0])))
+    return img
+
+
 # def pil_loader(path, mode='RGB'):
 #     """load an image using PIL/Pillow
 
@@ -103,34 +127,60 @@ def float_to_uint8(img, min_val=None, max_val=None):
     return img_scale
 
 
-def PIL_to_cv2(img):
+def numpy_to_torch(arr):
+    '''Tensor sharing the memory of a numpy array. Read-only arrays and arrays with
+    negative strides (e.g. flipped channels) cannot be shared and are copied.
+
+    Arguments:
+        arr {numpy.array} -- numpy array
+
+    Returns:
+        torch.Tensor -- tensor with the same shape and dtype
+    '''
+    if not arr.flags.writeable or any(stride < 0 for stride in arr.strides):
+        arr = arr.copy()
+    return torch.from_numpy(arr)
+
+
+def PIL_to_cv2(img, writable=True):
     '''Converts PIL uint8 image into numpy array. No conversion applied.
 
     Arguments:
         img {PIL.Image} -- PIL image object
 
+    Keyword Arguments:
+        writable {bool} -- if False, the array is read-only and created directly from the image
+            buffer without a second copy (default: {True})
+
     Returns:
         numpy.array -- numpy array with same data as PIL image
     '''
-
-    return np.array(img)
+    if writable:
+        return np.array(img)
+    return np.asarray(img)
 
 
-def PIL_to_torch(img):
-    '''Converts PIL uint8 image into torch tensor. No conversion applied.
+def PIL_to_torch(img, share_memory=False):
+    '''Converts PIL uint8 image into float torch tensor with values in [0, 1].
 
     Arguments:
         img {PIL.Image} -- PIL image object
 
+    Keyword Arguments:
+        share_memory {bool} -- return the uint8 data without conversion instead, the channel dimension
+            is moved by a view of the HWC data (default: {False})
+
     Returns:
         torch.Tensor -- torch tensor with same data as PIL image, NCHW shape
     '''
-
+    if share_memory:
+        return cv2_to_torch(np.array(img), share_memory=True)
     return (torchvision.transforms.ToTensor()(img)).unsqueeze(0)
 
 
 def torch_to_PIL(img):
-    '''Converts torch tensor image into PIL uint8. No conversion applied.
+    '''Converts torch tensor image into PIL uint8. uint8 tensors are passed on unchanged,
+    floating point tensors in [0, 1] are scaled by 255 as in torchvision.
 
     Arguments:
         img {torch.tensor} -- torch tensor
@@ -138,26 +188,33 @@ def torch_to_PIL(img):
     Returns:
         PIL.Image -- PIL Image with same data as torch tensor
     '''
-
+    if img.dtype == torch.uint8:
+        img = torch_to_cv2(img)
+        if img.shape[2] == 1:
+            img = img[:, :, 0]
+        return Image.fromarray(np.ascontiguousarray(img))
     return torchvision.transforms.ToPILImage()(img.squeeze())
 
 
 def torch_to_cv2(img):
-    '''Converts torch format (NCHW or CHW) to cv2 format (HWC)
+    '''Converts torch format (NCHW or CHW) to cv2 format (HWC) without copying CPU tensors.
 
     Arguments:
         img {torch.Tensor} -- NCHW shaped with n=1 or CHW shaped torch tensor
 
     Returns:
-        [numpy.ndarray] -- cv2 image in HWC format
+        [numpy.ndarray] -- cv2 image in HWC format, a view of the tensor
     '''
-    img = np.transpose(img.squeeze().numpy(), axes=(1, 2, 0))
-    return img
+    img = img.detach().cpu()
+    if img.dim() == 4:
+        img = img.squeeze(0)
+    return img.permute(1, 2, 0).numpy()
 
 
 def cv2_to_PIL(img, min_val=None, max_val=None):
     '''Converts the cv2 image or numpy array of arbitrary scale to a PIL image with
-    uint8 format. Upper and lower bound for scaling can be given, e.g. 0.0 and 1.0, otherwise
+    uint8 format. uint8 images are passed on unchanged unless bounds are given. Otherwise
+    upper and lower bound for scaling can be given, e.g. 0.0 and 1.0, if not
     min and max values of image are used for 0 and 255. No clipping is applied. Passing a lower
     bound larger than the smallest value in the image can lead to values <0 and undefined behaviour
     in the conversion.
@@ -172,22 +229,30 @@ def cv2_to_PIL(img, min_val=None, max_val=None):
     Returns:
         [PIL.Image] -- PIL image in uint8 format
     '''
-
+    if img.dtype == np.uint8 and min_val is None and max_val is None:
+        return Image.fromarray(img)
     img_scale = float_to_uint8(img, min_val, max_val)
     pil_img = Image.fromarray(img_scale)
     return pil_img
 
 
-def cv2_to_torch(img):
-    '''Converts cv2 format (HWC) to torch format (NCHW)
+def cv2_to_torch(img, share_memory=False):
+    '''Converts cv2 format (HWC or HW) to float32 torch format (NCHW).
 
     Arguments:
         img {numpy.array} -- Numpy array in HWC format
 
+    Keyword Arguments:
+        share_memory {bool} -- return a view of the array with the same dtype instead, see numpy_to_torch
+            for arrays that are copied (default: {False})
 
     Returns:
         torch.Tensor -- NCHW torch tensor
     '''
+    if img.ndim == 2:
+        img = img[:, :, None]
+    if share_memory:
+        return numpy_to_torch(img).permute(2, 0, 1).unsqueeze(0)
     img = np.transpose(img, axes=(2, 0, 1))
     torch_img = torch.Tensor(img).unsqueeze(0)
     return torch_img
@@ -204,84 +269,34 @@ def split_tensor_image_into_patches(img, patch_size):
     Returns:
         torch.Tensor -- NCHW shaped tensor with all patches
     '''
-    c, h, w = img.size()
-    n_y = int(h / patch_size)
-    n_x = int(w / patch_size)
-    out = torch.zeros((n_x * n_y, c, patch_size, patch_size))
-    for ii in range(n_y):
-        for jj in range(n_x):
-            out[ii * n_x +
-                jj, :, :, :] = img[:, ii * patch_size:(ii + 1) * patch_size, jj * patch_size:(jj + 1) * patch_size]
-    return out
+    return split_patches(img.unsqueeze(0), patch_size)
 
 
 def merge_tensor_image_from_patches(patches, shape=None):
     """Assembles patches to an image
 
     Arguments:
-        patches {[type]} -- [description]
+        patches {torch.Tensor} -- NCHW patches in row major order
 
     Keyword Arguments:
-        shape {[type]} -- [description] (default: {None})
+        shape {tuple} -- number of patches (n_h, n_w), square if None (default: {None})
 
     Returns:
-        [type] -- [description]
+        torch.Tensor -- CHW image
     """
-    k, c, patch_size, _ = patches.size()
     if shape is None:
-        n_h = int(np.sqrt(k))
-        n_w = n_h
-    else:
-        n_h, n_w = shape
-    out = torch.zeros((c, patch_size * n_h, patch_size * n_w))
-    for ii in range(n_h):
-        for jj in range(n_w):
-            out[:, ii * patch_size:(ii + 1) * patch_size, jj * patch_size:(jj + 1) * patch_size] = patches[ii * n_w +
-                                                                                                           jj, :, :, :]
-    return out
+        n_h = int(np.sqrt(patches.shape[0]))
+        shape = (n_h, n_h)
+    return merge_patches(patches[:shape[0] * shape[1]], shape)[0]
 
 
 def split_tensor_image_sliding_window(img, patch_size, stride=1):
-    if isinstance(patch_size, (list, tuple)):
-        p_h, p_w = patch_size
-    else:
-        p_h = patch_size
-        p_w = patch_size
-    if isinstance(stride, (list, tuple)):
-        s_h, s_w = stride
-    else:
-        s_h = stride
-        s_w = stride
-    c, h, w = img.shape
-
-    n_h = int((h - p_h) / s_h) + 1
-    n_w = int((w - p_w) / s_w) + 1
-    patches = torch.zeros((n_h * n_w, c, p_h, p_w))
-    for ii in range(n_h):
-        for jj in range(n_w):
-            patches[ii * n_w + jj, ...] = img[:, ii * s_h:ii * s_h + p_h, jj * s_w:jj * s_w + p_w]
-
-    return patches
+    return split_patches(img.unsqueeze(0), patch_size, stride)
 
 
 def split_tensor_image_sliding_window_generator(img, patch_size, stride=1):
-    if isinstance(patch_size, (list, tuple)):
-        p_h, p_w = patch_size
-    else:
-        p_h = patch_size
-        p_w = patch_size
-    if isinstance(stride, (list, tuple)):
-        s_h, s_w = stride
-    else:
-        s_h = stride
-        s_w = stride
-    c, h, w = img.shape
-
-    n_h = int((h - p_h) / s_h) + 1
-    n_w = int((w - p_w) / s_w) + 1
-    for ii in range(n_h):
-        for jj in range(n_w):
-            yield img[:, ii * s_h:ii * s_h + p_h, jj * s_w:jj * s_w + p_w]
+    for row in sliding_window_view(img.unsqueeze(0), patch_size, stride)[0]:
+        yield from row
 
 
 def merge_label_on_image(images, labels):
@@ -289,51 +304,61 @@ def merge_label_on_image(images, labels):
     return out
 
 
-def merge_labels(labels, img_size, stride=1, minimum_matches=0):
-    if isinstance(img_size, (list, tuple)):
-        h, w = img_size
-    else:
-        h = img_size
-        w = img_size
-    if isinstance(stride, (list, tuple)):
-        s_h, s_w = stride
-    else:
-        s_h = stride
-        s_w = stride
+def merge_labels(labels, img_size, stride=1, minimum_matches=0, return_votes=False):
+    """Merges the labels of overlapping sliding window patches (in row major order, see
+    split_tensor_image_sliding_window) into an image. The labels are summed with fold, by
+    default a pixel is set if more than minimum_matches patches found it (clamped to [0, 1]).
+
+    Arguments:
+        labels {torch.Tensor} -- NHW or N1HW patch labels
+        img_size {int} -- edge length or (height, width) of the image
 
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {1})
+        minimum_matches {int} -- votes subtracted before clamping, ignored with return_votes (default: {0})
+        return_votes {bool} -- return the probability map and votes instead (default: {False})
+
+    Returns:
+        torch.Tensor -- HW merged labels, or with return_votes a tuple of the HW averaged probability map
+            (0 where no patch covers the image) and the HW vote count (sum of the labels)
+    """
     if labels.dim() == 4:
-        n, c, p_h, p_w = labels.shape
-        if c != 1:
+        if labels.shape[1] != 1:
             raise ValueError('labels must be NHW or NCHW with C=1. This label is {0}'.format(labels.shape))
-        labels = labels.squeeze()
     else:
-        n, p_h, p_w = labels.shape
-        c = 1
-
-    n_h = int((h - p_h) / s_h) + 1
-    n_w = int((w - p_w) / s_w) + 1
-    img = torch.zeros((h, w)) - minimum_matches
-    for ii in range(n_h):
-        for jj in range(n_w):
-            img[ii * s_h:ii * s_h + p_h, jj * s_w:jj * s_w + p_w] += labels[ii * n_w + n_h, :, :]
-    img = torch.clamp(img, 0, 1)
-    return img
+        labels = labels.unsqueeze(1)
+    size = img_size if isinstance(img_size, (list, tuple)) else (img_size, img_size)
+    n_h, n_w = grid_size(size, labels.shape[2:], stride)
+    if labels.shape[0] != n_h * n_w:
+        raise ValueError('Expected {} patches for an image of size {}, got {}'.format(n_h * n_w, size, labels.shape[0]))
+
+    votes, count = fold_patches(labels.float(), size, stride)
+    if return_votes:
+        probability = votes / count.clamp_min(1)
+        return probability[0, 0], votes[0, 0]
+    return torch.clamp(votes[0, 0] - minimum_matches, 0, 1)
 
 
 def sample_patches(images, labels, patch_size, number_patches):
-    n, c, h, w = images.size()
-    max_y = h - patch_size
-    max_x = w - patch_size
-    img_patch = torch.zeros((number_patches, c, patch_size, patch_size))
-    lab_patch = torch.zeros((number_patches, 2, patch_size, patch_size))
-    for ii in range(number_patches):
-        img_index = np.random.randint(n)
-        p_x = np.random.randint(max_x)
-        p_y = np.random.randint(max_y)
-        img_patch[ii, ...] = images[img_index, :, p_y:p_y + patch_size, p_x:p_x + patch_size]
-        lab_patch[ii, 0, ...] = 1 - labels[img_index, :, p_y:p_y + patch_size, p_x:p_x + patch_size]
-        lab_patch[ii, 1, ...] = labels[img_index, :, p_y:p_y + patch_size, p_x:p_x + patch_size]
-    return img_patch, lab_patch
+    """Random patches of a batch of images and their labels, drawn uniformly. See
+    datasets.PatchDataset for foreground aware sampling from memory-mapped images.
+
+    Arguments:
+        images {torch.Tensor} -- NCHW images
+        labels {torch.Tensor} -- N1HW labels
+        patch_size {int} -- edge length of the patches
+        number_patches {int} -- number of patches
+
+    Returns:
+        tuple -- (number_patches, C, p, p) image patches and (number_patches, 2, p, p) (background, label) patches
+    """
+    n, _, h, w = images.size()
+    img_index = torch.randint(n, (number_patches,))
+    p_y = torch.randint(h - patch_size + 1, (number_patches,))
+    p_x = torch.randint(w - patch_size + 1, (number_patches,))
+    img_patch = sliding_window_view(images, patch_size, 1)[img_index, p_y, p_x]
+    lab_patch = sliding_window_view(labels, patch_size, 1)[img_index, p_y, p_x][:, :1]
+    return img_patch, torch.cat((1 - lab_patch, lab_patch), dim=1)
 
 
 def parallel_variance(mean_a, count_a, var_a, mean_b, count_b, var_b):
@@ -344,21 +369,88 @@ def parallel_variance(mean_a, count_a, var_a, mean_b, count_b, var_b):
     return M2 / (count_a + count_b - 1)
 
 
-def calculate_mean_and_std(samples):
-    img = imageio.imread(samples[0]) / 255.
-    mean_a = img.reshape(-1, 3).mean(0)
-    var_a = img.reshape(-1, 3).var(0)
-    count_a = img.shape[0] * img.shape[1]
-    for s in tqdm(samples[1:]):
-        img = imageio.imread(s) / 255.
-        mean_b = img.reshape(-1, 3).mean(0)
-        var_b = img.reshape(-1, 3).var(0)
-        count_b = img.shape[0] * img.shape[1]
+def merge_moments(mean_a, count_a, m2_a, mean_b, count_b, m2_b):
+    '''Pairwise combination of mean and sum of squared deviations (M2) of two sets,
+    same formula as parallel_variance.
+
+    Returns:
+        tuple -- (mean, count, M2) of the union
+    '''
+    count = count_a + count_b
+    if count == 0:
+        return mean_a, count, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+    return mean, count, m2
+
+
+def _chunk_moments(args):
+    # (mean, count, M2) per channel of a chunk of images, exact from uint8 histograms
+    samples, subsample, retina_mask, seed = args
+    rng = np.random.default_rng(seed)
+    step = max(1, int(round(1 / subsample)))
+    hist = np.zeros((3, 256), dtype=np.int64)
+    for filename in samples:
+        img = np.asarray(pil_loader(filename, 'RGB'))
+        pixels = img.reshape(-1, 3)
+        if retina_mask:
+            mask = get_retina_mask(np.ascontiguousarray(img[..., ::-1]))
+            pixels = pixels[mask.reshape(-1) > 0]
+        if step > 1:
+            pixels = pixels[rng.integers(step)::step]
+        for c in range(3):
+            hist[c] += np.bincount(pixels[:, c], minlength=256)
+
+    values = np.arange(256, dtype=np.float64) / 255.
+    count = int(hist[0].sum())
+    if count == 0:
+        return np.zeros(3), 0, np.zeros(3)
+    mean = (hist * values).sum(1) / count
+    m2 = (hist * (values[None, :] - mean[:, None])**2).sum(1)
+    return mean, count, m2
+
+
+def calculate_mean_and_std(samples, num_workers=None, chunk_size=64, subsample=1.0, retina_mask=False,
+                           config=None):
+    '''Channel-wise mean and standard deviation of RGB images in the range [0, 1]. Chunks of
+    images are processed in a process pool and their (mean, count, M2) merged pairwise.
+
+    Arguments:
+        samples {list} -- image filenames
+
+    Keyword Arguments:
+        num_workers {int} -- number of processes, 0 computes in the calling process (default: {None} = number of cpus)
+        chunk_size {int} -- images per task (default: {64})
+        subsample {float} -- fraction of pixels used per image (default: {1.0})
+        retina_mask {bool} -- only use pixels inside the retina found by get_retina_mask (default: {False})
+        config {dict} -- DataPreparation config block, mean and std are written into it (default: {None})
+
+    Returns:
+        tuple -- mean, std
+    '''
+    if not 0 < subsample <= 1:
+        raise ValueError('subsample has to be in (0, 1], got {}'.format(subsample))
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    chunks = [(samples[ii:ii + chunk_size], subsample, retina_mask, ii) for ii in range(0, len(samples), chunk_size)]
+
+    mean, count, m2 = np.zeros(3), 0, np.zeros(3)
+    if num_workers == 0:
+        results = map(_chunk_moments, chunks)
+        for result in tqdm(results, total=len(chunks)):
+            mean, count, m2 = merge_moments(mean, count, m2, *result)
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.imap_unordered(_chunk_moments, chunks)
+            for result in tqdm(results, total=len(chunks)):
+                mean, count, m2 = merge_moments(mean, count, m2, *result)
+    std = np.sqrt(m2 / (count - 1))
 
-        var_a = parallel_variance(mean_a, count_a, var_a, mean_b, count_b, var_b)
-        mean_a = (mean_a * count_a + mean_b * count_b) / (count_a + count_b)
-        count_a += count_b
-    return mean_a, np.sqrt(var_a)
+    if config is not None:
+        config['mean'] = [float(v) for v in mean]
+        config['std'] = [float(v) for v in std]
+    return mean, std
 
 
 def show_samples_and_labels_from_loader(loader, iteration=0):
@@ -454,36 +546,52 @@ def show_label(label):
     return img
 
 
-def sliding_window_vessel(model, img, patch_size, stride=1, minimum_matches=0, device='cuda:0'):
-    if isinstance(patch_size, (list, tuple)):
-        p_h, p_w = patch_size
-    else:
-        p_h = patch_size
-        p_w = patch_size
-    if isinstance(stride, (list, tuple)):
-        s_h, s_w = stride
-    else:
-        s_h = stride
-        s_w = stride
-    c, h, w = img.shape
+def sliding_window_vessel(model, img, patch_size, stride=1, minimum_matches=0, device='cuda:0', blend=None,
+                          max_batch_bytes=2**22):
+    """Vessel map of an image from a patch based segmentation model. The model runs on
+    batches of overlapping patches (see patches.tiled_inference) and the results are
+    accumulated on the device.
 
-    n_h = int((h - p_h) / s_h) + 1
-    n_w = int((w - p_w) / s_w) + 1
+    Arguments:
+        model {torch.nn.Module} -- model returning NCHW outputs with C=1 (probability) or C=2 (two class scores)
+        img {torch.Tensor} -- CHW image
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {1})
+        minimum_matches {int} -- with voting, pixels need more than this many votes to count as vessel (default: {0})
+        device {str} -- device of the model (default: {'cuda:0'})
+        blend {str} -- None for voting, 'uniform', 'gaussian' or 'hann' to return the blended vessel probability instead (default: {None})
+        max_batch_bytes {int} -- size of the input patches per model call in bytes (default: {2**22})
 
-    vessel = torch.zeros((1, h, w)) - minimum_matches
+    Returns:
+        torch.Tensor -- 1HW vessel map, with voting 1 where a vessel is found by more than minimum_matches patches
+    """
+    def votes(y):
+        if y.shape[1] == 2:
+            return (y[:, 1:, :, :] > y[:, :1, :, :]).float()
+        return y
+
+    def probabilities(y):
+        if y.shape[1] == 2:
+            return torch.softmax(y, dim=1)[:, 1:, :, :]
+        return y
+
+    if blend is not None and minimum_matches > 0:
+        raise ValueError('minimum_matches only applies to voting, not to blend {}'.format(blend))
+    n_h, n_w = grid_size(img.shape[1:], patch_size, stride)
+    x = img.to(device).unsqueeze(0)
     with tqdm(total=(n_h * n_w), desc='Vessel detection', unit='patch') as pb:
-        for ii in range(n_h):
-            for jj in range(n_w):
-                x_cuda = img[:, ii * s_h:ii * s_h + p_h, jj * s_w:jj * s_w + p_w].to(device).unsqueeze(0)
-                y_cuda = model(x_cuda)
-                if y_cuda.shape[1] == 2:
-                    label = (y_cuda[:, 1, :, :] > y_cuda[:, 0, :, :]).cpu().squeeze().float()
-                else:
-                    label = y_cuda.cpu().squeeze()
-                vessel[0, ii * s_h:ii * s_h + p_h, jj * s_w:jj * s_w + p_w] += label
-                pb.update(1)
-    vessel = torch.clamp(vessel, 0, 1)
-    return vessel
+        if blend is None:
+            vessel, _ = tiled_inference(model, x, patch_size, stride, transform=votes,
+                                        max_batch_bytes=max_batch_bytes, callback=pb.update)
+            vessel = torch.clamp(vessel[0] - minimum_matches, 0, 1)
+        else:
+            window = blend_window(patch_size, blend, device=device)
+            summed, weight = tiled_inference(model, x, patch_size, stride, weight=window, transform=probabilities,
+                                             max_batch_bytes=max_batch_bytes, callback=pb.update)
+            vessel = summed[0] / weight[0].clamp_min(1e-12)
+    return vessel.cpu()
 
 
 def denoise(img, ksize=(5, 5), morph=cv2.MORPH_RECT):
@@ -492,6 +600,78 @@ def denoise(img, ksize=(5, 5), morph=cv2.MORPH_RECT):
     return img
 
 
+def _fit_circle(points):
+    # algebraic least squares circle fit (Kasa) through Nx2 points, returns (x, y, r)
+    x, y = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+    A = np.stack((x, y, np.ones_like(x)), axis=1)
+    b = x**2 + y**2
+    (a, c, d), *_ = np.linalg.lstsq(A, b, rcond=None)
+    cx, cy = a / 2, c / 2
+    return cx, cy, np.sqrt(max(d + cx**2 + cy**2, 0))
+
+
+def _retina_from_contour(gray, min_radius, max_radius, max_distance, threshold=0.05, min_fill=0.5):
+    # threshold the dark background just above its level (the retina border is often vignetted)
+    # and fit a circle to the border of the largest bright region
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    low, high = np.percentile(blurred, (1, 99))
+    binary = ((blurred > low + threshold * (high - low)) * np.uint8(255)).astype(np.uint8)
+    binary = denoise(binary)
+    contours = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+    if len(contours) == 0:
+        return None
+    contour = max(contours, key=cv2.contourArea).reshape(-1, 2)
+
+    # points on the image border belong to a cropped retina, not to its circle
+    h, w = gray.shape
+    inner = (contour[:, 0] > 1) & (contour[:, 0] < w - 2) & (contour[:, 1] > 1) & (contour[:, 1] < h - 2)
+    if inner.sum() < 20:
+        return None
+    x, y, r = _fit_circle(contour[inner])
+
+    if not min_radius <= r <= max_radius:
+        return None
+    if np.sqrt((x - w / 2)**2 + (y - h / 2)**2) > max_distance:
+        return None
+    if cv2.contourArea(contour) < min_fill * np.pi * r**2:
+        return None
+    return np.array([x, y, r])
+
+
+def _retina_from_hough(gray, dp, min_dist, min_radius, max_radius, max_distance, params):
+    # iterates over the (param1, param2) pairs until a circle close to the center is found
+    cy, cx = np.array(gray.shape) / 2
+    for param1, param2 in params:
+        circles = cv2.HoughCircles(gray,
+                                   cv2.HOUGH_GRADIENT,
+                                   dp=dp,
+                                   minDist=min_dist,
+                                   param1=param1,
+                                   param2=param2,
+                                   minRadius=min_radius,
+                                   maxRadius=max_radius)
+        if circles is None:
+            continue
+        circles = circles[0, :]
+        dist = np.sqrt((circles[:, 0] - cx)**2 + (circles[:, 1] - cy)**2)
+        center_circle = np.argmin(dist)
+        if len(circles) == 1 or dist[center_circle] <= max_distance:
+            return circles[center_circle]
+    return None
+
+
+def _hough_parameters(param1, param2, param1_limit, param1_step, param2_limit, param2_step):
+    # first lower param1 down to its limit, then param2, like the former recursive search
+    params = [(param1, param2)]
+    while param1 > param1_limit:
+        param1 -= max(abs(param1_step), 1)
+        params.append((param1, param2))
+    while param2 > param2_limit:
+        param2 -= max(abs(param2_step), 1)
+        params.append((param1, param2))
+    return params
+
+
 def find_retina_boxes(im,
                       display=False,
                       dp=1.0,
@@ -505,11 +685,14 @@ def find_retina_boxes(im,
                       param1_limit=40,
                       param1_step=10,
                       param2_limit=20,
-                      param2_step=10):
-    '''Finds the inner and outer box around the retina using openCV
-    HoughCircles. If more than one circle is found returns the circle with the center
-    closest to the image center.
-    Recursively decreases first param1 then param2 if no circles are found until the limit for both parameter is reached.
+                      param2_step=10,
+                      method='contour'):
+    '''Finds the inner and outer box around the retina. By default the dark background is
+    thresholded and a circle is fitted to the border of the largest bright region,
+    ignoring border points on the image edge so cropped retinas are handled. If that fails
+    (e.g. no dark background) openCV HoughCircles is used as fallback. If more than one
+    circle is found it returns the circle with the center closest to the image center.
+    The Hough search decreases first param1 then param2 if no circles are found until the limit for both parameter is reached.
     Be cautious, setting the parameter limits too low will lead to very high computation time.
     For details see OpenCV documentation [https://docs.opencv.org/master/dd/d1a/group__imgproc__feature.html#ga47849c3be0d0406ad3ca45db65a25d2d]
 
@@ -526,122 +709,160 @@ def find_retina_boxes(im,
         maximum_radius {float} -- Maximum radius of the detected citcle given in patch size (default: {0.65})
         max_patch_size {int} -- Scales down the image to this size if it is larger to speed up computation (default: {800})
         max_distance_center {float} -- Maximum distance to the center of the patch given in patch size (default: {0.05})
-        param1_limit {int} -- lower bound on param1 during the recursive search if no circle is found (default: {40})
-        param1_step {int} -- step size for decreasing param1 in recursive search (default: {10})
-        param2_limit {int} -- lower bound on param2 during the recursive search if no circle is found (default: {20})
-        param2_step {int} -- step size for decreasing param2 in recursive search (default: {10})
+        param1_limit {int} -- lower bound on param1 during the Hough search if no circle is found (default: {40})
+        param1_step {int} -- step size for decreasing param1 in the Hough search (default: {10})
+        param2_limit {int} -- lower bound on param2 during the Hough search if no circle is found (default: {20})
+        param2_step {int} -- step size for decreasing param2 in the Hough search (default: {10})
+        method {str} -- 'contour' with Hough fallback or 'hough' only (default: {'contour'})
 
     Returns:
         tuple -- (x, y, r_in, r_out, img) where x,y coordinates of the box center, radius d of the inner box and radius r of the outer box, img image with circles, None if no circle is found
     '''
-
-    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    if method not in ('contour', 'hough'):
+        raise ValueError('Unknown method {}'.format(method))
+    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
     scale_factor = max(gray.shape) / max_patch_size
     shape = (int(gray.shape[0] / scale_factor), int(gray.shape[1] / scale_factor))
     gray = cv2.resize(gray.T, shape).T
-    output = None
 
     minRadius = int(min(gray.shape) * minimum_radius)
     maxRadius = int(min(gray.shape) * maximum_radius)
     minDist = int(min(gray.shape) * minimum_circle_distance)
     maxDist = int(min(gray.shape) * max_distance_center)
 
-    # detect circles in the image
-    try:
-        circles = cv2.HoughCircles(
-            gray,
-            cv2.HOUGH_GRADIENT,
-            dp=dp,
-            minDist=minDist,
-            param1=param1,
-            param2=param2,
-            minRadius=minRadius,
-            maxRadius=maxRadius)
-    except Exception as e:
-        print('Something bad happened:', e)
+    circle = None
+    if method == 'contour':
+        circle = _retina_from_contour(gray, minRadius, maxRadius, maxDist)
+    if circle is None:
+        params = _hough_parameters(param1, param2, param1_limit, param1_step, param2_limit, param2_step)
+        circle = _retina_from_hough(gray, dp, minDist, minRadius, maxRadius, maxDist, params)
+    if circle is None:
         return None
-    # ensure at least some circles were found
-
-    if circles is not None:
-        # convert the (x, y) coordinates and radius of the circles to integers
-        circles = np.round(circles[0, :]).astype("int")
-
-        center_circle = 0
-        if len(circles) > 1:
-            cy, cx = np.array(gray.shape) / 2
-            dist = np.sqrt((circles[:, 0] - cx)**2 + (circles[:, 1] - cy)**2)
-            center_circle = np.argmin(dist)
-            if dist[center_circle] > maxDist:
-                center_circle = None
-                #print(dist[center_circle], maxDist)
-
-        if display:
-            # loop over the (x, y) coordinates and radius of the circles
-            output = im.copy()
-            circles = np.round(scale_factor * circles).astype(int)
-            for (x, y, r) in circles:
-                # draw the circle in the output image, then draw a rectangle
-                # corresponding to the center of the circle
-                cv2.circle(output, (x, y), r, (0, 255, 0), 4)
-                cv2.rectangle(output, (x - 5, y - 5), (x + 5, y + 5), (0, 128, 255), -1)
-            if center_circle is not None:
-                x, y, r = circles[center_circle, :]
-                cv2.circle(output, (x, y), r, (0, 255, 255), 4)
-                cv2.rectangle(output, (x - 5, y - 5), (x + 5, y + 5), (128, 128, 255), -1)
-
-        if center_circle is not None:
-            x, y, r_out = np.round(scale_factor * circles[center_circle, :]).astype(int)
-            r_in = int(np.sqrt((r_out**2) / 2))
-            return x, y, r_in, r_out, output
-        else:
-            return None
-
-    if circles is None or center_circle is None:
-        #warnings.warn('No circles found on image')
-        if param1 > param1_limit:
-            param1 -= abs(param1_step)
-            print('Retry with param1=', param1)
-            return find_retina_boxes(
-                im,
-                display,
-                dp=dp,
-                param1=param1,
-                param2=param2,
-                minimum_circle_distance=minimum_circle_distance,
-                minimum_radius=minimum_radius,
-                maximum_radius=maximum_radius,
-                max_patch_size=max_patch_size,
-                max_distance_center=max_distance_center)
-        elif param2 > param2_limit:
-            param2 -= abs(param2_step)
-            print('Retry with param2=', param2)
-            return find_retina_boxes(
-                im,
-                display,
-                dp=dp,
-                param1=param1,
-                param2=param2,
-                minimum_circle_distance=minimum_circle_distance,
-                minimum_radius=minimum_radius,
-                maximum_radius=maximum_radius,
-                max_patch_size=max_patch_size,
-                max_distance_center=max_distance_center)
-        else:
-            print('no luck, skipping image')
 
-    return None
+    x, y, r_out = np.round(scale_factor * circle).astype(int)
+    r_in = int(np.sqrt((r_out**2) / 2))
+    output = None
+    if display:
+        output = im.copy()
+        cv2.circle(output, (x, y), r_out, (0, 255, 255), 4)
+        cv2.rectangle(output, (x - 5, y - 5), (x + 5, y + 5), (128, 128, 255), -1)
+    return x, y, r_in, r_out, output
+
+
+def find_retina_boxes_batch(images, num_workers=None, **kwargs):
+    '''find_retina_boxes for a list of images. openCV releases the GIL, so the images are
+    processed in a thread pool.
+
+    Arguments:
+        images {list} -- HWC-shaped uint8 numpy arrays
+
+    Keyword Arguments:
+        num_workers {int} -- number of threads, 0 runs sequentially (default: {None} = number of cpus)
+        kwargs -- passed to find_retina_boxes
+
+    Returns:
+        list -- result of find_retina_boxes per image
+    '''
+    if num_workers == 0 or len(images) < 2:
+        return [find_retina_boxes(im, **kwargs) for im in images]
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+        return list(pool.map(lambda im: find_retina_boxes(im, **kwargs), images))
+
+
+def circle_mask(height, width, x, y, radius):
+    '''uint8 mask with 255 inside the circle (x, y, radius) and 0 outside, all 1 if radius
+    is None.
+    '''
+    if radius is None:
+        return np.ones((height, width), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(mask, (x, y), radius - 1, (255), cv2.FILLED)
+    return mask
 
 
 def get_retina_mask(img, **kwargs):
-    mask = np.zeros((img.shape[:2]), dtype=np.uint8)
+    '''Mask of the retina found by find_retina_boxes, see circle_mask. Returns a new array.'''
     circle = find_retina_boxes(img, display=False, **kwargs)
     if circle is None:
-        return mask + 1
+        return circle_mask(*img.shape[:2], None, None, None)
     x, y, _, r_out, _ = circle
+    return circle_mask(*img.shape[:2], int(x), int(y), int(r_out))
 
-    cv2.circle(mask, (x, y), r_out - 1, (255), cv2.FILLED)
 
-    return mask
+class RetinaMasks():
+    '''Retina masks for batches of images. In camera profile mode the circle is only detected
+    on the first image of a profile (e.g. the camera model) and this template is reused, scaled
+    to the image size, for all further images of the profile. The masks of the templates are
+    cached per image size up to max_bytes, least recently used masks are dropped first.
+
+    Keyword Arguments:
+        profiles {dict} -- known templates, profile -> (x, y, radius, height, width) as in the retina index (default: {None})
+        num_workers {int} -- threads for the circle detection, see find_retina_boxes_batch (default: {None})
+        max_bytes {int} -- size of the cached template masks in bytes (default: {2**28})
+        kwargs -- passed to find_retina_boxes
+    '''
+
+    def __init__(self, profiles=None, num_workers=None, max_bytes=2**28, **kwargs):
+        self.profiles = dict(profiles) if profiles is not None else dict()
+        self.num_workers = num_workers
+        self.max_bytes = max_bytes
+        self.kwargs = kwargs
+        # (height, width, template) -> read-only mask, in order of use
+        self._masks = collections.OrderedDict()
+
+    def _template(self, profile, img):
+        if profile not in self.profiles:
+            circle = find_retina_boxes(img, **self.kwargs)
+            if circle is None:
+                self.profiles[profile] = None
+            else:
+                self.profiles[profile] = (int(circle[0]), int(circle[1]), int(circle[3]), img.shape[0], img.shape[1])
+        return self.profiles[profile]
+
+    def _mask(self, shape, circle):
+        # circle is (x, y, radius, height, width) of the image it was found in
+        height, width = shape[:2]
+        if circle is None:
+            return circle_mask(height, width, None, None, None)
+        x, y, radius, c_height, c_width = circle
+        if (c_height, c_width) != (height, width):
+            scale_x, scale_y = width / c_width, height / c_height
+            x, y, radius = x * scale_x, y * scale_y, radius * min(scale_x, scale_y)
+        return circle_mask(height, width, int(round(x)), int(round(y)), int(round(radius)))
+
+    def _template_mask(self, shape, template):
+        key = (shape[0], shape[1], template)
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+        mask = self._mask(shape, template)
+        mask.setflags(write=False)
+        self._masks[key] = mask
+        while len(self._masks) > 1 and sum(m.nbytes for m in self._masks.values()) > self.max_bytes:
+            self._masks.popitem(last=False)
+        return mask
+
+    def __call__(self, images, profile=None):
+        '''Masks for a list of HWC (or HW) uint8 images.
+
+        Arguments:
+            images {list} -- numpy arrays
+
+        Keyword Arguments:
+            profile {hashable} -- camera profile of all images (default: {None} = detect per image)
+
+        Returns:
+            list -- uint8 masks, the cached masks of a profile are shared and read-only
+        '''
+        if profile is not None:
+            template = self._template(profile, images[0])
+            return [self._template_mask(img.shape, template) for img in images]
+
+        circles = find_retina_boxes_batch(images, num_workers=self.num_workers, **self.kwargs)
+        return [
+            self._mask(img.shape, None if c is None else (c[0], c[1], c[3], img.shape[0], img.shape[1]))
+            for img, c in zip(images, circles)
+        ]
 
 
 def denormalize_transform(trans):
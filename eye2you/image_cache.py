@@ -0,0 +1,136 @@
+import hashlib
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .helper_functions import draft_image, pil_loader
+
+# columns of the entry table
+KEY, MTIME, OFFSET, NBYTES, HEIGHT, WIDTH, CHANNELS, LAST_USED = range(8)
+CACHE_MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+
+def _path_key(path):
+    digest = hashlib.blake2b(str(path).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class SharedImageCache():
+    '''Least recently used cache for decoded images that can be used as loader for
+    TripleDataset. Decoded uint8 arrays are stored in a shared memory arena so all
+    DataLoader workers see the images decoded by any other worker. Entries are keyed by
+    file path and modification time, changed files are decoded again. JPEG images requested
+    with a draft size are decoded at reduced resolution and cached separately per size.
+
+    Arguments:
+        max_bytes {int} -- size of the shared memory arena in bytes
+
+    Keyword Arguments:
+        max_entries {int} -- maximum number of cached images (default: {4096})
+        loader {callable} -- loader used on cache misses (default: {pil_loader})
+    '''
+
+    def __init__(self, max_bytes, max_entries=4096, loader=pil_loader):
+        self.max_bytes = int(max_bytes)
+        self.max_entries = int(max_entries)
+        self.loader = loader
+
+        self._arena = torch.empty(self.max_bytes, dtype=torch.uint8).share_memory_()
+        self._table = torch.full((self.max_entries, 8), -1, dtype=torch.int64).share_memory_()
+        # hits, misses, access clock
+        self._counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self._lock = multiprocessing.Lock()
+
+    def __call__(self, path, mode=None, draft=None):
+        '''Decoded image of path, see draft_image for the draft (height, width).'''
+        if draft is None:
+            key = _path_key(path)
+        else:
+            key = _path_key('{}@{}x{}'.format(path, *draft))
+        mtime = os.stat(path).st_mtime_ns
+
+        img = self._lookup(key, mtime)
+        if img is None:
+            img = draft_image(self.loader(path), draft)
+            if len(img.getbands()) in CACHE_MODES and img.mode == CACHE_MODES[len(img.getbands())]:
+                arr = np.asarray(img)
+                img = Image.fromarray(arr)
+                if arr.nbytes <= self.max_bytes:
+                    self._insert(key, mtime, arr)
+
+        if mode is None:
+            return img
+        return img.convert(mode)
+
+    def _lookup(self, key, mtime):
+        table = self._table.numpy()
+        counters = self._counters.numpy()
+        with self._lock:
+            rows = np.flatnonzero((table[:, KEY] == key) & (table[:, NBYTES] >= 0))
+            if len(rows) == 0 or table[rows[0], MTIME] != mtime:
+                counters[1] += 1
+                return None
+            row = table[rows[0]]
+            counters[0] += 1
+            counters[2] += 1
+            row[LAST_USED] = counters[2]
+            shape = (row[HEIGHT], row[WIDTH], row[CHANNELS]) if row[CHANNELS] > 1 else (row[HEIGHT], row[WIDTH])
+            arr = self._arena.numpy()[row[OFFSET]:row[OFFSET] + row[NBYTES]].reshape(shape).copy()
+        return Image.fromarray(arr)
+
+    def _insert(self, key, mtime, arr):
+        table = self._table.numpy()
+        counters = self._counters.numpy()
+        with self._lock:
+            # drop stale entries of modified files (or entries added by another worker meanwhile)
+            table[(table[:, KEY] == key), NBYTES] = -1
+            row, offset = self._allocate(arr.nbytes)
+            self._arena.numpy()[offset:offset + arr.nbytes] = arr.reshape(-1)
+            counters[2] += 1
+            channels = arr.shape[2] if arr.ndim == 3 else 1
+            table[row] = (key, mtime, offset, arr.nbytes, arr.shape[0], arr.shape[1], channels, counters[2])
+
+    def _allocate(self, nbytes):
+        table = self._table.numpy()
+        while True:
+            valid = np.flatnonzero(table[:, NBYTES] >= 0)
+            free_rows = np.flatnonzero(table[:, NBYTES] < 0)
+            if len(free_rows) > 0:
+                entries = table[valid]
+                entries = entries[np.argsort(entries[:, OFFSET])]
+                gap_start = np.concatenate(([0], entries[:, OFFSET] + entries[:, NBYTES]))
+                gap_end = np.concatenate((entries[:, OFFSET], [self.max_bytes]))
+                gaps = np.flatnonzero(gap_end - gap_start >= nbytes)
+                if len(gaps) > 0:
+                    return free_rows[0], gap_start[gaps[0]]
+            # evict least recently used entry
+            lru = valid[np.argmin(table[valid, LAST_USED])]
+            table[lru, NBYTES] = -1
+
+    def clear(self):
+        with self._lock:
+            self._table.fill_(-1)
+            self._counters.zero_()
+
+    @property
+    def hits(self):
+        return int(self._counters[0])
+
+    @property
+    def misses(self):
+        return int(self._counters[1])
+
+    @property
+    def nbytes(self):
+        table = self._table.numpy()
+        return int(table[table[:, NBYTES] >= 0, NBYTES].sum())
+
+    def __len__(self):
+        return int((self._table[:, NBYTES] >= 0).sum())
+
+    def __str__(self):
+        return 'SharedImageCache: {} entries, {}/{} bytes, {} hits, {} misses'.format(
+            len(self), self.nbytes, self.max_bytes, self.hits, self.misses)
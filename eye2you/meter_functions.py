@@ -308,6 +308,12 @@ class PerformanceMeter():
     def value(self):
         raise NotImplementedError
 
+    def merge(self, other):
+        '''
+        Adds the state of another meter of the same type, e.g. from another process
+        '''
+        raise NotImplementedError
+
     def __repr__(self):
         '''
         This should return a string that, when called with eval(), creates the same PerformanceMeter
@@ -346,6 +352,10 @@ class TotalAccuracyMeter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -382,6 +392,10 @@ class SingleAccuracyMeter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -418,6 +432,10 @@ class SingleSensitivityMeter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -454,6 +472,10 @@ class SingleSpecificityMeter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -490,6 +512,10 @@ class SinglePrecisionMeter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -526,6 +552,10 @@ class SingleF1Meter(PerformanceMeter):
         self.total = 0
         self.correct = 0
 
+    def merge(self, other):
+        self.total += other.total
+        self.correct += other.correct
+
     def value(self):
         if self.total == 0:
             return 0
@@ -560,6 +590,10 @@ class ROCAUCMeter(PerformanceMeter):
         self.outputs = []
         self.targets = []
 
+    def merge(self, other):
+        self.outputs.extend(other.outputs)
+        self.targets.extend(other.targets)
+
     def value(self):
         if len(self.outputs) == 0:
             return 0
@@ -600,6 +634,9 @@ class SegmentationAccuracyMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationAccuracyMeter()'
 
@@ -626,6 +663,9 @@ class SegmentationPrecisionMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationPrecisionMeter()'
 
@@ -652,6 +692,9 @@ class SegmentationRecallMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationRecallMeter()'
 
@@ -678,6 +721,9 @@ class SegmentationSpecificityMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationSpecificityMeter()'
 
@@ -704,6 +750,9 @@ class SegmentationIOUMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationIOUMeter()'
 
@@ -730,6 +779,9 @@ class SegmentationDiceMeter(PerformanceMeter):
     def reset(self):
         self.results = []
 
+    def merge(self, other):
+        self.results.extend(other.results)
+
     def __repr__(self):
         return 'SegmentationDiceMeter()'
 
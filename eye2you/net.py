@@ -1,7 +1,9 @@
 import sys
+import contextlib
 import copy
 import warnings
 
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim
 
@@ -17,6 +19,31 @@ if 'IPython' in sys.modules:
 else:
     from tqdm import tqdm
 
+
+# autocast data types of the amp option, True selects bfloat16
+AMP_DTYPES = {'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def _float_outputs(outputs):
+    # meters and logs work on float32, autocast returns half precision outputs
+    if isinstance(outputs, tuple):
+        return tuple(o.float() for o in outputs)
+    return outputs.float()
+
+
+def _synchronize(total_loss, num_samples, performance_meters):
+    # sums loss and samples over all processes and merges the meter states in every process
+    totals = torch.tensor([total_loss, num_samples], dtype=torch.float64)
+    dist.all_reduce(totals)
+    for meter in performance_meters:
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, meter)
+        meter.reset()
+        for state in states:
+            meter.merge(state)
+    return totals[0].item(), totals[1].item()
+
+
 class Network():
 
     def __init__(self,
@@ -30,7 +57,8 @@ class Network():
                  optimizer_kwargs=None,
                  use_scheduler=False,
                  scheduler_kwargs=None,
-                 target_labels=None):
+                 target_labels=None,
+                 amp=False):
 
         self.device = device
 
@@ -53,6 +81,17 @@ class Network():
 
         self.target_labels = target_labels
 
+        # optional datasets.BatchAugmentation applied to every training batch on the device
+        self.augmentation = None
+
+        # mixed precision: autocast of forward and loss, gradient scaling is only needed for float16
+        if amp is True:
+            amp = 'bfloat16'
+        if amp and amp not in AMP_DTYPES:
+            raise ValueError('amp must be one of {}, got {}'.format(list(AMP_DTYPES), amp))
+        self.amp = amp if amp else False
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.amp == 'float16')
+
         self.initialize(model_kwargs=model_kwargs,
                         criterion_kwargs=criterion_kwargs,
                         optimizer_kwargs=optimizer_kwargs,
@@ -119,7 +158,57 @@ class Network():
         if use_scheduler:
             self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, **scheduler_kwargs)
 
-    def train(self, loader, position=None):
+    @property
+    def distributed(self):
+        return isinstance(self.model, nn.parallel.DistributedDataParallel)
+
+    @property
+    def module(self):
+        '''The model without a DistributedDataParallel wrapper.'''
+        return self.model.module if self.distributed else self.model
+
+    @property
+    def _quiet(self):
+        # only the first process shows progress
+        return self.distributed and dist.get_rank() > 0
+
+    def distribute(self, **kwargs):
+        '''Wraps the model in DistributedDataParallel for training in the initialized process
+        group. Losses and meters of train and validate are then reduced over all processes.
+
+        Keyword Arguments:
+            kwargs -- passed to DistributedDataParallel
+        '''
+        if not self.distributed:
+            self.model = nn.parallel.DistributedDataParallel(self.model, **kwargs)
+        return self
+
+    @property
+    def device_type(self):
+        return torch.device(self.device).type
+
+    def autocast(self):
+        '''Autocast context for the device of the network, disabled without amp.'''
+        if not self.amp:
+            return torch.autocast(self.device_type, enabled=False)
+        return torch.autocast(self.device_type, dtype=AMP_DTYPES[self.amp])
+
+    def train(self, loader, position=None, accumulation_steps=1):
+        '''Trains the model for one epoch.
+
+        Arguments:
+            loader {torch.utils.data.DataLoader} -- training data
+
+        Keyword Arguments:
+            position {int} -- position of the progress bar (default: {None})
+            accumulation_steps {int} -- micro-batches per optimizer step, the gradients of
+                each step are those of the mean loss over all its samples (default: {1})
+
+        Returns:
+            tuple -- mean loss and values of the performance meters
+        '''
+        if accumulation_steps < 1:
+            raise ValueError('accumulation_steps must be at least 1, got {}'.format(accumulation_steps))
         if self.optimizer is None or self.criterion is None:
             raise ValueError('No optimizer and/or criterion defined. Cannot run training.')
         self.model.train()
@@ -129,49 +218,89 @@ class Network():
         self.target_labels = loader.dataset.target_labels
 
         total_loss = 0
-        num_batches = int(loader.sampler.num_samples / loader.batch_size)
-        num_samples = num_batches * loader.batch_size  #due to drop_last it's not len(loader.dataset)
+        # batch samplers may return batches of different size, samples are counted while iterating
+        num_samples = 0
+        num_batches = len(loader)
 
         for perf_meter in self.performance_meters:
             perf_meter.reset()
 
-        pbar = tqdm(total=num_batches, leave=False, desc='Train', position=position)
-        for source, target in loader:
+        pbar = tqdm(total=num_batches, leave=False, desc='Train', position=position, disable=self._quiet)
+        accumulated = 0
+        step_samples = 0
+        self.optimizer.zero_grad()
+        for batch, (source, target) in enumerate(loader):
             if isinstance(source, (tuple, list)):
-                source = [v.to(self.device) for v in source]
+                source = [v.to(self.device) if v is not None else None for v in source]
             else:
                 source = [source.to(self.device)]
             target = target.to(self.device).float()
+            num_samples += target.shape[0]
 
-            outputs = self.model(*source)
+            if self.augmentation is not None:
+                source, target = self.augmentation.apply(source, target)
 
-            if isinstance(outputs, tuple):
-                #TODO: Check if the division by length of outputs make a notable difference
-                loss = sum((self.criterion(o, target) for o in outputs))
-                total_loss += loss.item() * target.shape[0] / len(outputs)
-            else:
-                loss = self.criterion(outputs, target)
-                total_loss += loss.item() * target.shape[0]
+            # the last optimizer step of an epoch may span fewer micro-batches
+            group_size = min(accumulation_steps, max(num_batches - (batch - accumulated), 1))
+
+            with self.autocast():
+                outputs = self.model(*source)
+
+                if isinstance(outputs, tuple):
+                    #TODO: Check if the division by length of outputs make a notable difference
+                    loss = sum((self.criterion(o, target) for o in outputs))
+                    total_loss += loss.item() * target.shape[0] / len(outputs)
+                else:
+                    loss = self.criterion(outputs, target)
+                    total_loss += loss.item() * target.shape[0]
+            outputs = _float_outputs(outputs)
             for perf_meter in self.performance_meters:
                 if isinstance(outputs, tuple):
                     perf_meter.update(outputs[0], target)
                 else:
                     perf_meter.update(outputs, target)
 
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            # micro-batches of a step are summed over their samples and divided in _optimizer_step
+            if group_size > 1:
+                loss = loss * target.shape[0]
+                step_samples += target.shape[0]
+            # gradients are only averaged between processes for the last micro-batch of a step
+            if self.distributed and accumulated + 1 < group_size:
+                sync = self.model.no_sync()
+            else:
+                sync = contextlib.nullcontext()
+            with sync:
+                self.scaler.scale(loss).backward()
+            accumulated += 1
+            if accumulated >= group_size:
+                self._optimizer_step(step_samples)
+                accumulated = 0
+                step_samples = 0
 
             pbar.update(1)
+        if accumulated > 0:
+            self._optimizer_step(step_samples)
 
+        if self.distributed:
+            total_loss, num_samples = _synchronize(total_loss, num_samples, self.performance_meters)
         return (total_loss / num_samples, *[p.value() for p in self.performance_meters])
 
+    def _optimizer_step(self, num_samples=0):
+        # gradients of accumulated micro-batches are sums over their samples
+        if num_samples > 0:
+            for param in self.model.parameters():
+                if param.grad is not None:
+                    param.grad.div_(num_samples)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+
     def validate(self, loader, position=None):
         self.model.eval()
 
         total_loss = 0
-        num_samples = loader.sampler.num_samples
-        num_batches = int(loader.sampler.num_samples / loader.batch_size)
+        num_samples = 0
+        num_batches = len(loader)
 
         if self.target_labels is None:
             self.target_labels = loader.dataset.target_labels
@@ -180,37 +309,44 @@ class Network():
             perf_meter.reset()
 
         with torch.no_grad():
-            pbar = tqdm(total=num_batches, leave=False, desc='Validate', position=position)
+            pbar = tqdm(total=num_batches, leave=False, desc='Validate', position=position, disable=self._quiet)
             for source, target in loader:
                 if isinstance(source, (tuple, list)):
-                    source = [v.to(self.device) for v in source]
+                    source = [v.to(self.device) if v is not None else None for v in source]
                 else:
                     source = [source.to(self.device)]
                 target = target.to(self.device).float()
+                num_samples += target.shape[0]
 
-                output = self.model(*source)
+                with self.autocast():
+                    output = self.model(*source)
 
-                if self.criterion is not None:
-                    loss = self.criterion(output, target)
-                    total_loss += loss.item() * target.shape[0]
+                    if self.criterion is not None:
+                        loss = self.criterion(output, target)
+                        total_loss += loss.item() * target.shape[0]
+                output = _float_outputs(output)
                 for perf_meter in self.performance_meters:
                     perf_meter.update(output, target)
 
                 pbar.update(1)
 
+        if self.distributed:
+            total_loss, num_samples = _synchronize(total_loss, num_samples, self.performance_meters)
         return (total_loss / num_samples, *[p.value() for p in self.performance_meters])
 
     def load_state_dict(self, checkpoint):
-        self.model.load_state_dict(checkpoint['model'])
+        self.module.load_state_dict(checkpoint['model'])
         if 'optimizer' in checkpoint:
             self.optimizer.load_state_dict(checkpoint['optimizer'])
         if 'scheduler' in checkpoint:
             self.scheduler.load_state_dict(checkpoint['scheduler'])
+        if 'scaler' in checkpoint and self.scaler.is_enabled():
+            self.scaler.load_state_dict(checkpoint['scaler'])
 
     def get_state_dict(self):
         state_dict = dict()
         state_dict['device'] = self.device
-        state_dict['model'] = self.model.state_dict()
+        state_dict['model'] = self.module.state_dict()
         state_dict['model_name'] = self.model_name
         state_dict['model_kwargs'] = self.model_kwargs
         if self.optimizer is not None:
@@ -225,6 +361,10 @@ class Network():
             state_dict['criterion_kwargs'] = self.criterion_kwargs
         state_dict['performance_meters'] = [repr(p) for p in self.performance_meters]
         state_dict['target_labels'] = self.target_labels
+        # the weights stay float32 with amp, the checkpoint loads without it
+        state_dict['amp'] = self.amp
+        if self.scaler.is_enabled():
+            state_dict['scaler'] = self.scaler.state_dict()
         return state_dict
 
     @staticmethod
@@ -272,7 +412,8 @@ class Network():
                       optimizer_kwargs=optimizer_kwargs,
                       use_scheduler=use_scheduler,
                       scheduler_kwargs=scheduler_kwargs,
-                      target_labels=target_labels)
+                      target_labels=target_labels,
+                      amp=state_dict.get('amp', False))
         net.load_state_dict(state_dict)
         return net
 
@@ -0,0 +1,224 @@
+import torch
+import torch.nn.functional as F
+
+
+def _pair(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return (value, value)
+
+
+def grid_size(size, patch_size, stride=None):
+    '''Number of (rows, columns) of patches that fit into an image without padding.
+
+    Arguments:
+        size {tuple} -- (height, width) of the image
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {None} = patch_size)
+
+    Returns:
+        tuple -- (n_h, n_w)
+    '''
+    h, w = _pair(size)
+    p_h, p_w = _pair(patch_size)
+    s_h, s_w = _pair(patch_size if stride is None else stride)
+    return (h - p_h) // s_h + 1, (w - p_w) // s_w + 1
+
+
+def sliding_window_view(imgs, patch_size, stride=None):
+    '''Strided view of all patches of a batch of images, nothing is copied.
+    Pixels at the bottom and right that do not fill a patch are skipped.
+
+    Arguments:
+        imgs {torch.Tensor} -- NCHW images
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {None} = patch_size)
+
+    Returns:
+        torch.Tensor -- view of shape (N, n_h, n_w, C, p_h, p_w)
+    '''
+    p_h, p_w = _pair(patch_size)
+    s_h, s_w = _pair(patch_size if stride is None else stride)
+    return imgs.unfold(2, p_h, s_h).unfold(3, p_w, s_w).permute(0, 2, 3, 1, 4, 5)
+
+
+def split_patches(imgs, patch_size, stride=None):
+    '''Patches of a batch of images in row major order per image.
+
+    Arguments:
+        imgs {torch.Tensor} -- NCHW images
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {None} = patch_size)
+
+    Returns:
+        torch.Tensor -- (N * n_h * n_w, C, p_h, p_w) patches
+    '''
+    view = sliding_window_view(imgs, patch_size, stride)
+    return view.reshape(-1, *view.shape[3:])
+
+
+def merge_patches(patches, grid):
+    '''Inverse of split_patches for non-overlapping patches.
+
+    Arguments:
+        patches {torch.Tensor} -- (N * n_h * n_w, C, p_h, p_w) patches
+        grid {tuple} -- (n_h, n_w) patches per column and row
+
+    Returns:
+        torch.Tensor -- NCHW images of size (n_h * p_h, n_w * p_w)
+    '''
+    n_h, n_w = grid
+    _, c, p_h, p_w = patches.shape
+    imgs = patches.reshape(-1, n_h, n_w, c, p_h, p_w).permute(0, 3, 1, 4, 2, 5)
+    return imgs.reshape(-1, c, n_h * p_h, n_w * p_w)
+
+
+def fold_patches(patches, size, stride=None, weight=None):
+    '''Sums (possibly overlapping) patches in row major order back into images, together
+    with the number of patches (or sum of weights) covering each pixel.
+
+    Arguments:
+        patches {torch.Tensor} -- (N * n_h * n_w, C, p_h, p_w) patches
+        size {tuple} -- (height, width) of the images
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {None} = patch size)
+        weight {torch.Tensor} -- (p_h, p_w) weight every patch is multiplied with (default: {None})
+
+    Returns:
+        tuple -- NCHW sum of the patches and N1HW count (or weight) map
+    '''
+    _, c, p_h, p_w = patches.shape
+    size = _pair(size)
+    stride = (p_h, p_w) if stride is None else _pair(stride)
+    n_h, n_w = grid_size(size, (p_h, p_w), stride)
+    if weight is None:
+        weight = torch.ones((p_h, p_w), dtype=patches.dtype, device=patches.device)
+    else:
+        patches = patches * weight
+    num_images = patches.shape[0] // (n_h * n_w)
+
+    if p_h % stride[0] == 0 and p_w % stride[1] == 0:
+        summed = _grouped_fold(patches.reshape(num_images, n_h, n_w, c, p_h, p_w), size, stride)
+        count = _grouped_fold(weight.expand(1, n_h, n_w, 1, p_h, p_w), size, stride)
+    else:
+        # fold expects (N, C * p_h * p_w, L) columns
+        columns = patches.reshape(num_images, n_h * n_w, c * p_h * p_w).transpose(1, 2)
+        summed = F.fold(columns, size, (p_h, p_w), stride=stride)
+        count = F.fold(weight.reshape(1, -1, 1).expand(1, p_h * p_w, n_h * n_w), size, (p_h, p_w), stride=stride)
+    return summed, count.expand(num_images, -1, -1, -1)
+
+
+def _grouped_fold(grid, size, stride):
+    # fold for patch sizes divisible by the stride: the patches in every k-th row and column
+    # of the grid do not overlap, so each such group is merged into a tile by a reshape and
+    # added to the output at its offset. Much faster than F.fold on the CPU.
+    num_images, n_h, n_w, c, p_h, p_w = grid.shape
+    s_h, s_w = stride
+    k_h, k_w = p_h // s_h, p_w // s_w
+    out = torch.zeros((num_images, c) + tuple(size), dtype=grid.dtype, device=grid.device)
+    for a in range(min(k_h, n_h)):
+        for b in range(min(k_w, n_w)):
+            group = grid[:, a::k_h, b::k_w]
+            g_h, g_w = group.shape[1:3]
+            tile = group.permute(0, 3, 1, 4, 2, 5).reshape(num_images, c, g_h * p_h, g_w * p_w)
+            out[:, :, a * s_h:a * s_h + g_h * p_h, b * s_w:b * s_w + g_w * p_w] += tile
+    return out
+
+
+def blend_window(patch_size, mode='uniform', sigma_scale=0.125, dtype=torch.float32, device=None):
+    '''Weight for blending overlapping patch predictions. Pixels near the patch centre get
+    larger weights than the borders, where predictions lack context.
+
+    Arguments:
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        mode {str} -- 'uniform', 'gaussian' or 'hann' (default: {'uniform'})
+        sigma_scale {float} -- standard deviation of the gaussian relative to the patch size (default: {0.125})
+        dtype {torch.dtype} -- (default: {torch.float32})
+        device {torch.device} -- (default: {None})
+
+    Returns:
+        torch.Tensor -- (p_h, p_w) weight, maximum 1 and positive everywhere
+    '''
+    p_h, p_w = _pair(patch_size)
+    if mode == 'uniform':
+        return torch.ones((p_h, p_w), dtype=dtype, device=device)
+    if mode == 'gaussian':
+        rows = [torch.exp(-0.5 * ((torch.arange(p, dtype=torch.float64) - (p - 1) / 2) / (sigma_scale * p))**2)
+                for p in (p_h, p_w)]
+    elif mode == 'hann':
+        # drop the zero end points so border pixels of the image keep a weight
+        rows = [torch.hann_window(p + 2, periodic=False, dtype=torch.float64)[1:-1] for p in (p_h, p_w)]
+    else:
+        raise ValueError('Unknown blend mode {}'.format(mode))
+    weight = torch.outer(rows[0], rows[1]).clamp_min(1e-3)
+    return (weight / weight.max()).to(dtype=dtype, device=device)
+
+
+def tiled_inference(model, imgs, patch_size, stride=None, weight=None, transform=None, max_batch_bytes=2**22,
+                    callback=None):
+    '''Runs a segmentation model on all (overlapping) patches of a batch of images and sums
+    the weighted patch outputs on the model's device. Patches are taken from a strided view
+    and processed in blocks of whole grid rows (or part of a row) whose input fits into
+    max_batch_bytes, so every model call sees a full batch. The model has to return outputs
+    with the spatial size of its input.
+
+    Arguments:
+        model {torch.nn.Module} -- segmentation model
+        imgs {torch.Tensor} -- NCHW images, on the model's device
+        patch_size {int} -- edge length or (height, width) of the patches
+
+    Keyword Arguments:
+        stride {int} -- step between patches, or (step_h, step_w) (default: {None} = patch_size)
+        weight {torch.Tensor} -- (p_h, p_w) blending weight, see blend_window (default: {None} = uniform)
+        transform {callable} -- applied to every batch of model outputs before summing (default: {None})
+        max_batch_bytes {int} -- size of the input patches per model call in bytes (default: {2**22})
+        callback {callable} -- called with the number of patches after every model call (default: {None})
+
+    Returns:
+        tuple -- NCHW sum of the weighted outputs and N1HW sum of the weights, see fold_patches
+    '''
+    p_h, p_w = _pair(patch_size)
+    stride = (p_h, p_w) if stride is None else _pair(stride)
+    num_images, c, h, w = imgs.shape
+    n_h, n_w = grid_size((h, w), (p_h, p_w), stride)
+    patch_bytes = c * p_h * p_w * imgs.element_size()
+    rows = max(1, max_batch_bytes // (patch_bytes * n_w))
+    cols = n_w if rows > 1 else max(1, min(n_w, max_batch_bytes // patch_bytes))
+
+    windows = sliding_window_view(imgs, (p_h, p_w), stride)
+    summed = None
+    count = None
+    with torch.no_grad():
+        for ii in range(num_images):
+            for r0 in range(0, n_h, rows):
+                for c0 in range(0, n_w, cols):
+                    block = windows[ii, r0:r0 + rows, c0:c0 + cols]
+                    b_h, b_w = block.shape[:2]
+                    out = model(block.reshape(-1, c, p_h, p_w))
+                    if transform is not None:
+                        out = transform(out)
+                    if out.shape[2:] != (p_h, p_w):
+                        raise ValueError('Model output {} does not match the patch size {}'.format(
+                            tuple(out.shape[2:]), (p_h, p_w)))
+                    if summed is None:
+                        summed = torch.zeros((num_images, out.shape[1], h, w), dtype=out.dtype, device=out.device)
+                        count = torch.zeros((num_images, 1, h, w), dtype=out.dtype, device=out.device)
+                    if weight is not None:
+                        weight = weight.to(dtype=out.dtype, device=out.device)
+                    region = ((b_h - 1) * stride[0] + p_h, (b_w - 1) * stride[1] + p_w)
+                    y0, x0 = r0 * stride[0], c0 * stride[1]
+                    block_sum, block_count = fold_patches(out, region, stride, weight=weight)
+                    summed[ii, :, y0:y0 + region[0], x0:x0 + region[1]] += block_sum[0]
+                    count[ii, :, y0:y0 + region[0], x0:x0 + region[1]] += block_count[0]
+                    if callback is not None:
+                        callback(b_h * b_w)
+    return summed, count
@@ -0,0 +1,196 @@
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def sample_classes(targets, relevant_slice=None):
+    '''Class of each sample for class balanced sampling. A sample belongs to the last
+    relevant class whose target is 1, samples without any such class get -1.
+
+    Arguments:
+        targets {numpy.array} -- NxC array of class labels
+
+    Keyword Arguments:
+        relevant_slice {list} -- columns to consider (default: {None} = all)
+
+    Returns:
+        numpy.array -- N class indices into relevant_slice
+    '''
+    targets = np.asarray(targets)
+    if relevant_slice is None:
+        relevant_slice = range(targets.shape[1])
+    hits = targets[:, list(relevant_slice)] == 1
+    last = hits.shape[1] - 1 - np.argmax(hits[:, ::-1], axis=1)
+    return np.where(hits.any(1), last, -1)
+
+
+def class_balanced_weights(targets, relevant_slice=None):
+    '''Sampling probability of each sample so that every relevant class is drawn equally
+    often, see factory.get_equal_sampler. Samples without a relevant class get 0.
+
+    Arguments:
+        targets {numpy.array} -- NxC array of class labels
+
+    Keyword Arguments:
+        relevant_slice {list} -- columns to consider (default: {None} = all)
+
+    Returns:
+        numpy.array -- N probabilities summing to 1
+    '''
+    targets = np.asarray(targets)
+    if relevant_slice is None:
+        relevant_slice = range(targets.shape[1])
+    weights = (targets[:, list(relevant_slice)] == 1).mean(0)
+    inverted_weights = (1 / weights) / np.sum(1 / weights)
+
+    # samples in several classes get the weight of the last one, samples in none are never drawn
+    classes = sample_classes(targets, relevant_slice)
+    sampling_weights = np.where(classes >= 0, inverted_weights[classes], 0)
+    return sampling_weights / sampling_weights.sum()
+
+
+class DistributedWeightedSampler(torch.utils.data.Sampler):
+    '''Sampler for data parallel training. All processes draw the same num_samples indices
+    with the given weights from a generator seeded with seed + epoch, and each process takes
+    every num_replicas-th of them. The drawn samples are padded by repetition to a multiple
+    of num_replicas. Call set_epoch before every epoch to draw new samples.
+
+    Arguments:
+        weights {numpy.array} -- sampling weight of each sample, e.g. class_balanced_weights
+
+    Keyword Arguments:
+        num_samples {int} -- samples per epoch over all processes (default: {None} = number of weights)
+        replacement {bool} -- draw with replacement (default: {True})
+        num_replicas {int} -- number of processes (default: {None} = world size)
+        rank {int} -- rank of this process (default: {None} = current rank)
+        seed {int} -- seed shared by all processes (default: {0})
+    '''
+
+    def __init__(self, weights, num_samples=None, replacement=True, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.weights = torch.as_tensor(np.asarray(weights), dtype=torch.float64)
+        self.total_samples = len(self.weights) if num_samples is None else num_samples
+        self.replacement = replacement
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # samples of this process
+        self.num_samples = -(-self.total_samples // num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(self.weights, self.total_samples, self.replacement, generator=generator)
+        indices = indices[torch.arange(self.num_samples * self.num_replicas) % len(indices)]
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class StratifiedBatchSampler(torch.utils.data.Sampler):
+    '''Batch sampler drawing the same number of samples from every class in each batch.
+    If the batch size is not divisible by the number of classes, the remaining places go
+    to randomly chosen classes. Every class has a shuffled pool of its sample indices that
+    is drawn without replacement and reshuffled when exhausted.
+
+    Arguments:
+        classes {numpy.array} -- class index of each sample as returned by sample_classes, negative entries are never drawn
+        batch_size {int} -- samples per batch
+        num_batches {int} -- batches per epoch
+
+    Keyword Arguments:
+        seed {int} -- seed for the random generator (default: {None})
+    '''
+
+    def __init__(self, classes, batch_size, num_batches, seed=None):
+        classes = np.asarray(classes)
+        self.pools = [np.flatnonzero(classes == c) for c in np.unique(classes[classes >= 0])]
+        if len(self.pools) == 0:
+            raise ValueError('No samples with a class to draw from')
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.rng = np.random.default_rng(seed)
+        self._positions = [len(pool) for pool in self.pools]
+
+    def _draw(self, c, num):
+        pool = self.pools[c]
+        res = []
+        while num > 0:
+            if self._positions[c] >= len(pool):
+                # a new permutation, the chunks drawn before are views of the old one
+                pool = self.rng.permutation(pool)
+                self.pools[c] = pool
+                self._positions[c] = 0
+            chunk = pool[self._positions[c]:self._positions[c] + num]
+            self._positions[c] += len(chunk)
+            num -= len(chunk)
+            res.append(chunk)
+        return res
+
+    def quotas(self):
+        '''Number of samples per class for the next batch.'''
+        num_classes = len(self.pools)
+        quotas = np.full(num_classes, self.batch_size // num_classes)
+        quotas[self.rng.choice(num_classes, self.batch_size % num_classes, replace=False)] += 1
+        return quotas
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            batch = np.concatenate([chunk for c, num in enumerate(self.quotas()) for chunk in self._draw(c, num)])
+            self.rng.shuffle(batch)
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    '''Batch sampler that only puts samples of similar size into one batch. Samples are
+    grouped into buckets by their (height, width) rounded up to a multiple of granularity,
+    each epoch the buckets are shuffled and cut into batches and the batches shuffled.
+
+    Arguments:
+        sizes {numpy.array} -- Nx2 array of (height, width) per sample, see factory.load_size_index
+        batch_size {int} -- maximum samples per batch
+
+    Keyword Arguments:
+        granularity {int} -- bucket edge length in pixels (default: {32})
+        drop_last {bool} -- drop incomplete batches of each bucket (default: {False})
+        shuffle {bool} -- (default: {True})
+        seed {int} -- seed for the random generator (default: {None})
+    '''
+
+    def __init__(self, sizes, batch_size, granularity=32, drop_last=False, shuffle=True, seed=None):
+        sizes = np.asarray(sizes)
+        keys = -(-sizes // granularity)
+        _, bucket = np.unique(keys, axis=0, return_inverse=True)
+        bucket = bucket.reshape(-1)
+        self.buckets = [np.flatnonzero(bucket == b) for b in range(bucket.max() + 1)]
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        batches = []
+        for indices in self.buckets:
+            if self.shuffle:
+                indices = self.rng.permutation(indices)
+            stop = len(indices) - len(indices) % self.batch_size if self.drop_last else len(indices)
+            batches.extend(indices[ii:ii + self.batch_size] for ii in range(0, stop, self.batch_size))
+        if self.shuffle:
+            batches = [batches[ii] for ii in self.rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
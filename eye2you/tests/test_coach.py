@@ -1,8 +1,10 @@
 # pylint: disable=redefined-outer-name
-from eye2you import Coach
+from eye2you import Coach, factory
+from eye2you.datasets import BatchAugmentation
 import pathlib
 import os
 import pytest
+import torch
 from eye2you.meter_functions import TotalAccuracyMeter  # pylint: disable=unused-import
 
 from test_net import compare_network_weights, compare_network_setup
@@ -63,6 +65,25 @@ def test_coach_load():
     assert coach.log.columns is not None
 
 
+def test_coach_batch_augmentation():
+    config = factory.config_from_yaml(LOCAL_DIR / 'data/example.yaml')
+    config['batch_augmentation'] = {'angle': 10, 'hflip': 0.5}
+    coach = Coach()
+    coach.load_config(config)
+    assert isinstance(coach.net.augmentation, BatchAugmentation)
+    assert coach.net.augmentation.mean == config['data_preparation']['mean']
+    # only crop and resize are left to the per sample augmentation
+    assert coach.train_data.augmentation.random_resize_crop is not None
+    assert coach.train_data.augmentation.rotation is None
+    assert coach.train_data.augmentation.color_jitter is None
+    assert coach.train_data.augmentation.hflip is None and coach.train_data.augmentation.vflip is None
+
+    coach = Coach()
+    coach.load_config(LOCAL_DIR / 'data/example.yaml')
+    assert coach.net.augmentation is None
+    assert coach.train_data.augmentation.rotation is not None
+
+
 def test_coach_saveload_checkpoint(tmp_path, coach_example):
     coach_example.save(tmp_path / 'test.ckpt')
 
@@ -106,3 +127,41 @@ def test_coach_train(tmp_path, coach_example):
 
 def test_coach_validate(coach_example):
     coach_example.validate()
+
+
+def test_coach_distributed(tmp_path):
+    config = factory.config_from_yaml(LOCAL_DIR / 'data/example.yaml')
+    config['data_preparation'].update(size=299, crop=299)
+    config['data_augmentation']['size'] = 299
+    config['training']['num_samples'] = 8
+    coach = Coach()
+    coach.load_config(config)
+    weights = [p.detach().clone() for p in coach.net.model.parameters()]
+
+    coach.run(2, log_filename=str(tmp_path / 'test.log'), checkpoint=str(tmp_path / 'test'), num_processes=2)
+    assert coach.epochs == 2
+    assert len(list(tmp_path.glob('test.*.ckpt'))) > 0
+    assert len(coach.log._log['training']) == 2
+    assert os.path.exists(tmp_path / 'test.log')
+    assert any(not torch.equal(p1, p2) for p1, p2 in zip(weights, coach.net.model.parameters()))
+    assert not coach.net.distributed
+
+
+def test_coach_distributed_split(tmp_path):
+    # without validation section every process has to use the split of the calling coach
+    config = factory.config_from_yaml(LOCAL_DIR / 'data/example.yaml')
+    del config['dataset']['validation']
+    config['dataset']['test_size'] = 0.5
+    config['data_preparation'].update(size=299, crop=299)
+    config['data_augmentation']['size'] = 299
+    config['training']['num_samples'] = 4
+    del config['training']['weighted_sampling_classes']
+    coach = Coach()
+    coach.load_config(config)
+    train_samples = list(coach.train_data.samples)
+
+    coach.run(1, checkpoint=str(tmp_path / 'test'), num_processes=2)
+    state_dict = torch.load(next(tmp_path.glob('test.*.ckpt')), weights_only=False)
+    for index, saved_index in zip(coach.split, state_dict['split']):
+        assert list(index) == list(saved_index)
+    assert list(coach.train_data.samples) == train_samples
@@ -1,8 +1,12 @@
 # pylint: disable=redefined-outer-name
+import random
+
+import numpy as np
 import torch
 from PIL import Image
 
-from eye2you.datasets import DataAugmentation
+from eye2you import datasets
+from eye2you.datasets import BatchAugmentation, DataAugmentation
 
 
 def test_augmentation_initialization():
@@ -141,3 +145,106 @@ def test_augmentation_transform_correctness(image_filename):
     assert segment.size == (100, 100)
     assert isinstance(target, torch.Tensor)
     assert target.shape == (3,)
+
+
+def test_augmentation_fused(image_set):
+    files, masks = image_set
+    img = Image.open(files[0])
+    mask = Image.open(masks[0]).convert('L')
+    aug = DataAugmentation(angle=23.5, size=100, scale=(0.5, 1.0), ratio=(0.75, 1.3), hflip=0.5, vflip=0.5)
+    aug_fused = DataAugmentation(angle=23.5,
+                                 size=100,
+                                 scale=(0.5, 1.0),
+                                 ratio=(0.75, 1.3),
+                                 hflip=0.5,
+                                 vflip=0.5,
+                                 fused=True)
+    assert aug_fused.fused
+    for seed in range(5):
+        random.seed(seed)
+        torch.manual_seed(seed)
+        (sample1, mask1, segment1), target1 = aug.apply((img, mask, mask), [mask])
+        random.seed(seed)
+        torch.manual_seed(seed)
+        (sample2, mask2, segment2), target2 = aug_fused.apply((img, mask, mask), [mask])
+
+        assert sample1.size == sample2.size == (100, 100)
+        assert np.abs(np.asarray(sample1, dtype=float) - np.asarray(sample2, dtype=float)).mean() < 4
+        for label1, label2 in ((mask1, mask2), (segment1, segment2), (target1[0], target2[0])):
+            assert label2.mode == 'L'
+            assert (np.asarray(label1) != np.asarray(label2)).mean() < 0.01
+
+
+def test_augmentation_fused_flips_exact(image_filename):
+    img = Image.open(image_filename)
+    aug = DataAugmentation(hflip=1.0, vflip=1.0)
+    aug_fused = DataAugmentation(hflip=1.0, vflip=1.0, fused=True)
+    (sample1, _, _), _ = aug.apply((img, img, img), torch.Tensor([0.0, 1.0]))
+    (sample2, _, _), target = aug_fused.apply((img, img, img), torch.Tensor([0.0, 1.0]))
+    np.testing.assert_equal(np.asarray(sample1), np.asarray(sample2))
+    assert target.shape == (2,)
+
+
+def test_batch_augmentation():
+    torch.manual_seed(0)
+    sample = torch.rand(1, 3, 64, 64).repeat(8, 1, 1, 1)
+    mask = (torch.rand(1, 1, 64, 64) > 0.5).float().repeat(8, 1, 1, 1)
+    target = torch.cat((mask, 1 - mask), dim=1)
+    aug = BatchAugmentation(angle=30,
+                            size=48,
+                            scale=(0.5, 1.0),
+                            ratio=(0.75, 1.3),
+                            brightness=0.5,
+                            contrast=0.6,
+                            saturation=0.4,
+                            hue=0.1,
+                            hflip=0.5,
+                            vflip=0.5)
+    (sample_aug, mask_aug, segment_aug), target_aug = aug.apply([sample, mask, mask.clone()], target)
+    assert sample_aug.shape == (8, 3, 48, 48)
+    assert mask_aug.shape == segment_aug.shape == (8, 1, 48, 48)
+    assert target_aug.shape == (8, 2, 48, 48)
+    assert sample_aug.min() >= 0 and sample_aug.max() <= 1
+    assert set(mask_aug.unique().tolist()) <= {0.0, 1.0}
+    torch.testing.assert_close(mask_aug, segment_aug)
+    torch.testing.assert_close(mask_aug[:, 0], target_aug[:, 0])
+    # every sample gets its own parameters
+    for ii in range(1, 8):
+        assert not torch.allclose(sample_aug[0], sample_aug[ii])
+
+    labels = torch.Tensor([[0.0, 1.0]]).repeat(8, 1)
+    sample_aug, labels_aug = aug.apply(sample, labels)
+    assert sample_aug.shape == (8, 3, 48, 48)
+    torch.testing.assert_close(labels, labels_aug)
+
+
+def test_batch_augmentation_flips():
+    sample = torch.rand(4, 3, 20, 30)
+    mask = (torch.rand(4, 1, 20, 30) > 0.5).float()
+    aug = BatchAugmentation(hflip=1.0, vflip=1.0)
+    (sample_aug, mask_aug, _), _ = aug.apply([sample, mask, mask], torch.zeros(4, 2))
+    torch.testing.assert_close(sample_aug, sample.flip(2, 3))
+    torch.testing.assert_close(mask_aug, mask.flip(2, 3))
+
+    mean, std = (0.5, 0.25, 0.1), (0.2, 0.1, 0.05)
+    aug = BatchAugmentation(mean=mean, std=std, hflip=0.0)
+    sample_aug, _ = aug.apply(sample, torch.zeros(4, 2))
+    torch.testing.assert_close(sample_aug, sample)
+
+
+def test_batch_augmentation_rotation_center():
+    sample = torch.rand(4, 3, 20, 30)
+    aug = BatchAugmentation(angle=(180, 180))
+    sample_aug, _ = aug.apply(sample, torch.zeros(4, 2))
+    torch.testing.assert_close(sample_aug, sample.flip(2, 3), atol=1e-4, rtol=0)
+
+    # rotating around the top left corner moves the whole image out of view
+    aug.rotation.center = (0, 0)
+    sample_aug, _ = aug.apply(sample, torch.zeros(4, 2))
+    assert sample_aug.abs().max() < 1e-4
+
+
+def test_batch_augmentation_hsv():
+    img = torch.rand(5, 3, 10, 10)
+    # pylint: disable=protected-access
+    torch.testing.assert_close(datasets._hsv_to_rgb(datasets._rgb_to_hsv(img)), img)
@@ -1,9 +1,10 @@
 # pylint: disable=redefined-outer-name
+import numpy as np
 import torch
 import torchvision.transforms as transforms
 from PIL import Image
 
-from eye2you.datasets import DataPreparation
+from eye2you.datasets import DataPreparation, to_normalized_tensor
 
 
 def test_preparation_initialization():
@@ -67,3 +68,38 @@ def test_preparation_transform_correctness(image_filename):
     assert segment.shape == (3, 90, 90)
     assert isinstance(target, torch.Tensor)
     assert target.shape == (3,)
+
+
+def test_preparation_transform_cached():
+    prep = DataPreparation(size=100, mean=(0.5, 0.25, 0.1), std=(0.2, 0.1, 0.05), crop=90)
+    assert prep.transform is prep.transform
+    assert prep.get_transform() is prep.get_transform()
+    trans = prep.transform
+    prep.mean = (0.1, 0.1, 0.1)
+    assert prep.transform is not trans
+    assert 'Normalize(mean=(0.1, 0.1, 0.1)' in str(prep.transform)
+
+
+def test_preparation_transform_inputs(image_filename):
+    img = Image.open(image_filename)
+    prep = DataPreparation(mean=(0.5, 0.25, 0.1), std=(0.2, 0.1, 0.05), crop=90)
+    reference = transforms.Compose(prep.get_transform().transforms)(img)
+
+    arr = np.array(img)
+    tensor = torch.from_numpy(arr).permute(2, 0, 1)
+    for inp in (img, arr, tensor):
+        res = prep.transform(inp)
+        assert res.is_contiguous()
+        torch.testing.assert_close(res, reference)
+    # input is not modified
+    np.testing.assert_equal(arr, np.array(img))
+
+    res = to_normalized_tensor(tensor.float() / 255)
+    torch.testing.assert_close(res, transforms.ToTensor()(img))
+    res = to_normalized_tensor(arr[:, :, 0])
+    assert res.shape == (1, *arr.shape[:2])
+
+    prep = DataPreparation(size=100, mean=(0.5, 0.25, 0.1), std=(0.2, 0.1, 0.05), crop=90)
+    reference = transforms.Compose(prep.get_transform().transforms)(img)
+    torch.testing.assert_close(prep.transform(img), reference)
+    assert (prep.transform(tensor) - reference).abs().mean() < 0.05
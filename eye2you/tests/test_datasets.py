@@ -9,7 +9,9 @@ import torchvision.transforms as transforms
 from PIL import Image
 import pandas as pd
 
-from eye2you.datasets import DataAugmentation, DataPreparation, TripleDataset
+from eye2you import datasets, factory
+from eye2you.datasets import (ConstantChannel, DataAugmentation, DataPreparation, PaddingCollate, PatchDataset,
+                              ShardDataset, TarDataset, TripleCollate, TripleDataset)
 
 LOCAL_DIR = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))
 NUMBER_OF_CLASSES = 2
@@ -212,3 +214,360 @@ def test_triple_dataset_print():
     assert 'Targets' in output
     assert 'Target labels' in output
     assert 'classes' in output
+
+
+def test_shard_dataset(tmp_path):
+    prep = DataPreparation(size=(100, 100), mean=(0.5, 0.25, 0.1), std=(0.2, 0.1, 0.05))
+    directory = factory.create_shards(LOCAL_DIR / 'data/test.csv',
+                                      LOCAL_DIR / 'data/',
+                                      tmp_path / 'shards',
+                                      size=(100, 100),
+                                      shard_size=3)
+    shards = ShardDataset(directory, preparation=prep)
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(LOCAL_DIR / 'data/test.csv',
+                                                                             LOCAL_DIR / 'data/')
+    data = TripleDataset(samples=samples,
+                         masks=masks,
+                         segmentations=segmentations,
+                         targets=targets,
+                         target_labels=target_labels,
+                         preparation=prep)
+
+    assert len(shards) == len(data) == NUMBER_OF_IMAGES
+    assert shards.target_labels == data.target_labels
+    assert len(shards.index['shards']) == 2
+    for ii in range(len(data)):
+        (sample1, mask1, segment1), target1 = shards[ii]
+        (sample2, mask2, segment2), target2 = data[ii]
+        np.testing.assert_allclose(sample1, sample2)
+        np.testing.assert_equal(mask1.numpy(), mask2.numpy())
+        np.testing.assert_equal(segment1.numpy(), segment2.numpy())
+        np.testing.assert_equal(target1.numpy(), target2.numpy())
+    with pytest.raises(IndexError):
+        _ = shards[len(shards)]
+
+
+def test_patch_dataset(tmp_path):
+    directory = factory.create_shards(LOCAL_DIR / 'data/test.csv',
+                                      LOCAL_DIR / 'data/',
+                                      tmp_path / 'shards',
+                                      size=64,
+                                      shard_size=3)
+    shards = ShardDataset(directory)
+    data = PatchDataset(directory, 16, 40, foreground_ratio=1, min_foreground=0.9, label_channels=2, seed=0)
+    assert len(data) == 40
+    assert data.target_labels == ['background', 'foreground']
+
+    # integral image queries and patches agree with the shard images
+    entries, ys, xs = data.sample_positions(10)
+    samples, labels = data.load_patches(entries, ys, xs)
+    for ii, (entry, y, x) in enumerate(zip(entries, ys, xs)):
+        (sample, _, _), _ = shards[entry]
+        sample = np.asarray(sample)[y:y + 16, x:x + 16]
+        np.testing.assert_allclose(samples[ii].numpy(), sample.transpose(2, 0, 1) / 255, rtol=1e-6)
+        assert data.foreground_fraction(entry, y, x) == labels[ii, 1].mean()
+        assert labels[ii, 1].mean() >= 0.9
+    np.testing.assert_equal((labels[:, 0] + labels[:, 1]).numpy(), 1)
+
+    loader = torch.utils.data.DataLoader(data, batch_size=8)
+    batches = list(loader)
+    assert len(batches) == 5
+    sample, target = batches[0]
+    assert sample.shape == (8, 3, 16, 16)
+    assert target.shape == (8, 2, 16, 16)
+    assert torch.all(target[:, 1].mean((1, 2)) >= 0.9)
+    assert data.integral_file.exists()
+    assert isinstance(data.integral, np.memmap)
+
+    # workers draw new patches every epoch, reproducible with torch.manual_seed
+    loader = torch.utils.data.DataLoader(data, batch_size=8, num_workers=1)
+    torch.manual_seed(0)
+    epochs = [torch.cat([sample for sample, _ in loader]) for _ in range(2)]
+    assert not torch.equal(epochs[0], epochs[1])
+    torch.manual_seed(0)
+    torch.testing.assert_close(torch.cat([sample for sample, _ in loader]), epochs[0])
+
+    # without foreground patches some patches show the black background
+    data = PatchDataset(directory, 16, 200, foreground_ratio=0, label_channels=1, seed=0, mean=(0.5, 0.5, 0.5))
+    sample, target = data[0]
+    assert sample.shape == (3, 16, 16) and target.shape == (1, 16, 16)
+    _, labels = data.load_patches(*data.sample_positions(200))
+    assert labels.mean((1, 2, 3)).min() < 0.9
+
+    with pytest.raises(ValueError):
+        PatchDataset(directory, 80, 10)
+
+
+def test_shard_dataset_labels(tmp_path):
+    directory = factory.create_shards(LOCAL_DIR / 'data/test_classification.csv',
+                                      LOCAL_DIR / 'data/',
+                                      tmp_path / 'shards',
+                                      size=64,
+                                      mask_column_name='xxx',
+                                      segmentation_column_name='xxx',
+                                      target_column_names=['class A', 'class B'])
+    shards = ShardDataset(directory, preparation=DataPreparation())
+    assert len(shards) == NUMBER_OF_IMAGES
+    assert shards.targets.shape == (NUMBER_OF_IMAGES, 2)
+    (sample, mask, segment), target = shards[1]
+    assert sample.shape == (3, 64, 64)
+    assert mask.min() == 1
+    assert segment.max() == 0
+    np.testing.assert_equal(target, shards.targets[1])
+
+
+def test_minimum_size():
+    assert DataPreparation().get_minimum_size() is None
+    assert DataPreparation(size=100).get_minimum_size() == (100, 100)
+    assert DataPreparation(size=(100, 120)).get_minimum_size() == (100, 120)
+    assert DataAugmentation(angle=10).get_minimum_size() is None
+    assert DataAugmentation(size=100).get_minimum_size() == (100, 100)
+    assert DataAugmentation(size=100, scale=(0.25, 1.0)).get_minimum_size() == (200, 200)
+
+    data = TripleDataset(augmentation=DataAugmentation(angle=10), preparation=DataPreparation(size=(80, 90)))
+    assert data.decode_size == (80, 90)
+    data.augmentation = DataAugmentation(size=100, scale=(0.25, 1.0))
+    assert data.decode_size == (200, 200)
+
+
+def test_triple_dataset_reduced_decode(image_set):
+    files, _ = image_set
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(LOCAL_DIR / 'data/test.csv',
+                                                                             LOCAL_DIR / 'data/')
+    prep = DataPreparation(size=(100, 100))
+    data_full = TripleDataset(samples=samples,
+                              masks=masks,
+                              segmentations=segmentations,
+                              targets=targets,
+                              target_labels=target_labels,
+                              preparation=prep)
+    data_reduced = TripleDataset(samples=samples,
+                                 masks=masks,
+                                 segmentations=segmentations,
+                                 targets=targets,
+                                 target_labels=target_labels,
+                                 preparation=prep,
+                                 reduced_decode=True)
+
+    source, _ = data_reduced._load(0)  # pylint: disable=protected-access
+    assert source[0].size == (119, 119)
+    assert source[1].size == source[0].size
+
+    for ii in range(len(data_full)):
+        (sample1, mask1, segment1), target1 = data_full[ii]
+        (sample2, mask2, segment2), target2 = data_reduced[ii]
+        assert sample1.shape == sample2.shape
+        assert (sample1 - sample2).abs().mean() < 0.02
+        assert mask1.shape == mask2.shape
+        assert (mask1 != mask2).float().mean() < 0.02
+        assert (segment1 != segment2).float().mean() < 0.02
+        assert (target1 != target2).float().mean() < 0.02
+
+
+def test_triple_dataset_constant_channels(image_set):
+    files, _ = image_set
+    prep = DataPreparation(size=100, crop=90)
+    data = TripleDataset(samples=files, targets=torch.randn((len(files), 3)), preparation=prep)
+    source, _ = data._load(0)  # pylint: disable=protected-access
+    assert isinstance(source[1], ConstantChannel)
+    assert isinstance(source[2], ConstantChannel)
+    assert source[1].size == source[0].size
+
+    (sample, mask, segment), _ = data[0]
+    assert mask.shape == segment.shape == (1, 90, 90)
+    assert mask.stride()[1:] == segment.stride()[1:] == (0, 0)
+    assert (mask == 1).all()
+    assert (segment == 0).all()
+
+    aug = DataAugmentation(size=50, scale=(0.5, 1.0), hflip=0.5, vflip=0.5)
+    (sample, mask, segment), _ = aug.apply(source, torch.zeros(3))
+    assert isinstance(mask, ConstantChannel)
+    assert mask.size == sample.size == (50, 50)
+
+    data = TripleDataset(samples=files, targets=torch.randn((len(files), 3)))
+    (sample, mask, segment), _ = data[0]
+    assert isinstance(mask, Image.Image)
+    assert mask.size == sample.size
+    assert np.asarray(mask).min() == 255
+    assert np.asarray(segment).max() == 0
+
+
+def test_triple_collate(image_set):
+    files, masks = image_set
+    prep = DataPreparation(size=(50, 50))
+    data = TripleDataset(samples=files, targets=torch.randn((len(files), 3)), preparation=prep)
+    batch = [data[ii] for ii in range(len(data))]
+
+    (sample, mask, segment), target = TripleCollate()(batch)
+    assert sample.shape == (4, 3, 50, 50)
+    assert mask.shape == segment.shape == (4, 1, 50, 50)
+    assert mask.stride()[0] == mask.stride()[2] == mask.stride()[3] == 0
+    assert (mask == 1).all()
+    assert target.shape == (4, 3)
+
+    (sample, mask, segment), target = TripleCollate(omit_constant=True)(batch)
+    assert mask is None
+    assert segment is None
+
+    data.masks = [str(m) for m in masks]
+    batch = [data[ii] for ii in range(len(data))]
+    (sample, mask, segment), target = TripleCollate(omit_constant=True)(batch)
+    assert mask.shape == (4, 1, 50, 50)
+    assert mask.is_contiguous()
+    assert segment is None
+
+    loader = torch.utils.data.DataLoader(data, batch_size=2, num_workers=1, collate_fn=TripleCollate())
+    for (sample, mask, segment), target in loader:
+        assert segment.shape == (2, 1, 50, 50)
+        assert (segment == 0).all()
+
+
+def test_target_index(tmp_path):
+    files = ['classA/img0.jpg', 'classA/img1.jpg', 'classB/img2.jpg']
+    targets = []
+    for ii, f in enumerate(files):
+        target = np.zeros((40, 50, 3), dtype=np.uint8)
+        target[5:20, 10:30, 0] = 255
+        target[25:35, 5:15, 1] = 255
+        if ii == 1:
+            target[0, 0, 2] = 255
+        if ii == 2:
+            # soft labels cannot be stored as label map
+            target[30:35, 30:40, 2] = 128
+        Image.fromarray(target).save(tmp_path / 'target{}.png'.format(ii))
+        targets.append(str(tmp_path / 'target{}.png'.format(ii)))
+    pd.DataFrame({
+        'filename': [str(LOCAL_DIR / 'data' / f) for f in files],
+        'target': targets
+    }).to_csv(tmp_path / 'data.csv', index=False)
+
+    directory = factory.create_target_index(tmp_path / 'data.csv', '', tmp_path / 'index')
+    index = datasets.load_target_index(directory)
+    assert len(index) == 2
+    assert index[targets[0]][1] == 2
+    assert index[targets[1]][1] == 3
+
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(tmp_path / 'data.csv', '')
+    prep = DataPreparation(size=(40, 50))
+    data = TripleDataset(samples=samples, targets=targets, preparation=prep)
+    data_indexed = TripleDataset(samples=samples, targets=targets, preparation=prep, target_index=index)
+    for ii in range(len(data)):
+        _, target1 = data[ii]
+        _, target2 = data_indexed[ii]
+        assert target1.shape == target2.shape
+        torch.testing.assert_close(target1, target2)
+    assert data[0][1].shape == (3, 40, 50)
+    assert data[1][1].shape == (4, 40, 50)
+
+
+def test_tar_dataset(tmp_path):
+    prep = DataPreparation(size=(100, 100), mean=(0.5, 0.25, 0.1), std=(0.2, 0.1, 0.05))
+    shards = factory.create_tar_shards(LOCAL_DIR / 'data/test.csv', LOCAL_DIR / 'data/', tmp_path, shard_size=3)
+    assert len(shards) == 2
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(LOCAL_DIR / 'data/test.csv',
+                                                                             LOCAL_DIR / 'data/')
+    data = TripleDataset(samples=samples,
+                         masks=masks,
+                         segmentations=segmentations,
+                         targets=targets,
+                         target_labels=target_labels,
+                         preparation=prep)
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(tmp_path / 'manifest.csv', '')
+    stream = TarDataset(str(tmp_path / 'shard_*.tar'),
+                        samples=samples,
+                        masks=masks,
+                        segmentations=segmentations,
+                        targets=targets,
+                        target_labels=target_labels,
+                        preparation=prep,
+                        shuffle=False)
+    assert len(stream) == NUMBER_OF_IMAGES
+    assert stream.target_labels == data.target_labels
+    items = list(stream)
+    assert len(items) == NUMBER_OF_IMAGES
+    for ii, ((sample1, mask1, segment1), target1) in enumerate(items):
+        (sample2, mask2, segment2), target2 = data[ii]
+        np.testing.assert_allclose(sample1, sample2)
+        np.testing.assert_equal(mask1.numpy(), mask2.numpy())
+        np.testing.assert_equal(segment1.numpy(), segment2.numpy())
+        np.testing.assert_equal(target1.numpy(), target2.numpy())
+
+
+def test_tar_dataset_shuffle_workers(tmp_path):
+    prep = DataPreparation(size=(50, 50))
+    factory.create_tar_shards(LOCAL_DIR / 'data/test_classification.csv', LOCAL_DIR / 'data/', tmp_path, shard_size=1)
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(tmp_path / 'manifest.csv', '')
+    stream = TarDataset(sorted(tmp_path.glob('*.tar')),
+                        samples=samples,
+                        targets=targets,
+                        target_labels=target_labels,
+                        preparation=prep,
+                        shuffle_buffer=2)
+    reference = sorted(float(item[0].sum()) for item, _ in TripleDataset(
+        samples=np.array([str(LOCAL_DIR / 'data' / s) for s in samples]), targets=targets, preparation=prep))
+
+    for num_workers in (0, 2):
+        loader = torch.utils.data.DataLoader(stream, batch_size=1, num_workers=num_workers)
+        for _ in range(2):
+            sums = sorted(float(source[0].sum()) for source, _ in loader)
+            np.testing.assert_allclose(sums, reference, rtol=1e-5)
+
+
+def test_padding_collate(image_set):
+    files, masks = image_set
+    data = TripleDataset(samples=[str(f) for f in files],
+                         masks=[str(m) for m in masks],
+                         targets=np.eye(4)[:, :2],
+                         preparation=DataPreparation())
+    batch = [data[ii] for ii in (0, 2, 3)]
+    (sample, mask, segment), target = PaddingCollate(multiple=16)(batch)
+    assert sample.shape == (3, 3, 480, 480)
+    assert mask.shape == segment.shape == (3, 1, 480, 480)
+    assert target.shape == (3, 2)
+    np.testing.assert_equal(sample[1, :, :463, :463].numpy(), batch[1][0][0].numpy())
+    assert sample[1, :, 463:, :].abs().sum() == 0
+    assert mask[2, :, 459:, :].sum() == 0
+    assert mask[2, :, :459, :459].sum() == batch[2][0][1].sum()
+
+    # equal sizes are collated as before, constant channels stay broadcast
+    (sample, mask, segment), target = PaddingCollate()([data[0], data[1]])
+    assert sample.shape == (2, 3, 473, 473)
+    assert segment.stride(0) == 0
+
+
+def test_retina_index(tmp_path, image_set):
+    filename = factory.create_retina_index(LOCAL_DIR / 'data/test_classification.csv',
+                                           LOCAL_DIR / 'data/',
+                                           tmp_path / 'retina.csv',
+                                           num_workers=2)
+    index = datasets.load_retina_index(filename)
+    assert len(index) == NUMBER_OF_IMAGES
+    files, masks = image_set
+    x, y, radius, height, width = index[str(files[3])]
+    assert (height, width) == (459, 459)
+
+    data = TripleDataset(samples=[str(f) for f in files],
+                         masks=[str(m) for m in masks],
+                         targets=np.eye(4)[:, :2],
+                         retina_index=index)
+    (sample, mask, segment), _ = data[3]
+    box = (max(0, x - radius), max(0, y - radius), min(width, x + radius), min(height, y + radius))
+    assert sample.size == mask.size == segment.size == (box[2] - box[0], box[3] - box[1])
+    np.testing.assert_equal(np.asarray(sample), np.asarray(Image.open(files[3]).crop(box)))
+
+    # circle given for the original size is scaled to the drafted sample
+    data.preparation = DataPreparation(size=(100, 100))
+    data.reduced_decode = True
+    (sample, mask, segment), _ = data[3]
+    assert sample.shape[1:] == mask.shape[1:] == (100, 100)
+
+    data = TripleDataset(samples=[str(f) for f in files], targets=np.eye(4)[:, :2], retina_index={
+        str(files[0]): (200, 240, 100, 473, 473)
+    }, retina_mask=True)
+    (sample, mask, segment), _ = data[0]
+    assert sample.size == (200, 200)
+    mask = np.asarray(mask)
+    assert mask[100, 100] == 255 and mask[0, 0] == 0 and mask[100, 0] == 255
+    assert np.all(np.asarray(segment) == 0)
+    (sample, mask, _), _ = data[1]
+    assert sample.size == (473, 473) and np.all(np.asarray(mask) == 255)
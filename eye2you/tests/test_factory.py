@@ -55,6 +55,64 @@ def test_load_csv():
     assert len(target_labels) == 2
 
 
+def test_load_csv_cached(tmp_path):
+    filename = tmp_path / 'test.csv'
+    filename.write_text((LOCAL_DIR / 'data/test_classification.csv').read_text())
+    root = LOCAL_DIR / 'data/'
+
+    reference = factory.load_csv(filename, root)
+    for _ in range(2):
+        result = factory.load_csv(filename, root, cache_dir=tmp_path / 'cache')
+        for arr1, arr2 in zip(result[:4], reference[:4]):
+            np.testing.assert_equal(arr1, arr2)
+        assert result[4] == reference[4]
+    assert reference[0][0] == os.path.join(root, 'classA/img0.jpg')
+    cache_file = next((tmp_path / 'cache').glob('*.npz'))
+    mtime = cache_file.stat().st_mtime_ns
+
+    # touching the csv does not invalidate the cache, changing it does
+    os.utime(str(filename), ns=(mtime + 10**9, mtime + 10**9))
+    factory.load_csv(filename, root, cache_dir=tmp_path / 'cache')
+    assert cache_file.stat().st_mtime_ns == mtime
+    filename.write_text(filename.read_text().replace('img3.jpg,classB/img3_mask.png', 'img3.jpg,'))
+    samples, masks, _, _, _ = factory.load_csv(filename, root, cache_dir=tmp_path / 'cache')
+    assert isinstance(masks[2], str)
+    assert not isinstance(masks[3], str)
+    assert len(samples) == 4
+
+
+def test_data_from_config_cached_split(tmp_path):
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    test_size: 0.5
+    manifest_cache: {str(tmp_path)}
+    ''')
+    splits = set()
+    for _ in range(5):
+        training_data, validation_data = factory.data_from_config(config)
+        splits.add((tuple(training_data.samples), tuple(validation_data.samples)))
+    assert len(splits) == 1
+    assert len(list(tmp_path.glob('split_*.npz'))) == 1
+
+
+def test_data_from_config_given_split():
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    test_size: 0.5
+    ''')
+    training_data, validation_data, split = factory.data_from_config(config, return_split=True)
+    assert len(split[0]) == 2 and len(split[1]) == 2
+    for _ in range(5):
+        training_data2, validation_data2 = factory.data_from_config(config, split=split)
+        assert list(training_data2.samples) == list(training_data.samples)
+        assert list(validation_data2.samples) == list(validation_data.samples)
+
+    config['validation'] = {'csv': config['csv'], 'root': config['root']}
+    assert factory.data_from_config(config, return_split=True)[2] is None
+
+
 def test_data_from_config():
     config = yaml.full_load(f'''
     csv: {str(LOCAL_DIR)}/data/test_classification.csv
@@ -97,6 +155,108 @@ def test_data_from_config():
     assert len(validation_data) == 2
 
 
+def test_tar_data_from_config(tmp_path):
+    factory.create_tar_shards(LOCAL_DIR / 'data/test_classification.csv', LOCAL_DIR / 'data/', tmp_path, shard_size=2)
+    config = yaml.full_load(f'''
+    shards: {str(tmp_path)}/shard_*.tar
+    csv: {str(tmp_path)}/manifest.csv
+    shuffle_buffer: 2
+    validation:
+        shards: {str(tmp_path)}/shard_*.tar
+        csv: {str(tmp_path)}/manifest.csv
+    ''')
+    training_data, validation_data = factory.data_from_config(config)
+    assert isinstance(training_data, eye2you.TarDataset)
+    assert len(training_data.shards) == 2
+    assert len(training_data) == len(validation_data) == 4
+    assert not validation_data.shuffle
+    training_data.preparation = eye2you.DataPreparation(size=50)
+
+    loader = factory.get_loader(yaml.full_load('''
+    batch_size: 2
+    num_workers: 0
+    '''), training_data)
+    batches = list(loader)
+    assert len(batches) == 2
+    assert batches[0][1].shape == (2, 2)
+
+    with pytest.raises(ValueError):
+        factory.get_loader({'batch_size': 2, 'num_workers': 0, 'weighted_sampling_classes': [0, 1]}, training_data)
+    del config['validation']
+    with pytest.raises(ValueError):
+        factory.data_from_config(config)
+
+
+def test_size_index_loader(tmp_path):
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    validation:
+        csv: {str(LOCAL_DIR)}/data/test_classification.csv
+        root: {str(LOCAL_DIR)}/data/
+    ''')
+    training_data, _ = factory.data_from_config(config)
+    training_data.preparation = eye2you.DataPreparation()
+    index = factory.create_size_index(LOCAL_DIR / 'data/test_classification.csv', LOCAL_DIR / 'data/',
+                                      tmp_path / 'sizes.csv')
+    sizes = factory.load_size_index(index, training_data.samples[::-1])
+    assert tuple(sizes[0]) == (459, 459)
+    with pytest.raises(ValueError):
+        factory.load_size_index(index, ['missing.jpg'])
+
+    loader = factory.get_loader({'batch_size': 2, 'num_workers': 0, 'size_index': str(index),
+                                 'bucket_granularity': 16, 'pad_multiple': 8}, training_data)
+    shapes = sorted(tuple(source[0].shape) for source, _ in loader)
+    assert shapes == [(2, 3, 464, 464), (2, 3, 480, 480)]
+
+
+def test_get_loader_auto_tune(tmp_path, capsys):
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    validation:
+        csv: {str(LOCAL_DIR)}/data/test_classification.csv
+        root: {str(LOCAL_DIR)}/data/
+    ''')
+    training_data, _ = factory.data_from_config(config)
+    training_data.preparation = eye2you.DataPreparation(size=64)
+
+    config = yaml.full_load('''
+    num_samples: 8
+    replacement: True
+    batch_size: 2
+    num_workers: auto
+    pin_memory: False
+    auto_tune:
+        worker_counts: [0, 1]
+        prefetch_factors: [2]
+        num_batches: 2
+    ''')
+    tune_file = tmp_path / 'config.training_loader.yaml'
+    loader = factory.get_loader(config, training_data, tune_file=tune_file)
+    assert 'Loader auto-tune' in capsys.readouterr().out
+    with open(str(tune_file), 'r') as f:
+        tuned = yaml.safe_load(f)
+    assert tuned['num_workers'] in (0, 1)
+    assert tuned['samples_per_second'] > 0
+    assert loader.num_workers == tuned['num_workers']
+    if loader.num_workers > 0:
+        assert loader.persistent_workers and loader.prefetch_factor == 2
+    assert len(list(loader)) == 4
+
+    # the stored result is reused
+    tuned['num_workers'] = 1
+    with open(str(tune_file), 'w') as f:
+        yaml.safe_dump(tuned, f)
+    loader = factory.get_loader(config, training_data, tune_file=tune_file)
+    assert 'from' in capsys.readouterr().out
+    assert loader.num_workers == 1
+
+    config = dict(batch_size=2, num_workers=1, prefetch_factor=3, persistent_workers=True)
+    loader = factory.get_loader(config, training_data)
+    assert loader.prefetch_factor == 3 and loader.persistent_workers
+
+
 def test_get_loader():
     config = yaml.full_load(f'''
     csv: {str(LOCAL_DIR)}/data/test_classification.csv
@@ -163,6 +323,33 @@ def test_get_loader():
     assert loader.sampler.num_samples == 4
 
 
+def test_get_loader_accumulation():
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    validation:
+        csv: {str(LOCAL_DIR)}/data/test_classification.csv
+        root: {str(LOCAL_DIR)}/data/
+    ''')
+    training_data, _ = factory.data_from_config(config)
+
+    config = yaml.full_load('''
+    batch_size: 4
+    num_workers: 0
+    batch_size_increase: 6
+    ''')
+    assert factory.get_accumulation_steps(config, 3) == 1
+    assert factory.get_loader(config, training_data, 3).batch_size == 22
+
+    # with accumulation the loader keeps the micro-batch size and the increase goes into the steps
+    config['accumulation_steps'] = 2
+    for step, accumulation_steps in ((None, 2), (0, 2), (1, 4), (3, 7)):
+        assert factory.get_accumulation_steps(config, step) == accumulation_steps
+        assert factory.get_loader(config, training_data, step).batch_size == 4
+    del config['batch_size_increase']
+    assert factory.get_accumulation_steps(config, 3) == 2
+
+
 def test_configparser():
     config = {
         0: dict(),
@@ -72,6 +72,46 @@ def test_image_conversion():
         np.testing.assert_almost_equal(cv2_img[:, :, ii], torch_img[0, ii, :, :])
 
 
+def test_zero_copy_conversion():
+    hf = eye2you.helper_functions
+    img = hf.pil_loader(LOCAL_DIR / 'data/classA/img0.jpg')
+    arr = np.array(img)
+
+    # defaults keep float32 tensors in [0, 1] (PIL) or in the array scale (cv2), and HWC arrays
+    assert hf.PIL_to_torch(img).dtype == torch.float32 and hf.PIL_to_torch(img).max() <= 1
+    assert hf.cv2_to_torch(arr).dtype == torch.float32
+    assert hf.torch_to_cv2(hf.cv2_to_torch(arr[:, :, :1])).shape == (*arr.shape[:2], 1)
+    assert hf.PIL_to_cv2(img).flags.writeable
+
+    # views: numpy -> torch and torch -> numpy share memory
+    torch_img = hf.cv2_to_torch(arr, share_memory=True)
+    assert torch_img.dtype == torch.uint8
+    assert torch_img.data_ptr() == arr.ctypes.data
+    cv2_img = hf.torch_to_cv2(torch_img)
+    assert np.shares_memory(cv2_img, arr)
+    np.testing.assert_equal(cv2_img, arr)
+    gray = hf.cv2_to_torch(arr[:, :, 0], share_memory=True)
+    assert gray.shape == (1, 1, *arr.shape[:2])
+    assert np.shares_memory(hf.torch_to_cv2(gray), arr)
+    np.testing.assert_equal(hf.PIL_to_torch(img, share_memory=True).numpy(), torch_img.numpy())
+
+    # copies: read-only and flipped arrays cannot be shared
+    readonly = hf.PIL_to_cv2(img, writable=False)
+    assert not readonly.flags.writeable
+    assert hf.cv2_to_torch(readonly, share_memory=True).data_ptr() != readonly.ctypes.data
+    bgr = arr[:, :, ::-1]
+    np.testing.assert_equal(hf.cv2_to_torch(bgr, share_memory=True)[0, 0].numpy(), arr[:, :, 2])
+
+    # uint8 is passed on without rescaling
+    dark = (arr // 4 + 10).astype(np.uint8)
+    np.testing.assert_equal(np.asarray(hf.cv2_to_PIL(dark)), dark)
+    scaled = np.asarray(hf.cv2_to_PIL(dark.astype(np.float32)))
+    assert scaled.min() == 0 and scaled.max() == 255
+    for share_memory in (False, True):
+        pil_img = hf.torch_to_PIL(hf.PIL_to_torch(img, share_memory=share_memory))
+        np.testing.assert_equal(np.asarray(pil_img), arr)
+
+
 def test_split_and_merge_patches():
     patch_size = np.random.randint(5, 40)
     n_h, n_w = np.random.randint(5, 20, 2)
@@ -90,3 +130,82 @@ def test_split_and_merge_patches():
 
     img_new = eye2you.helper_functions.merge_tensor_image_from_patches(patches)
     np.testing.assert_allclose(img, img_new)
+
+
+def test_calculate_mean_and_std(image_set):
+    files, _ = image_set
+    files = [str(f) for f in files]
+    pixels = np.concatenate([np.asarray(Image.open(f).convert('RGB')).reshape(-1, 3) / 255. for f in files])
+
+    config = dict(size=200)
+    mean, std = eye2you.helper_functions.calculate_mean_and_std(files, num_workers=2, chunk_size=1, config=config)
+    np.testing.assert_allclose(mean, pixels.mean(0))
+    np.testing.assert_allclose(std, pixels.std(0, ddof=1))
+    assert config['mean'] == list(mean) and config['std'] == list(std)
+    eye2you.DataPreparation(**config)
+
+    mean2, std2 = eye2you.helper_functions.calculate_mean_and_std(files, num_workers=0, subsample=0.1)
+    np.testing.assert_allclose(mean2, mean, atol=0.01)
+    np.testing.assert_allclose(std2, std, atol=0.01)
+
+    mean3, _ = eye2you.helper_functions.calculate_mean_and_std(files, num_workers=0, retina_mask=True)
+    assert np.all(mean3 >= mean)
+
+
+def test_find_retina_boxes(image_set):
+    files, _ = image_set
+    images = [np.ascontiguousarray(np.asarray(Image.open(f).convert('RGB'))[..., ::-1]) for f in files]
+    for im in images:
+        x, y, r_in, r_out, output = eye2you.helper_functions.find_retina_boxes(im)
+        assert output is None
+        assert r_in == int(np.sqrt(r_out**2 / 2))
+        # the retina of the test images fills the image
+        assert abs(x - im.shape[1] / 2) < 10 and abs(y - im.shape[0] / 2) < 10
+        assert abs(r_out - im.shape[0] / 2) < 15
+
+    batch = eye2you.helper_functions.find_retina_boxes_batch(images, num_workers=2)
+    assert [c[:4] for c in batch] == [eye2you.helper_functions.find_retina_boxes(im)[:4] for im in images]
+    circle = eye2you.helper_functions.find_retina_boxes(images[0], display=True, method='hough')
+    assert circle[4].shape == images[0].shape
+
+    # synthetic retina, cut at top and bottom, no Hough fallback needed
+    img = np.zeros((600, 800), dtype=np.uint8)
+    yy, xx = np.mgrid[:600, :800]
+    img[(xx - 400)**2 + (yy - 300)**2 < 350**2] = 120
+    x, y, _, r_out, _ = eye2you.helper_functions.find_retina_boxes(img, max_distance_center=0.01, param2_limit=50)
+    assert abs(x - 400) <= 2 and abs(y - 300) <= 2 and abs(r_out - 350) <= 3
+
+    assert eye2you.helper_functions.find_retina_boxes(np.zeros((100, 100, 3), dtype=np.uint8)) is None
+    assert eye2you.helper_functions._hough_parameters(60, 50, 40, 10, 20, 10) == [(60, 50), (50, 50), (40, 50),
+                                                                                 (40, 40), (40, 30), (40, 20)]
+
+
+def test_retina_masks(image_set):
+    files, _ = image_set
+    images = [np.ascontiguousarray(np.asarray(Image.open(f).convert('RGB'))[..., ::-1]) for f in files]
+    hf = eye2you.helper_functions
+
+    mask = hf.get_retina_mask(images[0])
+    assert mask.shape == images[0].shape[:2] and mask.dtype == np.uint8
+    assert mask.flags.writeable
+    assert np.all(hf.get_retina_mask(np.zeros((50, 60, 3), dtype=np.uint8)) == 1)
+
+    masks = hf.RetinaMasks(num_workers=0)(images)
+    for img, m in zip(images, masks):
+        np.testing.assert_equal(m, hf.get_retina_mask(img))
+
+    # camera profile: detected once, scaled to other image sizes
+    retina_masks = hf.RetinaMasks(profiles={'known': (50, 40, 30, 100, 100)})
+    masks = retina_masks(images[:2], profile='camera')
+    assert masks[0] is masks[1]
+    assert not masks[0].flags.writeable
+    assert retina_masks.profiles['camera'][3:] == images[0].shape[:2]
+    masks = retina_masks([np.zeros((200, 400, 3), dtype=np.uint8)], profile='known')
+    assert masks[0][80, 200] == 255 and masks[0][80, 255] == 255 and masks[0][80, 265] == 0
+    assert masks[0].shape == (200, 400)
+
+    # the cache is bounded, the least recently used template masks are dropped
+    retina_masks = hf.RetinaMasks(profiles={'known': (50, 40, 30, 100, 100)}, max_bytes=3 * 100 * 100)
+    for size in (100, 110, 120, 100):
+        retina_masks([np.zeros((size, 100, 3), dtype=np.uint8)], profile='known')
+    assert [key[:2] for key in retina_masks._masks] == [(120, 100), (100, 100)]  # pylint: disable=protected-access
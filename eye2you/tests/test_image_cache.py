@@ -0,0 +1,123 @@
+# pylint: disable=redefined-outer-name
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+
+from eye2you import factory
+from eye2you.datasets import DataPreparation, TripleDataset
+from eye2you.helper_functions import pil_loader
+from eye2you.image_cache import SharedImageCache
+
+LOCAL_DIR = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))
+
+
+def test_cache_hits_and_misses(image_set):
+    files, masks = image_set
+    cache = SharedImageCache(10 * 2**20)
+    for f in files:
+        img = cache(f)
+        np.testing.assert_equal(np.asarray(img), np.asarray(pil_loader(f)))
+    assert cache.misses == len(files)
+    assert cache.hits == 0
+    assert len(cache) == len(files)
+
+    for f in files:
+        img = cache(f)
+        np.testing.assert_equal(np.asarray(img), np.asarray(pil_loader(f)))
+    img = cache(masks[0], 'L')
+    assert img.mode == 'L'
+    assert cache.hits == len(files)
+    assert cache.misses == len(files) + 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.hits == 0
+
+
+def test_cache_eviction(image_set):
+    files, _ = image_set
+    size = np.asarray(pil_loader(files[0])).nbytes
+    cache = SharedImageCache(2 * size, max_entries=2)
+    cache(files[0])
+    cache(files[1])
+    cache(files[0])
+    cache(files[2])
+    assert len(cache) == 2
+    assert cache.nbytes <= 2 * size
+
+    # files[1] was least recently used
+    cache(files[0])
+    assert cache.hits == 2
+    cache(files[1])
+    assert cache.misses == 4
+
+
+def test_cache_modified_file(tmp_path, image_filename):
+    filename = tmp_path / 'img.jpg'
+    shutil.copy(image_filename, filename)
+    cache = SharedImageCache(10 * 2**20)
+    cache(filename)
+
+    Image.new('RGB', (10, 20)).save(filename)
+    os.utime(filename, ns=(0, 0))
+    img = cache(filename)
+    assert img.size == (10, 20)
+    assert cache.misses == 2
+    assert len(cache) == 1
+
+
+def test_cache_shared_between_workers(image_set):
+    files, masks = image_set
+    cache = SharedImageCache(10 * 2**20)
+    data = TripleDataset(samples=files,
+                         masks=[str(m) for m in masks],
+                         targets=torch.zeros((len(files), 2)),
+                         loader=cache,
+                         preparation=DataPreparation(size=(50, 50)))
+    loader = torch.utils.data.DataLoader(data, batch_size=1, num_workers=2)
+    for _ in range(2):
+        for _ in loader:
+            pass
+    assert cache.misses == 2 * len(files)
+    assert cache.hits == 2 * len(files)
+
+
+def test_cache_from_config():
+    config = yaml.full_load(f'''
+    csv: {str(LOCAL_DIR)}/data/test_classification.csv
+    root: {str(LOCAL_DIR)}/data/
+    cache_size: 16
+    validation:
+        csv: {str(LOCAL_DIR)}/data/test_classification.csv
+        root: {str(LOCAL_DIR)}/data/
+    ''')
+    training_data, validation_data = factory.data_from_config(config)
+    assert isinstance(training_data.loader, SharedImageCache)
+    assert training_data.loader is validation_data.loader
+    assert training_data.loader.max_bytes == 16 * 2**20
+
+
+def test_cache_reduced_decode():
+    samples, masks, segmentations, targets, target_labels = factory.load_csv(LOCAL_DIR / 'data/test.csv',
+                                                                             LOCAL_DIR / 'data/')
+    cache = SharedImageCache(10 * 2**20)
+    data = TripleDataset(samples=samples,
+                         masks=masks,
+                         segmentations=segmentations,
+                         targets=targets,
+                         target_labels=target_labels,
+                         loader=cache,
+                         preparation=DataPreparation(size=(100, 100)),
+                         reduced_decode=True)
+    for _ in range(2):
+        source, _ = data._load(0)  # pylint: disable=protected-access
+        assert source[0].size == (119, 119)
+    assert cache.hits > 0
+    # drafted and full resolution images are cached separately
+    assert cache(samples[0]).size == pil_loader(samples[0]).size
+    assert cache(samples[0], draft=(100, 100)).size == (119, 119)
@@ -1,4 +1,5 @@
 # pylint: disable=redefined-outer-name
+import copy
 import os
 import pathlib
 
@@ -8,7 +9,7 @@ import yaml
 
 import eye2you
 from eye2you import factory
-from eye2you.meter_functions import TotalAccuracyMeter
+from eye2you.meter_functions import SegmentationAccuracyMeter, TotalAccuracyMeter
 
 LOCAL_DIR = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))
 
@@ -295,3 +296,106 @@ def compare_network_weights(net1, net2):
 
 def test_network_print():
     pass
+
+
+class SegmentationData(torch.utils.data.Dataset):
+    # random images with the mean above 0.5 as segmentation target
+    def __init__(self, size=8):
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.rand(size, 3, 16, 16, generator=generator)
+        self.targets = (self.images.mean(1, keepdim=True) > 0.5).float()
+        self.target_labels = ['vessel']
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], self.targets[index]
+
+
+def segmentation_net(**kwargs):
+    return eye2you.net.Network(device='cpu',
+                               model_name='directnet',
+                               criterion_name='BCEWithLogitsLoss',
+                               optimizer_name='Adam',
+                               performance_meters=[SegmentationAccuracyMeter()],
+                               **kwargs)
+
+
+@pytest.mark.parametrize('amp', [True, 'float16'])
+def test_network_amp(amp):
+    data = SegmentationData()
+    loader = torch.utils.data.DataLoader(data, batch_size=4, sampler=torch.utils.data.RandomSampler(data))
+    net = segmentation_net(amp=amp)
+    assert net.amp == ('bfloat16' if amp is True else amp)
+    assert net.scaler.is_enabled() == (amp == 'float16')
+
+    loss, accuracy = net.train(loader)
+    assert torch.isfinite(torch.tensor(loss))
+    assert isinstance(accuracy, float) or accuracy.dtype == torch.float32
+    loss, accuracy = net.validate(loader)
+    assert torch.isfinite(torch.tensor(loss))
+
+    # weights stay float32 and the checkpoint loads into a network without amp
+    state_dict = net.get_state_dict()
+    assert all(v.dtype == torch.float32 for v in state_dict['model'].values() if v.is_floating_point())
+    assert state_dict['amp'] == net.amp
+    net_fp32 = segmentation_net()
+    net_fp32.load_state_dict(state_dict)
+    compare_network_weights(net, net_fp32)
+    assert eye2you.net.Network.from_state_dict(state_dict).amp == net.amp
+
+    with pytest.raises(ValueError):
+        segmentation_net(amp='int8')
+
+
+def test_network_accumulation():
+    torch.manual_seed(0)
+    model = torch.nn.Conv2d(3, 1, 3, padding=1)
+
+    def train(batch_size, accumulation_steps, num_samples, batch_sampler=None):
+        data = SegmentationData(num_samples)
+        net = segmentation_net()
+        net.model = copy.deepcopy(model)
+        net.optimizer = torch.optim.SGD(net.model.parameters(), lr=0.5)
+        steps = []
+        step = net.optimizer.step
+        net.optimizer.step = lambda *args, **kwargs: steps.append(step(*args, **kwargs))
+        if batch_sampler is None:
+            sampler = torch.utils.data.RandomSampler(data)
+            loader = torch.utils.data.DataLoader(data, batch_size=batch_size, sampler=sampler)
+        else:
+            loader = torch.utils.data.DataLoader(data, batch_sampler=batch_sampler)
+        net.train(loader, accumulation_steps=accumulation_steps)
+        return net, len(steps)
+
+    # one step over 8 samples, in one batch or in micro-batches
+    full, num_steps = train(8, 1, 8)
+    assert num_steps == 1
+    for batch_size, accumulation_steps in ((4, 2), (2, 4)):
+        accumulated, num_steps = train(batch_size, accumulation_steps, 8)
+        assert num_steps == 1
+        compare_network_weights(full, accumulated)
+
+    # micro-batches of different size, e.g. from a BucketBatchSampler, are weighted by their samples
+    accumulated, num_steps = train(None, 2, 8, batch_sampler=[[0, 1, 2], [3, 4, 5, 6, 7]])
+    assert num_steps == 1
+    compare_network_weights(full, accumulated)
+
+    # 3 micro-batches with 2 per step: the last step spans a single micro-batch
+    _, num_steps = train(4, 2, 12)
+    assert num_steps == 2
+
+    with pytest.raises(ValueError):
+        train(4, 0, 8)
+
+
+def test_network_uneven_batches():
+    data = SegmentationData(8)
+    net = segmentation_net()
+    full_loss, full_accuracy = net.validate(torch.utils.data.DataLoader(data, batch_size=8))
+    # batch sampler with partial batches, the mean loss is over the samples, not over full batches
+    loader = torch.utils.data.DataLoader(data, batch_sampler=[[0, 1, 2], [3, 4, 5, 6, 7]])
+    loss, accuracy = net.validate(loader)
+    assert loss == pytest.approx(full_loss)
+    assert accuracy == pytest.approx(full_accuracy)
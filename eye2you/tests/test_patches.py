@@ -0,0 +1,149 @@
+# pylint: disable=redefined-outer-name
+import numpy as np
+import pytest
+import torch
+
+import eye2you
+from eye2you import patches
+
+
+def loop_sliding_window(img, patch_size, stride):
+    # reference: the former loop implementation
+    c, h, w = img.shape
+    n_h = int((h - patch_size) / stride) + 1
+    n_w = int((w - patch_size) / stride) + 1
+    out = torch.zeros((n_h * n_w, c, patch_size, patch_size))
+    for ii in range(n_h):
+        for jj in range(n_w):
+            out[ii * n_w + jj, ...] = img[:, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size]
+    return out
+
+
+@pytest.mark.parametrize('stride', [1, 3, 8])
+def test_split_patches(stride):
+    imgs = torch.randn(2, 3, 37, 29)
+    view = patches.sliding_window_view(imgs, 8, stride)
+    assert view.shape[:3] == (2, *patches.grid_size((37, 29), 8, stride))
+    assert view.data_ptr() == imgs.data_ptr()
+
+    split = patches.split_patches(imgs, 8, stride)
+    reference = torch.cat([loop_sliding_window(img, 8, stride) for img in imgs])
+    np.testing.assert_equal(split.numpy(), reference.numpy())
+    np.testing.assert_equal(
+        eye2you.helper_functions.split_tensor_image_sliding_window(imgs[1], 8, stride).numpy(),
+        loop_sliding_window(imgs[1], 8, stride).numpy())
+    generated = list(eye2you.helper_functions.split_tensor_image_sliding_window_generator(imgs[0], 8, stride))
+    np.testing.assert_equal(torch.stack(generated).numpy(), loop_sliding_window(imgs[0], 8, stride).numpy())
+
+
+def test_merge_and_fold_patches():
+    imgs = torch.randn(2, 3, 32, 24)
+    split = patches.split_patches(imgs, (8, 6))
+    np.testing.assert_equal(patches.merge_patches(split, (4, 4)).numpy(), imgs.numpy())
+
+    summed, count = patches.fold_patches(split, (32, 24))
+    np.testing.assert_equal(summed.numpy(), imgs.numpy())
+    assert torch.all(count == 1)
+
+    # overlapping patches: every pixel is summed once per covering patch
+    split = patches.split_patches(imgs, 8, 4)
+    summed, count = patches.fold_patches(split, (32, 24), 4)
+    assert count.shape == (2, 1, 32, 24)
+    assert count[0, 0, 0, 0] == 1 and count[0, 0, 4, 4] == 4 and count[0, 0, 4, 0] == 2
+    np.testing.assert_allclose((summed / count).numpy(), imgs.numpy(), rtol=1e-5, atol=1e-6)
+
+    weight = torch.rand(8, 8)
+    summed, count = patches.fold_patches(split, (32, 24), 4, weight=weight)
+    np.testing.assert_allclose((summed / count).numpy(), imgs.numpy(), rtol=1e-4, atol=1e-5)
+
+
+class TwoClassModel(torch.nn.Module):
+    # scores (mean, 0.5) per pixel, i.e. vessel where the channel mean is above 0.5
+    def forward(self, x):
+        mean = x.mean(1, keepdim=True)
+        return torch.cat((torch.full_like(mean, 0.5), mean), dim=1)
+
+
+def loop_sliding_window_vessel(model, img, patch_size, stride, minimum_matches):
+    # reference: the former per-patch implementation
+    c, h, w = img.shape
+    n_h, n_w = patches.grid_size((h, w), patch_size, stride)
+    vessel = torch.zeros((1, h, w)) - minimum_matches
+    for ii in range(n_h):
+        for jj in range(n_w):
+            y = model(img[:, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size].unsqueeze(0))
+            vessel[0, ii * stride:ii * stride + patch_size, jj * stride:jj * stride + patch_size] += (
+                y[:, 1, :, :] > y[:, 0, :, :]).squeeze().float()
+    return torch.clamp(vessel, 0, 1)
+
+
+@pytest.mark.parametrize('stride', [1, 3, 8])
+@pytest.mark.parametrize('max_batch_bytes', [1, 5000, 2**26])
+def test_sliding_window_vessel(stride, max_batch_bytes):
+    img = torch.rand(3, 40, 35)
+    model = TwoClassModel()
+    vessel = eye2you.helper_functions.sliding_window_vessel(model, img, 8, stride, minimum_matches=1, device='cpu',
+                                                            max_batch_bytes=max_batch_bytes)
+    assert vessel.shape == (1, 40, 35)
+    np.testing.assert_equal(vessel.numpy(), loop_sliding_window_vessel(model, img, 8, stride, 1).numpy())
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'gaussian', 'hann'])
+def test_blended_inference(mode):
+    window = patches.blend_window((8, 6), mode)
+    assert window.shape == (8, 6) and window.max() == 1 and window.min() > 0
+
+    # blending a constant model output gives the constant where patches cover the image
+    img = torch.rand(3, 36, 32)
+    model = lambda x: torch.full((x.shape[0], 1, x.shape[2], x.shape[3]), 0.25)
+    vessel = eye2you.helper_functions.sliding_window_vessel(model, img, 8, 4, device='cpu', blend=mode)
+    np.testing.assert_allclose(vessel.numpy(), 0.25, rtol=1e-5)
+
+    summed, weight = patches.tiled_inference(lambda x: x, img[None], 8, 4, weight=patches.blend_window(8, mode),
+                                             max_batch_bytes=3000)
+    np.testing.assert_allclose((summed / weight).numpy(), img[None].numpy(), rtol=1e-4, atol=1e-5)
+    with pytest.raises(ValueError):
+        eye2you.helper_functions.sliding_window_vessel(model, img, 8, 4, 1, device='cpu', blend=mode)
+
+
+@pytest.mark.parametrize('stride', [1, 2, 3, (4, 2)])
+def test_merge_labels(stride):
+    labels = (torch.rand(2, 3, 22, 18) > 0.5).float()
+    windows = patches.split_patches(labels[:1, :1], 6, stride)
+    s_h, s_w = stride if isinstance(stride, tuple) else (stride, stride)
+    n_h, n_w = patches.grid_size((22, 18), 6, stride)
+    votes = torch.zeros(22, 18)
+    count = torch.zeros(22, 18)
+    for ii in range(n_h):
+        for jj in range(n_w):
+            votes[ii * s_h:ii * s_h + 6, jj * s_w:jj * s_w + 6] += windows[ii * n_w + jj, 0]
+            count[ii * s_h:ii * s_h + 6, jj * s_w:jj * s_w + 6] += 1
+
+    probability, merged_votes = eye2you.helper_functions.merge_labels(windows, (22, 18), stride, return_votes=True)
+    np.testing.assert_equal(merged_votes.numpy(), votes.numpy())
+    np.testing.assert_allclose(probability.numpy(), (votes / count.clamp_min(1)).numpy(), rtol=1e-6)
+    # identical windows reproduce the covered part of the labels
+    np.testing.assert_allclose(probability[count > 0].numpy(), labels[0, 0][count > 0].numpy())
+
+    _, nhw_votes = eye2you.helper_functions.merge_labels(windows[:, 0], (22, 18), stride, return_votes=True)
+    np.testing.assert_equal(nhw_votes.numpy(), votes.numpy())
+
+    # default: pixels found by more than minimum_matches patches
+    for minimum_matches in (0, 1, 2):
+        merged = eye2you.helper_functions.merge_labels(windows, (22, 18), stride, minimum_matches=minimum_matches)
+        np.testing.assert_equal(merged.numpy(), (votes - minimum_matches).clamp(0, 1).numpy())
+    with pytest.raises(ValueError):
+        eye2you.helper_functions.merge_labels(windows[1:], (22, 18), stride)
+
+
+def test_sample_patches():
+    images = torch.rand(3, 3, 20, 24)
+    labels = (torch.rand(3, 1, 20, 24) > 0.5).float()
+    img_patch, lab_patch = eye2you.helper_functions.sample_patches(images, labels, 8, 50)
+    assert img_patch.shape == (50, 3, 8, 8)
+    assert lab_patch.shape == (50, 2, 8, 8)
+    np.testing.assert_equal((lab_patch[:, 0] + lab_patch[:, 1]).numpy(), 1)
+    # every patch is a window of one of the images
+    windows = patches.split_patches(images, 8, 1)
+    matches = (img_patch[:, None] == windows[None]).flatten(2).all(2)
+    assert torch.all(matches.any(1))
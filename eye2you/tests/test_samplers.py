@@ -0,0 +1,121 @@
+# pylint: disable=redefined-outer-name
+import numpy as np
+import pytest
+import torch
+
+from eye2you import factory
+from eye2you.samplers import (BucketBatchSampler, DistributedWeightedSampler, StratifiedBatchSampler,
+                              class_balanced_weights, sample_classes)
+
+
+class LabelDataset(torch.utils.data.Dataset):
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return torch.tensor(index), torch.from_numpy(self.targets[index])
+
+
+def test_sample_classes():
+    targets = np.array([[1, 0, 0], [0, 1, 0], [1, 1, 0], [0, 0, 0], [0, 0, 1]])
+    np.testing.assert_equal(sample_classes(targets), [0, 1, 1, -1, 2])
+    np.testing.assert_equal(sample_classes(targets, [0, 1]), [0, 1, 1, -1, -1])
+
+
+def test_equal_sampler_weights():
+    rng = np.random.default_rng(0)
+    targets = (rng.random((1000, 3)) < [0.8, 0.3, 0.05]).astype(np.float32)
+    sampler = factory.get_equal_sampler(LabelDataset(targets), num_samples=10, relevant_slice=[0, 1, 2])
+
+    # reference: the original loop based computation
+    class_distribution = targets.astype(int)
+    weights = np.array([np.mean(class_distribution[:, ii] == 1) for ii in range(3)])
+    inverted_weights = (1 / weights) / np.sum(1 / weights)
+    sampling_weights = np.zeros(len(targets))
+    for ii in range(3):
+        sampling_weights[class_distribution[:, ii] == 1] = inverted_weights[ii]
+    sampling_weights /= sampling_weights.sum()
+    np.testing.assert_allclose(sampler.weights.numpy(), sampling_weights)
+
+
+def test_stratified_batch_sampler():
+    classes = np.array([0] * 90 + [1] * 8 + [2] * 2 + [-1] * 5)
+    sampler = StratifiedBatchSampler(classes, batch_size=7, num_batches=20, seed=0)
+    assert len(sampler) == 20
+    batches = list(sampler)
+    assert len(batches) == 20
+    counts = np.zeros(3, dtype=int)
+    for batch in batches:
+        assert len(batch) == 7
+        per_class = np.bincount(classes[batch], minlength=3)
+        assert per_class.min() >= 2 and per_class.max() <= 3
+        counts += per_class
+    assert counts.sum() == 140
+    # each pool is exhausted before it is reshuffled, also when a quota wraps in the middle of a draw
+    classes = np.array([0] * 5 + [1] * 100)
+    for seed in range(20):
+        sampler = StratifiedBatchSampler(classes, batch_size=6, num_batches=2, seed=seed)
+        # pylint: disable=protected-access
+        drawn = np.concatenate([np.concatenate(sampler._draw(0, 3)) for _ in range(5)])
+        for start in range(0, 15, 5):
+            np.testing.assert_equal(np.sort(drawn[start:start + 5]), np.arange(5))
+
+    with pytest.raises(ValueError):
+        StratifiedBatchSampler(np.full(10, -1), batch_size=2, num_batches=1)
+
+
+def test_stratified_batches_loader():
+    targets = np.zeros((50, 2))
+    targets[:45, 0] = 1
+    targets[45:, 1] = 1
+    loader = factory.get_loader({'batch_size': 4, 'num_workers': 0, 'num_samples': 40, 'stratified_batches': True},
+                                LabelDataset(targets))
+    assert len(loader) == 10
+    for index, target in loader:
+        assert np.sum(targets[index.numpy(), 1]) == target[:, 1].sum() == 2
+
+
+def test_bucket_batch_sampler():
+    sizes = np.array([[100, 150]] * 7 + [[150, 100]] * 5 + [[110, 160]] * 3)
+    sampler = BucketBatchSampler(sizes, batch_size=4, granularity=64, seed=0)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 2 + 2 + 1
+    assert sorted(np.concatenate(batches)) == list(range(len(sizes)))
+    for batch in batches:
+        assert len(np.unique(-(-sizes[batch] // 64), axis=0)) == 1
+
+    sampler = BucketBatchSampler(sizes, batch_size=4, granularity=8, drop_last=True, shuffle=False)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 2
+    assert all(len(b) == 4 for b in batches)
+
+
+def test_distributed_weighted_sampler():
+    rng = np.random.default_rng(0)
+    targets = (rng.random((500, 2)) < [0.9, 0.1]).astype(np.float32)
+    weights = class_balanced_weights(targets, [0, 1])
+    samplers = [DistributedWeightedSampler(weights, 1001, num_replicas=3, rank=rank, seed=1) for rank in range(3)]
+    assert all(len(s) == s.num_samples == 334 for s in samplers)
+
+    # the processes split one weighted draw of the same generator
+    shards = [list(s) for s in samplers]
+    drawn = np.array([shards[ii % 3][ii // 3] for ii in range(1001)])
+    generator = torch.Generator().manual_seed(1)
+    expected = torch.multinomial(torch.as_tensor(weights), 1001, True, generator=generator).numpy()
+    np.testing.assert_equal(drawn, expected)
+    classes = sample_classes(targets[drawn], [0, 1])
+    assert 0.4 < (classes == 1).mean() < 0.6
+
+    for s in samplers:
+        s.set_epoch(1)
+    assert list(samplers[0]) != shards[0]
+
+    # without replacement every sample is drawn once per epoch
+    samplers = [DistributedWeightedSampler(np.ones(10), replacement=False, num_replicas=4, rank=rank) for rank in range(4)]
+    drawn = sum((list(s) for s in samplers), [])
+    assert len(drawn) == 12
+    assert sorted(set(drawn)) == list(range(10))
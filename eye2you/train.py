@@ -1,8 +1,14 @@
+import os
+import pathlib
+import socket
 import sys
+import tempfile
 
 import numpy as np
 import pandas as pd
 import torch
+import torch.distributed as dist
+import torch.multiprocessing
 import torchvision.transforms as transforms
 import yaml
 from sklearn.linear_model import LinearRegression
@@ -73,12 +79,36 @@ class Logger():
 
     def get_best(self, category, criterion, min_or_max='max'):
         if min_or_max == 'max':
-            idx = self._log[category][criterion].idxmax(axis='index', skipna=True)
+            idx = self._log[category][criterion].idxmax(skipna=True)
         else:
-            idx = self._log[category][criterion].idxmin(axis='index', skipna=True)
+            idx = self._log[category][criterion].idxmin(skipna=True)
         return idx, self._log[category].iloc[idx].values
 
 
+def _distributed_worker(rank, world_size, init_method, state_filename, run_kwargs):
+    # one process of Coach.run with num_processes, starts from and returns the state in state_filename
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        state_dict = torch.load(state_filename, weights_only=False)
+        coach = Coach()
+        coach.load_config(state_dict['config'], distributed=True, split=state_dict['split'])
+        coach.net.load_state_dict(state_dict)
+        coach.epochs = state_dict['epochs']
+        coach.log = state_dict['log']
+        coach.run(**run_kwargs)
+        if rank == 0:
+            coach.save(state_filename)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
 class Coach():
 
     def __init__(self):
@@ -90,31 +120,67 @@ class Coach():
         self.validate_loader = None
         self.log = None
         self.config = None
+        # (train_index, validation_index) of a random split of the dataset csv
+        self.split = None
 
         self.epochs = 0
+        # rank of this process when training with several processes, see run
+        self.rank = 0
 
-    def load_config(self, config):
+    def load_config(self, config, distributed=False, split=None):
+        tune_files = dict()
         if isinstance(config, dict):
             self.config = config
         else:  # then it should be a filename
             self.config = factory.config_from_yaml(config)
+            # results of num_workers: auto are stored next to the config
+            config = pathlib.Path(config)
+            tune_files = {
+                section: config.parent / '{}.{}_loader.yaml'.format(config.stem, section)
+                for section in ('training', 'validation')
+            }
 
         dataprep = datasets.DataPreparation(**self.config['data_preparation'])
-        dataaug = datasets.DataAugmentation(**self.config['data_augmentation'])
+        batch_augmentation = self.config.get('batch_augmentation', None)
+        if batch_augmentation is None:
+            dataaug = datasets.DataAugmentation(**self.config['data_augmentation'])
+        else:
+            # rotation, flips and color jitter are done on the batch, the samples are only cropped and resized
+            dataaug = datasets.DataAugmentation(**{
+                key: value
+                for key, value in self.config['data_augmentation'].items()
+                if key in ('size', 'scale', 'ratio', 'fused')
+            })
 
-        self.train_data, self.validate_data = factory.data_from_config(self.config['dataset'])
+        self.train_data, self.validate_data, self.split = factory.data_from_config(self.config['dataset'],
+                                                                                   split=split,
+                                                                                   return_split=True)
 
         self.train_data.preparation = dataprep
         self.train_data.augmentation = dataaug
 
         self.validate_data.preparation = dataprep
 
-        self.train_loader = factory.get_loader(self.config['training'], self.train_data)
+        self.train_loader = factory.get_loader(self.config['training'],
+                                               self.train_data,
+                                               tune_file=tune_files.get('training', None),
+                                               distributed=distributed)
 
-        self.validate_loader = factory.get_loader(self.config['validation'], self.validate_data)
+        self.validate_loader = factory.get_loader(self.config['validation'],
+                                                  self.validate_data,
+                                                  tune_file=tune_files.get('validation', None),
+                                                  distributed=distributed)
 
         self.net = Network(**self.config['net'])
         self.device = self.net.device
+        if distributed:
+            self.rank = dist.get_rank()
+            self.net.distribute()
+
+        if batch_augmentation is not None:
+            self.net.augmentation = datasets.BatchAugmentation(mean=dataprep.mean,
+                                                               std=dataprep.std,
+                                                               **batch_augmentation)
 
         self.log = Logger()
         self.log.columns = self.net.name_measures()
@@ -123,6 +189,7 @@ class Coach():
         state_dict = self.net.get_state_dict()
         state_dict['epochs'] = self.epochs
         state_dict['config'] = self.config
+        state_dict['split'] = self.split
         state_dict['log'] = self.log
         torch.save(state_dict, filename)
 
@@ -138,7 +205,7 @@ class Coach():
                 device = self.device
         state_dict = torch.load(filename, map_location=device)
         if self.net is None:
-            self.load_config(state_dict['config'])
+            self.load_config(state_dict['config'], split=state_dict.get('split', None))
         self.epochs = state_dict['epochs']
         self.config = state_dict['config']
         self.log = state_dict['log']
@@ -153,20 +220,53 @@ class Coach():
             checkpoint=None,
             early_stop_window=None,
             early_stop_criterion='loss',
-            early_stop_slope=0.0):
+            early_stop_slope=0.0,
+            num_processes=None):
+        '''Trains for num_epochs epochs with validation after each epoch.
+
+        Arguments:
+            num_epochs {int} -- number of epochs
+
+        Keyword Arguments:
+            log_filename {str} -- csv file the log is written to after each epoch (default: {None})
+            checkpoint {str} -- prefix of the checkpoints of the best epochs (default: {None})
+            early_stop_window {int} -- epochs for the slope of early_stop_criterion (default: {None})
+            early_stop_criterion {str} -- validation measure for early stopping (default: {'loss'})
+            early_stop_slope {float} -- stop if the slope is below (default: {0.0})
+            num_processes {int} -- train data parallel in this many processes on this host with the gloo
+                backend. Each process uses the train/validation split of this coach and loads its share
+                of the samples, only the first one writes logs and checkpoints. Afterwards this coach
+                has the trained weights and log (default: {None})
+        '''
+        run_kwargs = dict(num_epochs=num_epochs,
+                          log_filename=log_filename,
+                          checkpoint=checkpoint,
+                          early_stop_window=early_stop_window,
+                          early_stop_criterion=early_stop_criterion,
+                          early_stop_slope=early_stop_slope)
+        if num_processes is not None and num_processes > 1 and not self.net.distributed:
+            self._run_distributed(num_processes, run_kwargs)
+            return
+
+        main = self.rank == 0
         #TODO: add error message if model is not set up completely
-        pbar = tqdm(total=num_epochs, desc='Epoch', position=0)
-        log_title = tqdm(total=0, desc='Criteria', position=2, bar_format='{desc}')
+        pbar = tqdm(total=num_epochs, desc='Epoch', position=0, disable=not main)
+        log_title = tqdm(total=0, desc='Criteria', position=2, bar_format='{desc}', disable=not main)
         log_title.set_description_str(
             ('Performance meter: ' + ' {:>8.8}' * (1 + len(self.net.performance_meters))).format(
                 'loss', *[p.__str__() for p in self.net.performance_meters]))
 
-        log_train = tqdm(total=0, desc='Training results', position=3, bar_format='{desc}')
-        log_val = tqdm(total=0, desc='Validation results', position=4, bar_format='{desc}')
-        log_best = tqdm(total=0, desc='Validation best', position=5, bar_format='{desc}')
-        log_slope = tqdm(total=0, desc='Validation slope', position=6, bar_format='{desc}')
+        log_train = tqdm(total=0, desc='Training results', position=3, bar_format='{desc}', disable=not main)
+        log_val = tqdm(total=0, desc='Validation results', position=4, bar_format='{desc}', disable=not main)
+        log_best = tqdm(total=0, desc='Validation best', position=5, bar_format='{desc}', disable=not main)
+        log_slope = tqdm(total=0, desc='Validation slope', position=6, bar_format='{desc}', disable=not main)
         for _ in range(num_epochs):
-            train_results = self.net.train(self.train_loader, position=1)
+            # distributed samplers draw new samples each epoch
+            for loader in (self.train_loader, self.validate_loader):
+                if hasattr(loader.sampler, 'set_epoch'):
+                    loader.sampler.set_epoch(self.epochs)
+            accumulation_steps = factory.get_accumulation_steps(self.config['training'], self.epochs)
+            train_results = self.net.train(self.train_loader, position=1, accumulation_steps=accumulation_steps)
             validate_results = self.net.validate(self.validate_loader, position=1)
 
             self.log.append(train_results, 'training')
@@ -180,9 +280,9 @@ class Coach():
             log_best.set_description_str(('Best after {:7d}:' + ' {:>8.4f}' * len(best_results)).format(
                 best_idx, *best_results))
 
-            if log_filename is not None:
+            if log_filename is not None and main:
                 self.log.to_csv(log_filename)
-            if checkpoint is not None:
+            if checkpoint is not None and main:
                 #TODO: select max/min by criterion
                 idxmax, idxmin = self.log.idxmaxmin('validation')
                 for ii, idx in enumerate(idxmax[1:]):
@@ -195,11 +295,26 @@ class Coach():
                 validation_slope = self.log.get_slope('validation', early_stop_criterion, early_stop_window)
                 log_slope.set_description_str('Validation slope:  {:.4f}'.format(validation_slope))
                 if validation_slope < early_stop_slope and self.epochs >= early_stop_window:
-                    pbar.write('Early stop triggered. Slope {}'.format(validation_slope))
+                    if main:
+                        pbar.write('Early stop triggered. Slope {}'.format(validation_slope))
                     return
             self.epochs += 1
             pbar.update(1)
 
+    def _run_distributed(self, num_processes, run_kwargs):
+        # the processes start from the current state and hand back the trained one in a file
+        with tempfile.TemporaryDirectory() as directory:
+            state_filename = str(pathlib.Path(directory) / 'state.ckpt')
+            self.save(state_filename)
+            init_method = 'tcp://127.0.0.1:{}'.format(_free_port())
+            torch.multiprocessing.spawn(_distributed_worker,
+                                        args=(num_processes, init_method, state_filename, run_kwargs),
+                                        nprocs=num_processes)
+            state_dict = torch.load(state_filename, weights_only=False)
+        self.net.load_state_dict(state_dict)
+        self.epochs = state_dict['epochs']
+        self.log = state_dict['log']
+
     def validate(self):
         validate_results = self.net.validate(self.validate_loader)
         return validate_results